@@ -1,8 +1,19 @@
+import json
+import time
 import uvicorn
 import logging
-from fastapi import FastAPI
-from service_ml import calculate_top_films
-from service_ml import calculate_recommendations_one, calculate_recommendations_all
+from typing import List
+from fastapi import Body, FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from service_ml import calculate_top_films, calculate_film_recommendations, calculate_film_features, calculate_model_snapshot
+from service_ml import calculate_recommendations_one, calculate_recommendations_many, calculate_recommendations_all, migrate_user_profiles
+from calculations_film import film_catalog
+from cache import recommendations_cache
+from bson import ObjectId
+from jobs import job_manager
+from db import KMongoDb, get_client, close_client, get_pool_stats
+from indexes import ensure_indexes
+from metrics import metrics, request_timings, add_gauges
 from config import config
 
 # Set others loggers level
@@ -22,21 +33,123 @@ logging.basicConfig(
 # API
 api = FastAPI()
 
+
+# Один пул соединений с Mongo на весь процесс
+@api.on_event('startup')
+def api_startup():
+    logging.info('Open Mongo connection pool')
+    get_client()
+
+    if config.MONGO_ENSURE_INDEXES:
+        try:
+            ensure_indexes(KMongoDb(config.MONGO_INITDB_DATABASE))
+        except Exception:
+            logging.exception('Indexes are not created')
+
+    # Прогреваем каталог фильмов, чтобы первый запрос не ждал его загрузки
+    if config.FILM_CANDIDATES_MODE != 'query':
+        try:
+            film_catalog.get(KMongoDb(config.MONGO_INITDB_DATABASE))
+        except Exception:
+            logging.exception('Film catalog is not loaded, it will be loaded on first request')
+
+
+# Тайминги этапов каждого запроса: заголовок Server-Timing и лог, медленные запросы логируем с INFO
+@api.middleware('http')
+async def api_timings(request: Request, call_next):
+    timings = {}
+    token = request_timings.set(timings)
+    started_at = time.perf_counter()
+
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+
+    seconds = time.perf_counter() - started_at
+    endpoint = getattr(request.scope.get('endpoint'), '__name__', request.url.path)
+    metrics.observe_request(request.method, endpoint, response.status_code, seconds)
+
+    response.headers['Server-Timing'] = ', '.join(
+        [f'{stage};dur={value * 1000:.2f}' for stage, value in timings.items()] + [f'total;dur={seconds * 1000:.2f}']
+    )
+    summary = {
+        'method': request.method,
+        'path': request.url.path,
+        'status': response.status_code,
+        'totalMs': round(seconds * 1000, 2),
+        'stagesMs': {stage: round(value * 1000, 2) for stage, value in timings.items()},
+    }
+    level = logging.INFO if seconds * 1000 >= config.SLOW_REQUEST_MS else logging.DEBUG
+    logging.log(level, f'Request timings: {json.dumps(summary)}')
+    return response
+
+
+@api.on_event('shutdown')
+def api_shutdown():
+    logging.info('Stop jobs')
+    job_manager.shutdown()
+
+    logging.info('Close Mongo connection pool')
+    close_client()
+
+
 # Пересчитываем средний рейтинг фильмов
 # Результат складываем в отдельную коллекцию
+# Синхронные роуты тоже идут через job_manager: параллельные вызовы ждут один и тот же расчёт,
+# тайминги этапов расчёта попадают в Server-Timing запроса, который его запустил
 @api.post('/calculate/top/films')
 def api_calculate_top_films():
     logging.info('Calculate top films')
-    response = calculate_top_films()
+    response = job_manager.call('top_films', calculate_top_films)
+    logging.debug(f'Response: {response}')
+    return response
+
+# Пересчитываем признаки изменённых фильмов
+# Результат складываем в отдельную коллекцию
+@api.post('/calculate/film/features')
+def api_calculate_film_features():
+    logging.info('Calculate film features')
+    response = job_manager.call('film_features', calculate_film_features)
+    logging.debug(f'Response: {response}')
+    return response
+
+# Пересчитываем похожие фильмы для каждого фильма
+# Результат складываем в отдельную коллекцию
+@api.post('/calculate/film/recommendations')
+def api_calculate_film_recommendations():
+    logging.info('Calculate similar films')
+    response = job_manager.call('film_recommendations', calculate_film_recommendations)
+    logging.debug(f'Response: {response}')
+    return response
+
+# Сохраняем новую версию снапшота модели, API процессы подхватывают её без перезапуска
+@api.post('/calculate/snapshot')
+def api_calculate_model_snapshot():
+    logging.info('Calculate model snapshot')
+    response = job_manager.call('model_snapshot', calculate_model_snapshot)
     logging.debug(f'Response: {response}')
     return response
 
 # Пересчитываем рекомендации для пользователей
 # Результат складываем в отдельную коллекцию
 @api.post('/calculate/user/recommendations')
-def api_calculate_recommendations_all():
-    logging.info('Calculate recommendations for all users')
-    response = calculate_recommendations_all()
+def api_calculate_recommendations_all(full_rebuild:bool=False):
+    logging.info(f'Calculate recommendations for all users, full_rebuild: {full_rebuild}')
+    response = job_manager.call('user_recommendations', calculate_recommendations_all, full_rebuild=full_rebuild)
+    logging.debug(f'Response: {response}')
+    return response
+
+# Пересчёт рекомендаций для списка пользователей: ["user_id", ...]
+# Объявлен до /{user_id}, иначе batch попадёт в user_id
+@api.post('/calculate/user/recommendations/batch')
+def api_calculate_recommendations_many(user_ids:List[str]=Body(...)):
+    invalid_ids = [user_id for user_id in user_ids if not ObjectId.is_valid(user_id)]
+    if invalid_ids:
+        raise HTTPException(status_code=400, detail=f'Invalid user ids {invalid_ids[:10]}')
+
+    logging.info(f'Calculate recommendations for {len(user_ids)} users')
+    response = calculate_recommendations_many(user_ids)
     logging.debug(f'Response: {response}')
     return response
 
@@ -48,6 +161,70 @@ def api_calculate_recommendations_one(user_id:str):
     logging.debug(f'Response: {response}')
     return response
 
+# Отдаём сохранённые рекомендации пользователя, для неизвестных пользователей - ТОП фильмов
+# Ответы кэшируются в памяти процесса на RECOMMENDATIONS_CACHE_TTL_SECONDS
+@api.get('/recommendations/{user_id}')
+def api_recommendations(user_id:str):
+    if not ObjectId.is_valid(user_id):
+        raise HTTPException(status_code=400, detail=f'Invalid user id {user_id}')
+
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
+    return recommendations_cache.get_recommendations(mongo_db, ObjectId(user_id))
+
+# Асинхронные расчёты: сразу возвращаем jobId, статус смотрим через GET /jobs/{job_id}
+@api.post('/jobs/top/films')
+def api_job_top_films():
+    logging.info('Submit job: calculate top films')
+    return job_manager.submit('top_films', calculate_top_films).to_dict()
+
+@api.post('/jobs/film/features')
+def api_job_film_features():
+    logging.info('Submit job: calculate film features')
+    return job_manager.submit('film_features', calculate_film_features).to_dict()
+
+@api.post('/jobs/film/recommendations')
+def api_job_film_recommendations():
+    logging.info('Submit job: calculate similar films')
+    return job_manager.submit('film_recommendations', calculate_film_recommendations).to_dict()
+
+@api.post('/jobs/snapshot')
+def api_job_model_snapshot():
+    logging.info('Submit job: calculate model snapshot')
+    return job_manager.submit('model_snapshot', calculate_model_snapshot).to_dict()
+
+@api.post('/jobs/user/recommendations')
+def api_job_recommendations_all(full_rebuild:bool=False):
+    logging.info(f'Submit job: calculate recommendations for all users, full_rebuild: {full_rebuild}')
+    return job_manager.submit('user_recommendations', calculate_recommendations_all, full_rebuild=full_rebuild).to_dict()
+
+@api.post('/jobs/user/profiles/migrate')
+def api_job_migrate_user_profiles():
+    logging.info('Submit job: migrate user profiles')
+    return job_manager.submit('migrate_user_profiles', migrate_user_profiles).to_dict()
+
+@api.get('/jobs')
+def api_jobs():
+    return [job.to_dict() for job in job_manager.list()]
+
+@api.get('/jobs/{job_id}')
+def api_job(job_id:str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} not found')
+    return job.to_dict()
+
+# Статистика пула соединений с Mongo
+@api.get('/stats/mongo')
+def api_mongo_stats():
+    return get_pool_stats()
+
+# Метрики в формате Prometheus
+@api.get('/metrics', response_class=PlainTextResponse)
+def api_metrics():
+    lines = []
+    add_gauges(lines, 'kinoki_mongo_pool', get_pool_stats())
+    return metrics.render() + '\n'.join(lines) + '\n'
+
 if __name__ == "__main__":
     logging.info('Starting...')
     uvicorn.run("api:api", host=config.API_HOST, port=8080)
@@ -0,0 +1,268 @@
+"""
+    Benchmark of service stages on synthetic data, without Mongo.
+
+    python benchmark.py --films 10000 --likes 1000000 --users 100000 --output report.json
+    python benchmark.py --likes 100000 --compare report.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import statistics
+import bson
+from bson.raw_bson import RawBSONDocument
+
+# Обязательные переменные окружения config, если бенчмарк запускается без .env
+BENCHMARK_ENV = {
+    'MONGO_INITDB_DATABASE': 'benchmark',
+    'DEFAULT_TOP_LIMIT': '100',
+    'DEFAULT_TOP_RATING': '7',
+    'DEFAULT_COSINE_LIMIT': '0.8',
+    'DEFAULT_FILM_MISSED_RATING': '5',
+    'DEFAULT_ACTIVITY_TRIGGER_LIMIT': '5',
+    'NUMBER_SIMILAR_FILMS': '20',
+    'NUMBER_QUERY_FILMS': '500',
+    'LOGGIN_LEVEL': 'INFO',
+}
+for key, value in BENCHMARK_ENV.items():
+    os.environ.setdefault(key, value)
+
+# Снапшоты модели из рабочего каталога не должны попасть в замеры
+os.environ.setdefault('SNAPSHOT_DIR', tempfile.mkdtemp(prefix='kinoki_snapshots_'))
+
+import service_ml
+from config import config
+from cache import film_cache, recommendations_cache
+from calculations_film import film_catalog
+from calculations_user import prepare_top_films, prepare_user_activity
+from calculations_user import prepare_user_recommendations, process_user_recommendations
+from helpers import get_user_key, get_raw_document_id
+from metrics import metrics
+from synthetic import InMemoryMongoDb, load_synthetic_data, project
+
+# Logger
+logging.getLogger(__name__)
+
+# Проекции скана фильмов-кандидатов: весь документ, весь staff (как было до db.PROJECTIONS) и проекции сервиса
+CANDIDATE_SCAN_PROJECTIONS = {
+    'none': None,
+    'full_staff': {"nameRu":1, "nameOriginal":1, "genres":1, "countries":1, "staff":1},
+    'film_features': 'film_features',
+    'film_scoring': 'film_scoring',
+}
+
+STAGES = [
+    'prepare_top_films',
+    'prepare_user_activity',
+    'prepare_user_recommendations',
+    'process_user_recommendations',
+    'calculate_recommendations_all',
+    'calculate_recommendations_one',
+]
+
+
+def clear_caches():
+    film_cache.clear()
+    recommendations_cache.clear()
+    film_catalog.engine = None
+
+
+def measure(function, repeat, memory, mongo_db):
+    """
+        Run function repeat times, then once more under tracemalloc to get peak memory.
+        Timings are measured without tracemalloc, it slows python code down.
+        Every run starts from the same database state: profiles, recommendations and other collections,
+        which stage writes, are restored from dump before the run
+    """
+    skip = (config.MONGO_FILMS_TABLE, config.MONGO_FILMS_LIKES_TABLE)
+    state = mongo_db.dump(skip)
+
+    seconds = []
+    for _ in range(repeat):
+        mongo_db.restore(state, skip)
+        clear_caches()
+        metrics.clear()
+        started_at = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - started_at)
+
+    report = {
+        'seconds': [round(value, 6) for value in seconds],
+        'min': round(min(seconds), 6),
+        'median': round(statistics.median(seconds), 6),
+    }
+    if isinstance(result, dict):
+        report.update(result)
+
+    # Разбивка последнего запуска по этапам stage_timer
+    if metrics.stages:
+        report['stageSeconds'] = {stage: round(stats[1], 6) for stage, stats in metrics.stages.items()}
+
+    if memory:
+        mongo_db.restore(state, skip)
+        clear_caches()
+        tracemalloc.start()
+        function()
+        report['peakMemoryBytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return report
+
+
+def run_recommendations_one(user_ids):
+    """
+        Recommendations for sample of users one by one, with latency percentiles
+    """
+    latencies = []
+    for user_id in user_ids:
+        started_at = time.perf_counter()
+        service_ml.calculate_recommendations_one(user_id)
+        latencies.append(time.perf_counter() - started_at)
+
+    latencies.sort()
+    return {
+        'users': len(latencies),
+        'p50': round(latencies[len(latencies) // 2], 6),
+        'p99': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 6),
+    }
+
+
+def measure_candidate_scan(films, repeat):
+    """
+        Bytes of candidate films in BSON, as they come from Mongo, and median time of decoding them
+        into dicts or of reading them as RawBSONDocument like calculate_film_features does: _id is taken
+        from the bytes (indexing RawBSONDocument decodes the whole document) for every projection
+    """
+    def median_seconds(function):
+        timings = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started_at)
+        return round(statistics.median(timings), 6)
+
+    result = {}
+    for name, select_query in CANDIDATE_SCAN_PROJECTIONS.items():
+        documents = [bson.encode(project(film, select_query)) for film in films]
+        result[name] = {
+            'bytes': sum(len(document) for document in documents),
+            'decodeSeconds': median_seconds(lambda: [bson.decode(document) for document in documents]),
+            'rawDecodeSeconds': median_seconds(lambda: [get_raw_document_id(RawBSONDocument(document)) for document in documents]),
+        }
+
+    base = result['none']
+    for stats in result.values():
+        stats['bytesRatio'] = round(stats['bytes'] / base['bytes'], 4) if base['bytes'] else None
+        stats['decodeRatio'] = round(stats['decodeSeconds'] / base['decodeSeconds'], 4) if base['decodeSeconds'] else None
+    return result
+
+
+def run_benchmark(args):
+    mongo_db = InMemoryMongoDb(config.MONGO_INITDB_DATABASE)
+    started_at = time.perf_counter()
+    load_synthetic_data(mongo_db, args.films, args.likes, args.users, seed=args.seed)
+    generation_seconds = time.perf_counter() - started_at
+
+    # Все расчёты service_ml идут в in-memory базу
+    service_ml.KMongoDb = mongo_db
+
+    films = mongo_db.get_records(config.MONGO_FILMS_TABLE)
+    likes = mongo_db.get_records(config.MONGO_FILMS_LIKES_TABLE)
+
+    # Пользователи для calculate_recommendations_one: после calculate_recommendations_all у всех есть профили
+    users = sorted({str(like.get('userId') or like.get('anonymousId')) for like in likes})
+    user_ids = random.Random(args.seed).sample(users, min(args.sample_users, len(users)))
+
+    user_recommendations = None
+    if 'process_user_recommendations' in args.stages:
+        user_recommendations = prepare_user_recommendations(prepare_user_activity(likes))
+
+    stages = {
+        'prepare_top_films': lambda: {'items': len(prepare_top_films(films))},
+        'prepare_user_activity': lambda: {'items': len(prepare_user_activity(likes))},
+        'prepare_user_recommendations': lambda: {'items': len(prepare_user_recommendations(prepare_user_activity(likes)))},
+        'process_user_recommendations': lambda: {'items': sum(len(batch) for batch in process_user_recommendations(user_recommendations))},
+        'calculate_recommendations_all': lambda: service_ml.calculate_recommendations_all(full_rebuild=True),
+        'calculate_recommendations_one': lambda: run_recommendations_one(user_ids),
+    }
+
+    report = {
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'params': {
+            'films': args.films,
+            'likes': args.likes,
+            'users': args.users,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'sampleUsers': len(user_ids),
+            'filmCandidatesMode': config.FILM_CANDIDATES_MODE,
+            'profileWorkers': config.PROFILE_WORKERS,
+        },
+        'generationSeconds': round(generation_seconds, 6),
+        'usersWithLikes': len({get_user_key(like) for like in likes}),
+        'stages': {},
+    }
+
+    logging.info('Benchmark candidate scan projections')
+    report['candidateScan'] = measure_candidate_scan(films, args.repeat)
+
+    for stage in args.stages:
+        logging.info(f'Benchmark {stage}')
+        report['stages'][stage] = measure(stages[stage], args.repeat, not args.no_memory, mongo_db)
+        logging.info(f'Benchmark {stage}: {report["stages"][stage]["median"]} s')
+
+    return report
+
+
+def compare_reports(report, base_report):
+    """
+        Median time and peak memory of stages relative to base report
+    """
+    comparison = {}
+    for stage, result in report['stages'].items():
+        base = base_report.get('stages', {}).get(stage)
+        if base is None:
+            continue
+
+        comparison[stage] = {'medianRatio': round(result['median'] / base['median'], 4) if base['median'] else None}
+        if 'peakMemoryBytes' in result and base.get('peakMemoryBytes'):
+            comparison[stage]['peakMemoryRatio'] = round(result['peakMemoryBytes'] / base['peakMemoryBytes'], 4)
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of service stages on synthetic data')
+    parser.add_argument('--films', type=int, default=1000)
+    parser.add_argument('--likes', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sample-users', type=int, default=100, help='users for calculate_recommendations_one')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc run')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='previous report to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s: %(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    report = run_benchmark(args)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            report['comparison'] = compare_reports(report, json.load(file))
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=4, ensure_ascii=False)
+    logging.info(f'Benchmark report saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
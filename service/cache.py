@@ -0,0 +1,212 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from metrics import metrics
+from helpers import get_film_features_record
+from config import config
+
+# Logger
+logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+        Bounded in-process cache with LRU eviction
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __contains__(self, key):
+        return key in self.records
+
+
+    def get(self, key, default=None):
+        """
+            Get value by key and mark it as recently used
+        """
+        with self.lock:
+            if key not in self.records:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.records.move_to_end(key)
+            return self.records[key]
+
+
+    def set(self, key, value):
+        """
+            Set value by key, evict least recently used values over maxsize
+        """
+        with self.lock:
+            self.records[key] = value
+            self.records.move_to_end(key)
+
+            while len(self.records) > self.maxsize:
+                self.records.popitem(last=False)
+
+
+    def delete(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+
+class TTLCache(LRUCache):
+    """
+        LRU cache, where values expire after ttl seconds
+    """
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+
+    def get(self, key, default=None):
+        """
+            Get value by key, expired values are removed and counted as misses
+        """
+        with self.lock:
+            item = self.records.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.records.pop(key, None)
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.records.move_to_end(key)
+            return item[1]
+
+
+    def set(self, key, value):
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+
+class RecommendationsCache(TTLCache):
+    """
+        Stored user recommendations as API responses.
+        Users without recommendations get ml_film_top list
+    """
+    TOP_FILMS_KEY = '__top_films__'
+
+    def get_recommendations(self, mongo_db, user_id):
+        """
+            Get recommendations of user as {'userId', 'source', 'films'}, source is user or top
+        """
+        key = str(user_id)
+        response = self.get(key)
+        if response is not None:
+            return response
+
+        find_query = {
+            "$or": [
+                {"userId": user_id},
+                {"anonymousId": user_id}
+            ]
+        }
+        records = mongo_db.get_sorted_limited_records(
+            config.MONGO_USER_RECOMS_TABLE,
+            sort_field='rank',
+            ascending=True,
+            find_query=find_query,
+            select_query={"_id":0, "filmId":1},
+            limit=config.NUMBER_SIMILAR_FILMS
+        )
+
+        if records:
+            response = {'userId': key, 'source': 'user', 'films': [str(record['filmId']) for record in records]}
+        else:
+            response = {'userId': key, 'source': 'top', 'films': self.get_top_films(mongo_db)}
+
+        self.set(key, response)
+        return response
+
+
+    def get_top_films(self, mongo_db):
+        """
+            Top films by mean rating, the same list for all unknown users
+        """
+        films = self.get(self.TOP_FILMS_KEY)
+        if films is None:
+            records = mongo_db.get_sorted_limited_records(
+                config.MONGO_FILMS_TOP_TABLE,
+                sort_field='meanRating',
+                ascending=False,
+                select_query={"_id":0, "filmId":1},
+                limit=config.NUMBER_SIMILAR_FILMS
+            )
+            films = [str(record['filmId']) for record in records]
+            self.set(self.TOP_FILMS_KEY, films)
+
+        return films
+
+
+class FilmCache(TTLCache):
+    """
+        Film features cache: features are loaded from ml_film_features by chunked $in queries
+        and only for ids which are not cached yet. Features of films, which are not materialized yet,
+        are calculated from film collection. Features expire after ttl seconds, as film features
+        recalculated in other process are not invalidated here
+    """
+    def get_films(self, mongo_db, film_ids):
+        """
+            Get film features by ids as {filmId: features}. Films missed in Mongo are not returned
+        """
+        films = {}
+        missed_ids = []
+
+        for filmid in dict.fromkeys(film_ids):
+            film = self.get(filmid)
+            if film is None:
+                missed_ids.append(filmid)
+            else:
+                films[filmid] = film
+
+        if missed_ids:
+            # Кэш нужен профилям и скорингу кандидатов: persons и staff дальше staff[:10] им не нужны
+            records = mongo_db.get_records_by_ids(
+                config.MONGO_FILM_FEATURES_TABLE,
+                missed_ids,
+                select_query="features_scoring",
+                chunk_size=config.FILM_QUERY_CHUNK_SIZE
+            )
+
+            # Новые фильмы, для которых ещё не посчитаны признаки
+            found_ids = {record['_id'] for record in records}
+            not_materialized_ids = [filmid for filmid in missed_ids if filmid not in found_ids]
+            if not_materialized_ids:
+                records += mongo_db.get_records_by_ids(
+                    config.MONGO_FILMS_TABLE,
+                    not_materialized_ids,
+                    select_query="film_scoring",
+                    chunk_size=config.FILM_QUERY_CHUNK_SIZE
+                )
+
+            for record in records:
+                film = get_film_features_record(record)
+                self.set(film['_id'], film)
+                films[film['_id']] = film
+
+            logging.debug(f'Film cache: {len(films) - len(records)} hits, {len(records)} films loaded, '
+                          f'{len(not_materialized_ids)} without materialized features')
+
+        return films
+
+
+film_cache = FilmCache(config.FILM_CACHE_SIZE, config.FILM_CACHE_TTL_SECONDS)
+recommendations_cache = RecommendationsCache(config.RECOMMENDATIONS_CACHE_SIZE, config.RECOMMENDATIONS_CACHE_TTL_SECONDS)
+metrics.register_cache('films', film_cache)
+metrics.register_cache('recommendations', recommendations_cache)
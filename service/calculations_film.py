@@ -0,0 +1,418 @@
+import time
+import logging
+import threading
+import numpy as np
+from scipy import sparse
+from helpers import get_profile_top_features, get_film_features_record
+from snapshots import SnapshotStore, MODEL_SNAPSHOT, encode_object_ids, decode_object_ids
+from config import config
+
+# Logger
+logging.getLogger(__name__)
+
+def get_film_features(film):
+    """Film features as tokens, same slices as in helpers.get_film_similarity"""
+
+    film = get_film_features_record(film)
+    features = ['genre:' + genre for genre in film["genres"][:3]]
+    features += ['country:' + country for country in film["countries"][:2]]
+    features += ['director:' + director for director in film["directors"]]
+    features += ['actor:' + actor for actor in film["actors"]]
+    features += ['text:' + word for word in film["texts"]]
+
+    # Similarity считается по множествам, поэтому убираем дубли
+    return list(dict.fromkeys(features))
+
+
+def get_profile_features(user_profile):
+    """User profile features as tokens in the same namespace as film features"""
+
+    features = ['genre:' + genre for genre in user_profile.get("genres") or {}]
+    features += ['country:' + country for country in user_profile.get("countries") or {}]
+    features += ['director:' + director for director in user_profile.get("directors") or {}]
+    features += ['actor:' + actor for actor in user_profile.get("actors") or {}]
+    features += ['text:' + word for word in user_profile.get("texts") or []]
+    return features
+
+
+def get_film_index_keys(film):
+    """Film keys for inverted index: all genres, countries and persons, as Mongo $in matches any of them"""
+
+    film = get_film_features_record(film)
+    keys = ['genre:' + genre for genre in film["genres"]]
+    keys += ['country:' + country for country in film["countries"]]
+    keys += ['person:' + person for person in film["persons"]]
+    return list(dict.fromkeys(keys))
+
+
+def iter_film_features(mongo_db):
+    """
+        Features of all films from ml_film_features, or from film collection, if features are not calculated yet.
+        Features of films, added after the last film features job, are calculated from film collection on the fly,
+        features of deleted films are skipped
+    """
+    if not mongo_db.estimate_records(config.MONGO_FILM_FEATURES_TABLE):
+        logging.warning(f'{config.MONGO_FILM_FEATURES_TABLE} is empty, film features are calculated from {config.MONGO_FILMS_TABLE}')
+        yield from mongo_db.iter_records(config.MONGO_FILMS_TABLE, select_query="film_features")
+        return
+
+    missed_ids = {record["_id"] for record in mongo_db.iter_records(config.MONGO_FILMS_TABLE, select_query={"_id":1})}
+    for record in mongo_db.iter_records(config.MONGO_FILM_FEATURES_TABLE):
+        if record["_id"] in missed_ids:
+            missed_ids.remove(record["_id"])
+            yield record
+
+    if missed_ids:
+        logging.warning(f'{len(missed_ids)} films have no features in {config.MONGO_FILM_FEATURES_TABLE}, '
+                        f'their features are calculated from {config.MONGO_FILMS_TABLE}')
+        yield from mongo_db.get_records_by_ids(config.MONGO_FILMS_TABLE, sorted(missed_ids), select_query="film_features")
+
+
+def build_csr_matrix(rows_tokens):
+    """
+        Binary CSR matrix from token lists: rows x vocabulary
+    """
+    vocabulary = {}
+    indices = []
+    indptr = [0]
+
+    for tokens in rows_tokens:
+        for token in tokens:
+            indices.append(vocabulary.setdefault(token, len(vocabulary)))
+        indptr.append(len(indices))
+
+    matrix = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, len(vocabulary))
+    )
+    return vocabulary, matrix
+
+
+class FilmInvertedIndex:
+    """
+        Inverted index: genre, country, person -> films.
+        Keys x films CSR matrix, row of the key is the list of film positions
+    """
+    def __init__(self, film_ids, vocabulary, matrix):
+        self.film_ids = film_ids
+        self.vocabulary = vocabulary
+        self.matrix = matrix
+
+
+    def get_rows(self, key):
+        row = self.vocabulary.get(key)
+        if row is None:
+            return np.array([], dtype=np.int32)
+        return self.matrix.indices[self.matrix.indptr[row]:self.matrix.indptr[row+1]]
+
+
+    def get_candidates(self, user_profile, exclude_rows=None):
+        """
+            Candidate film positions: the same films helpers.get_filter finds in Mongo,
+            but without NUMBER_QUERY_FILMS limit
+        """
+        genres, countries, directors, actors = get_profile_top_features(user_profile)
+        keys = ['genre:' + genre for genre in genres]
+        keys += ['country:' + country for country in countries]
+        keys += ['person:' + person for person in directors + actors]
+
+        # Bitmap union of films by keys, watched films are excluded
+        mask = np.zeros(len(self.film_ids), dtype=bool)
+        for key in keys:
+            mask[self.get_rows(key)] = True
+        if exclude_rows is not None:
+            mask[exclude_rows] = False
+
+        return np.flatnonzero(mask)
+
+
+class FilmScoringEngine:
+    """
+        Films x features binary CSR matrix.
+
+        Similarity of film and user profile is the number of common features
+        (genres, countries, director, actors, title words), so all films are
+        scored by one sparse matrix-vector product.
+    """
+    def __init__(self, film_ids, vocabulary, matrix, index=None):
+        self.film_ids = film_ids
+        self.film_index = {filmid: i for i, filmid in enumerate(film_ids)}
+        self.vocabulary = vocabulary
+        self.matrix = matrix
+        self.index = index
+
+
+    def __len__(self):
+        return len(self.film_ids)
+
+
+    @classmethod
+    def from_films(cls, films, with_index=False):
+        """
+            Build engine (and inverted index over the same films) from iterable of films
+        """
+        film_ids = []
+        features = []
+        index_keys = []
+
+        for film in films:
+            film_ids.append(film.get('_id'))
+            features.append(get_film_features(film))
+            if with_index:
+                index_keys.append(get_film_index_keys(film))
+
+        vocabulary, matrix = build_csr_matrix(features)
+        index = None
+        if with_index:
+            keys_vocabulary, keys_matrix = build_csr_matrix(index_keys)
+            index = FilmInvertedIndex(film_ids, keys_vocabulary, keys_matrix.T.tocsr())
+
+        return cls(film_ids, vocabulary, matrix, index)
+
+
+    def to_snapshot(self):
+        """
+            Arrays for snapshots.save_snapshot: vocabularies in column order, films in row order
+        """
+        arrays = {
+            'film_ids': encode_object_ids(self.film_ids),
+            'film_vocabulary': np.array(list(self.vocabulary), dtype=str),
+            'film_matrix': self.matrix,
+        }
+        if self.index is not None:
+            arrays['index_vocabulary'] = np.array(list(self.index.vocabulary), dtype=str)
+            arrays['index_matrix'] = self.index.matrix
+        return arrays
+
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+            Engine over memory-mapped matrices of snapshot, only ids and vocabularies are decoded into process memory
+        """
+        film_ids = decode_object_ids(snapshot['film_ids'])
+        vocabulary = {feature: i for i, feature in enumerate(snapshot['film_vocabulary'].tolist())}
+        index = None
+        if 'index_matrix' in snapshot:
+            keys_vocabulary = {key: i for i, key in enumerate(snapshot['index_vocabulary'].tolist())}
+            index = FilmInvertedIndex(film_ids, keys_vocabulary, snapshot['index_matrix'])
+
+        return cls(film_ids, vocabulary, snapshot['film_matrix'], index)
+
+
+    def get_profile_vector(self, user_profile):
+        """
+            User profile as binary vector over engine vocabulary
+        """
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        vector[self.get_profile_columns(user_profile)] = 1
+        return vector
+
+
+    def get_profile_columns(self, user_profile):
+        """
+            Unique vocabulary columns of user profile features
+        """
+        columns = [self.vocabulary[feature] for feature in get_profile_features(user_profile) if feature in self.vocabulary]
+        return list(dict.fromkeys(columns))
+
+
+    def get_profiles_matrix(self, user_profiles):
+        """
+            User profiles as binary sparse matrix users x vocabulary
+        """
+        columns = [self.get_profile_columns(user_profile) for user_profile in user_profiles]
+        indptr = np.cumsum([0] + [len(user_columns) for user_columns in columns])
+        indices = np.array([column for user_columns in columns for column in user_columns], dtype=np.int32)
+        return sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), indices, indptr),
+            shape=(len(user_profiles), len(self.vocabulary))
+        )
+
+
+    def get_rows(self, film_ids):
+        """
+            Matrix rows of known films
+        """
+        return np.array([self.film_index[filmid] for filmid in film_ids if filmid in self.film_index], dtype=np.int64)
+
+
+    def score(self, user_profile, rows=None):
+        """
+            Similarity of user profile with all films (or with films in rows)
+        """
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return matrix @ self.get_profile_vector(user_profile)
+
+
+    def get_candidates(self, user_profile):
+        """
+            Candidate films by inverted index, watched films excluded
+        """
+        exclude_rows = self.get_rows(user_profile.get("watchedFilms", []))
+        return self.index.get_candidates(user_profile, exclude_rows)
+
+
+    def recommend(self, user_profile, k, rows=None, exclude_ids=(), min_score=None):
+        """
+            Top k films as [(filmId, similarity)], sorted by similarity desc.
+            Films with equal similarity keep order of rows, like stable sort does
+        """
+        rows = np.arange(len(self.film_ids)) if rows is None else np.asarray(rows, dtype=np.int64)
+        scores = self.score(user_profile, rows)
+        return self.get_top_films(rows, scores, k, exclude_ids, min_score)
+
+
+    def recommend_many(self, user_profiles, k, rows=None, exclude_ids=None, min_score=None):
+        """
+            Recommend for many users at once: candidate rows of all users are united
+            and scored by one sparse matrix-matrix product.
+            rows, exclude_ids - lists with candidate rows and excluded films of every user
+        """
+        if rows is None:
+            all_rows = np.arange(len(self.film_ids))
+            rows = [all_rows] * len(user_profiles)
+        rows = [np.asarray(user_rows, dtype=np.int64) for user_rows in rows]
+        exclude_ids = exclude_ids or [()] * len(user_profiles)
+
+        # Все кандидаты скорим один раз: films x users
+        union_rows = np.unique(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+        scores = (self.matrix[union_rows] @ self.get_profiles_matrix(user_profiles).T).toarray()
+
+        return [
+            self.get_top_films(user_rows, scores[np.searchsorted(union_rows, user_rows), i], k, exclude_ids[i], min_score)
+            for i, user_rows in enumerate(rows)
+        ]
+
+
+    def get_top_films(self, rows, scores, k, exclude_ids=(), min_score=None):
+        """
+            Top k of films in rows by scores
+        """
+        # Убираем просмотренные фильмы и фильмы с маленькой похожестью
+        keep = np.ones(len(rows), dtype=bool)
+        exclude_rows = self.get_rows(exclude_ids)
+        if len(exclude_rows):
+            keep &= ~np.isin(rows, exclude_rows)
+        if min_score is not None:
+            keep &= scores >= min_score
+
+        positions = np.flatnonzero(keep)
+        return [(self.film_ids[rows[i]], round(float(scores[i]), 2)) for i in top_k(scores, k, positions)]
+
+
+def top_k(scores, k, positions=None):
+    """
+        Positions of k max scores, sorted by score desc and by position asc
+    """
+    positions = np.arange(len(scores)) if positions is None else positions
+    values = scores[positions]
+
+    # argpartition находит порог, а все значения на пороге добираем по позиции
+    if 0 < k < len(values):
+        threshold = values[np.argpartition(-values, k - 1)[k - 1]]
+        positions = positions[values >= threshold]
+        values = scores[positions]
+
+    order = np.lexsort((positions, -values))
+    return positions[order][:k]
+
+
+def get_co_likes_matrix(user_codes, film_rows, number_of_films):
+    """
+        Films x films cosine similarity of likes: number of users liked both films / sqrt(n_i * n_j)
+    """
+    likes = sparse.csr_matrix(
+        (np.ones(len(user_codes), dtype=np.float32), (user_codes, film_rows)),
+        shape=(int(user_codes.max()) + 1 if len(user_codes) else 0, number_of_films)
+    )
+    likes.data[:] = 1  # repeated likes of the same film count once
+
+    co_likes = (likes.T @ likes).tocsr()
+    norms = np.sqrt(co_likes.diagonal())
+    norms[norms == 0] = 1
+
+    inverse_norms = sparse.diags(1 / norms)
+    return (inverse_norms @ co_likes @ inverse_norms).tocsr()
+
+
+def get_similar_films(engine, k, co_likes=None, co_like_weight=0.0, block_size=1000):
+    """
+        Top k similar films for every film in engine.
+        Similarity is the number of common content features, plus co_like_weight * co-likes similarity.
+        Yields records for ml_film_recommendations
+    """
+    features_t = engine.matrix.T.tocsr()
+
+    for start in range(0, len(engine), block_size):
+        rows = np.arange(start, min(start + block_size, len(engine)))
+        similarity = engine.matrix[rows] @ features_t
+        if co_likes is not None and co_like_weight:
+            similarity = similarity + co_likes[rows] * co_like_weight
+        similarity = similarity.tocsr()
+
+        for i, row in enumerate(rows):
+            columns = similarity.indices[similarity.indptr[i]:similarity.indptr[i+1]]
+            scores = similarity.data[similarity.indptr[i]:similarity.indptr[i+1]]
+
+            # Сам фильм себе не рекомендуем
+            keep = (columns != row) & (scores > 0)
+            columns, scores = columns[keep], scores[keep]
+
+            order = np.lexsort((columns, -scores))[:k]
+            yield {
+                'filmId': engine.film_ids[row],
+                'similarFilms': [
+                    {'filmId': engine.film_ids[column], 'similarity': round(float(score), 4)}
+                    for column, score in zip(columns[order], scores[order])
+                ]
+            }
+
+
+class FilmCatalog:
+    """
+        Process-wide scoring engine with inverted index for the whole film catalog.
+        If model snapshot is saved, engine is memory-mapped from its current version: films are as of
+        the snapshot, film features job saves new version, when features are changed.
+        Otherwise engine is reloaded from Mongo every refresh_seconds. While reloading
+        requests keep using previous engine.
+    """
+    def __init__(self, refresh_seconds):
+        self.refresh_seconds = refresh_seconds
+        self.engine = None
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+        self.snapshots = SnapshotStore(MODEL_SNAPSHOT, FilmScoringEngine.from_snapshot)
+
+
+    def get(self, mongo_db):
+        """
+            Get current engine, load or reload it if needed
+        """
+        engine = self.snapshots.get()
+        if engine is not None:
+            return engine
+
+        if self.engine is None:
+            with self.lock:
+                if self.engine is None:
+                    self.load(mongo_db)
+
+        elif time.time() - self.loaded_at > self.refresh_seconds and self.lock.acquire(blocking=False):
+            try:
+                self.load(mongo_db)
+            finally:
+                self.lock.release()
+
+        return self.engine
+
+
+    def load(self, mongo_db):
+        logging.info('Loading film catalog')
+        self.engine = FilmScoringEngine.from_films(iter_film_features(mongo_db), with_index=True)
+        self.loaded_at = time.time()
+        logging.info(f'Film catalog loaded: {len(self.engine)} films, {len(self.engine.vocabulary)} features, '
+                     f'{len(self.engine.index.vocabulary)} index keys')
+
+
+film_catalog = FilmCatalog(config.FILM_CATALOG_REFRESH_SECONDS)
@@ -1,7 +1,12 @@
 import pandas as pd
+import numpy as np
 import logging
-from bson import ObjectId
-from sklearn.metrics.pairwise import pairwise_distances
+from bson import ObjectId, Decimal128
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+from helpers import get_user_key
+from calculations_film import top_k
+from snapshots import SnapshotStore, MODEL_SNAPSHOT, encode_object_ids, decode_object_ids
 from config import config
 
 # Logger
@@ -16,32 +21,161 @@ def get_film_rating(film, key):
     return rating
 
 
-def prepare_top_films(films):
-    """Prepare top films based on their ratings"""
+# Точные степени 10: coefficient / 10**k округляется так же, как float(Decimal)
+POWERS_OF_TEN = np.array([float(10**power) for power in range(23)])
+EMPTY_DECIMAL128 = Decimal128('0').bid
+
+
+def decode_decimal128(values):
+    """
+        Decode list of Mongo Decimal128 (or None) to float array in bulk from BID bytes.
+        Values which can't be converted exactly in bulk are converted one by one
+    """
+    is_decimal = np.array([isinstance(value, Decimal128) for value in values], dtype=bool)
+    bids = b''.join(value.bid if decimal else EMPTY_DECIMAL128 for value, decimal in zip(values, is_decimal))
+    words = np.frombuffer(bids, dtype='<u8').reshape(len(values), 2)
+    low, high = words[:, 0], words[:, 1]
+
+    # IEEE 754-2008 BID: sign, 14 bits of exponent, 113 bits of coefficient
+    exponent = ((high >> np.uint64(49)) & np.uint64(0x3FFF)).astype(np.int64) - 6176
+    special = ((high >> np.uint64(61)) & np.uint64(3)) == 3
+    exact = is_decimal & ~special & ((high & np.uint64((1 << 49) - 1)) == 0) & (low < np.uint64(2**53)) & (np.abs(exponent) <= 22)
+
+    coefficient = low.astype(np.float64)
+    power = POWERS_OF_TEN[np.clip(np.abs(exponent), 0, 22)]
+    ratings = np.where(exponent < 0, coefficient / power, coefficient * power)
+    ratings = np.where(high >> np.uint64(63), -ratings, ratings)
+
+    for row in np.flatnonzero(~exact).tolist():
+        value = values[row]
+        ratings[row] = np.nan if value is None else float(value.to_decimal() if is_decimal[row] else value)
+
+    return ratings
+
+
+def get_film_ratings(films, key):
+    """Turn Mongo Decimal128 column to float array, missed ratings are filled by DEFAULT_FILM_MISSED_RATING"""
+
+    values = [film.get(key) for film in films]
+    missed = np.array([value is None for value in values], dtype=bool)
+
+    ratings = decode_decimal128(values)
+    ratings = ratings/10 if key == 'ratingGoodReview' else ratings
+    ratings[missed] = config.DEFAULT_FILM_MISSED_RATING
+    return ratings
+
+
+def prepare_top_films(films, segment_keys=()):
+    """Prepare top films based on their ratings, segment_keys (genres, countries) are copied from films"""
 
-    top_films = []
     rating_keys = ['rating', 'ratingFilmCritics', 'ratingGoodReview', 'ratingImdb', 'ratingKinopoisk']
     rating_keys_length = len(rating_keys)
     logging.info(f'Preparing top films based on: {rating_keys}')
 
-    # Решил делать не через пандас, а через словари, 
-    # т.к. по времени это в 2 раза быстрее выходит
-    for film in films:
-        film['meanRating'] = 0.0
-        for key in rating_keys:
-            if film.get(key) is None:
-                film['meanRating'] += config.DEFAULT_FILM_MISSED_RATING
-            else:
-                film['meanRating'] += get_film_rating(film, key)
-
-        film['meanRating'] /= rating_keys_length
-        if film['meanRating'] >= config.DEFAULT_TOP_RATING:
-            top_film = {'filmId': film.get('_id'), 'meanRating': film.get('meanRating')}
-            top_films.append(top_film)
+    # Считаем колонками: каждый рейтинг декодируем сразу для всех фильмов
+    # Складываем по очереди, как раньше в цикле, чтобы среднее совпадало до последнего знака
+    mean_ratings = np.zeros(len(films), dtype=np.float64)
+    for key in rating_keys:
+        mean_ratings += get_film_ratings(films, key)
+    mean_ratings /= rating_keys_length
+
+    top_rows = np.flatnonzero(mean_ratings >= config.DEFAULT_TOP_RATING)
+    top_films = [{'filmId': films[row].get('_id'), 'meanRating': mean_rating} for row, mean_rating in zip(top_rows.tolist(), mean_ratings[top_rows].tolist())]
 
+    # Жанры и страны нужны только для ТОПов по сегментам
+    for top_film, row in zip(top_films, top_rows.tolist()):
+        for key in segment_keys:
+            top_film[key] = films[row].get(key) or []
     return top_films
 
 
+TOP_SEGMENTS = {'genre': 'genres', 'country': 'countries'}
+
+
+def prepare_top_segments(top_films, number_of_films):
+    """
+        Top films of every genre and country: records for ml_film_top_segments.
+        Films are sorted by meanRating desc and filmId asc, as in get_top_films_pipeline
+    """
+    segments = {}
+    for film in sorted(top_films, key=lambda film: (-film['meanRating'], film['filmId'])):
+        for segment, key in TOP_SEGMENTS.items():
+            for value in film.get(key) or []:
+                record = segments.setdefault(f'{segment}:{value}', {
+                    '_id': f'{segment}:{value}', 'segment': segment, 'value': value, 'films': []
+                })
+                if len(record['films']) < number_of_films:
+                    record['films'].append({'filmId': film['filmId'], 'meanRating': film['meanRating']})
+
+    return list(segments.values())
+
+
+def get_mean_rating_stages():
+    """
+        Aggregation stages with the same mean rating as prepare_top_films:
+        ratings are added one by one in the same order, ratingGoodReview is divided by 10,
+        missed ratings are filled by DEFAULT_FILM_MISSED_RATING
+    """
+    rating_keys = ['rating', 'ratingFilmCritics', 'ratingGoodReview', 'ratingImdb', 'ratingKinopoisk']
+    missed_rating = config.DEFAULT_FILM_MISSED_RATING
+
+    mean_rating = None
+    for key in rating_keys:
+        rating = {"$toDouble": f"${key}"}
+        rating = {"$divide": [rating, 10]} if key == 'ratingGoodReview' else rating
+        rating = {"$ifNull": [rating, missed_rating]}
+        mean_rating = rating if mean_rating is None else {"$add": [mean_rating, rating]}
+
+    return [
+        {"$project": {"meanRating": {"$divide": [mean_rating, len(rating_keys)]}, "genres": 1, "countries": 1}},
+        {"$match": {"meanRating": {"$gte": config.DEFAULT_TOP_RATING}}},
+    ]
+
+
+def get_top_films_pipeline(number_of_films):
+    """
+        Aggregation pipeline over film collection, which reads films once: records for ml_film_top
+        and top number_of_films films of every genre and country for ml_film_top_segments.
+        Every record has "collection" field with its target, see KMongoDb.aggregate_into_collections.
+
+        Top of segment is kept by bounded $topN accumulator (MongoDB 5.2+) instead of $push of all
+        films of genre. $facet returns one document, so ml_film_top records must fit in 16MB (~400k films)
+    """
+    facets = {
+        "top": [
+            {"$project": {
+                "_id": 0,
+                "collection": {"$literal": config.MONGO_FILMS_TOP_TABLE},
+                "filmId": "$_id",
+                "meanRating": 1,
+            }},
+        ],
+    }
+    for segment, key in TOP_SEGMENTS.items():
+        facets[key] = [
+            {"$unwind": f"${key}"},
+            {"$group": {"_id": f"${key}", "films": {"$topN": {
+                "n": number_of_films,
+                "sortBy": {"meanRating": -1, "_id": 1},
+                "output": {"filmId": "$_id", "meanRating": "$meanRating"},
+            }}}},
+            {"$project": {
+                "_id": {"$concat": [f"{segment}:", "$_id"]},
+                "collection": {"$literal": config.MONGO_FILMS_TOP_SEGMENTS_TABLE},
+                "segment": {"$literal": segment},
+                "value": "$_id",
+                "films": 1,
+            }},
+        ]
+
+    return get_mean_rating_stages() + [
+        {"$facet": facets},
+        {"$project": {"records": {"$concatArrays": [f"${key}" for key in facets]}}},
+        {"$unwind": "$records"},
+        {"$replaceRoot": {"newRoot": "$records"}},
+    ]
+
+
 # def map_user_likes(row):
 #     if row['state'] == 'LIKE' and row.get('listCode') == 'WATCHED':
 #         state = 2
@@ -64,6 +198,10 @@ def map_user_likes(row):
     return state
 
 
+# Same mapping as map_user_likes, for vectorized Series.map
+USER_STATES = {'LIKE': 1, 'DISLIKE': -1}
+
+
 def prepare_user_activity(user_likes):
     logging.info('Preparing user activity')
 
@@ -87,7 +225,7 @@ def prepare_user_activity(user_likes):
         else:
             df_like['uniqueId'] = df_like['userId'].fillna(df_like['anonymousId'])
 
-        df_like['state'] = df_like.apply(map_user_likes, axis=1)
+        df_like['state'] = df_like['state'].map(USER_STATES)
     logging.info(f'Collected user_likes: {len(df_like)}')
 
     # Объединяем данные вместе
@@ -95,9 +233,9 @@ def prepare_user_activity(user_likes):
         df_like = df_like[['uniqueId', 'userId', 'anonymousId', 'filmId', 'state']]
 
         # Исключаем пользователей, у которых меньше config.DEFAULT_ACTIVITY_TRIGGER_LIMIT оценок\лайков фильмов
-        less_active_users = df_like.groupby('uniqueId')['filmId'].count()
-        less_active_users = [user for user, likes in less_active_users.items() if likes < config.DEFAULT_ACTIVITY_TRIGGER_LIMIT]
-        df_user_activity = df_like[~df_like['uniqueId'].isin(less_active_users)]
+        # Пользователи без uniqueId в группировку не попадают и остаются
+        user_likes_count = df_like.groupby('uniqueId')['filmId'].transform('count')
+        df_user_activity = df_like[~(user_likes_count < config.DEFAULT_ACTIVITY_TRIGGER_LIMIT)]
         df_user_activity = df_user_activity.drop('uniqueId', axis=1)
 
         logging.info(f'After filtering less active: {len(df_user_activity)}')
@@ -107,6 +245,168 @@ def prepare_user_activity(user_likes):
         return pd.DataFrame()
 
 
+def get_user_film_codes(df_user_activity):
+    """Integer codes of users & films: (user_codes, user_ids, film_codes, film_ids)"""
+
+    user_codes, user_ids = pd.factorize(df_user_activity['userId'])
+    film_codes, film_ids = pd.factorize(df_user_activity['filmId'])
+    return user_codes, list(user_ids), film_codes, list(film_ids)
+
+
+def get_user_item_matrix(user_codes, film_codes, values, shape):
+    """Sparse users x films matrix, values of the same (user, film) are summed like aggfunc='sum' in pivot_table"""
+
+    matrix = sparse.csr_matrix((np.asarray(values, dtype=np.float64), (user_codes, film_codes)), shape=shape)
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def get_braycurtis_weights(matrix):
+    """
+        Bray-Curtis corrections for common films of two users with states a & b:
+        |a|+|b|-|a-b| for numerator and |a|+|b|-|a+b| for denominator.
+        Returns [(a, numerator weights, denominator weights)], weights are films x users
+    """
+    values = np.unique(matrix.data)
+    indicators = {b: (matrix == b).astype(np.float64) for b in values}
+    weights = []
+
+    for a in values:
+        num_weights = sparse.csr_matrix(matrix.shape)
+        den_weights = sparse.csr_matrix(matrix.shape)
+
+        for b in values:
+            num_weights = num_weights + indicators[b] * (abs(a) + abs(b) - abs(a - b))
+            den_weights = den_weights + indicators[b] * (abs(a) + abs(b) - abs(a + b))
+
+        weights.append((a, num_weights.T.tocsr(), den_weights.T.tocsr()))
+
+    return weights
+
+
+def get_braycurtis_distances(matrix, rows, weights=None):
+    """
+        Bray-Curtis distances between users in rows and all users: sum|u-v| / sum|u+v|.
+
+        Considered only pairs of users with common films, other pairs have distance 1.
+        For common films corrections are computed per pair of state values (a, b),
+        so the full users x users matrix is never built.
+    """
+    weights = get_braycurtis_weights(matrix) if weights is None else weights
+    block = matrix[rows]
+    abs_sums = np.asarray(abs(matrix).sum(axis=1)).ravel()
+
+    # Пары пользователей с общими фильмами
+    common = (block != 0).astype(np.float64) @ (matrix != 0).astype(np.float64).T
+    common = common.tocoo()
+    block_rows, other_rows = common.row, common.col
+
+    num_correction = sparse.csr_matrix(common.shape)
+    den_correction = sparse.csr_matrix(common.shape)
+    for a, num_weights, den_weights in weights:
+        block_a = (block == a).astype(np.float64)
+        num_correction = num_correction + block_a @ num_weights
+        den_correction = den_correction + block_a @ den_weights
+
+    totals = abs_sums[rows][block_rows] + abs_sums[other_rows]
+    numerator = totals - np.asarray(num_correction[block_rows, other_rows]).ravel()
+    denominator = totals - np.asarray(den_correction[block_rows, other_rows]).ravel()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = numerator / denominator
+
+    return block_rows, other_rows, distances
+
+
+def get_user_neighbours(matrix, rows, k=None, weights=None):
+    """
+        Top k nearest users with 0.01 <= distance <= DEFAULT_COSINE_LIMIT for every user in rows.
+        Returns arrays (row, other_row, distance) sorted by row & distance
+    """
+    rows = np.asarray(rows)
+    block_rows, other_rows, distances = get_braycurtis_distances(matrix, rows, weights)
+
+    keep = (distances >= 0.01) & (distances <= config.DEFAULT_COSINE_LIMIT) & (rows[block_rows] != other_rows)
+    block_rows, other_rows, distances = block_rows[keep], other_rows[keep], distances[keep]
+
+    # Сортируем по (пользователь, расстояние) и оставляем первые k в каждой группе
+    order = np.lexsort((other_rows, distances, block_rows))
+    block_rows, other_rows, distances = block_rows[order], other_rows[order], distances[order]
+    if k is not None and len(block_rows):
+        group_starts = np.flatnonzero(np.r_[True, block_rows[1:] != block_rows[:-1]])
+        ranks = np.arange(len(block_rows)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(block_rows)]))
+        keep = ranks < k
+        block_rows, other_rows, distances = block_rows[keep], other_rows[keep], distances[keep]
+
+    return rows[block_rows], other_rows, distances
+
+
+def get_user_correlations(matrix, row):
+    """Pearson correlation over films between user in row and all users, like DataFrame.corrwith"""
+
+    number_of_films = matrix.shape[1]
+    user_vector = matrix[row].toarray().ravel()
+
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    squares = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+    products = matrix @ user_vector
+
+    covariance = products - sums * user_vector.sum() / number_of_films
+    variance = (squares - sums ** 2 / number_of_films) * (user_vector @ user_vector - user_vector.sum() ** 2 / number_of_films)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance / np.sqrt(variance)
+
+
+def get_neighbours_liked_films(rows, other_rows, liked, seen):
+    """
+        Films liked by neighbours (other_rows) of users (rows), which users haven't liked or disliked yet.
+        Returns arrays (row, film_code)
+    """
+    if not len(rows):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    current_rows, neighbours_rows = np.unique(rows, return_inverse=True)
+    neighbours = sparse.csr_matrix(
+        (np.ones(len(rows)), (neighbours_rows, other_rows)),
+        shape=(len(current_rows), liked.shape[0])
+    )
+
+    films = neighbours @ liked
+    films.data[:] = 1
+    films = films - films.multiply(seen[current_rows])
+    films.eliminate_zeros()
+    films = films.tocoo()
+
+    return current_rows[films.row], films.col.astype(np.int64)
+
+
+class UserRecommendations:
+    """
+        Recommended films of users as pairs of integer codes (user_codes[i], film_codes[i]).
+        user_ids - userId or ANON_ + anonymousId strings, film_ids - film ObjectIds
+    """
+    def __init__(self, user_ids, film_ids, user_codes, film_codes):
+        self.user_ids = user_ids
+        self.film_ids = film_ids
+        self.user_codes = user_codes
+        self.film_codes = film_codes
+
+
+    def __len__(self):
+        return len(self.user_codes)
+
+
+    def to_dict(self):
+        """
+            Old format: {user: [set of films]}
+        """
+        dict_user_recommendations = {}
+        for user_code, film_code in zip(self.user_codes.tolist(), self.film_codes.tolist()):
+            dict_user_recommendations.setdefault(self.user_ids[user_code], [set()])[0].add(self.film_ids[film_code])
+        return dict_user_recommendations
+
+
 def prepare_user_recommendations(df_user_activity, user_id=None):
     logging.info('Start preparing user recommendations')
 
@@ -115,99 +415,244 @@ def prepare_user_recommendations(df_user_activity, user_id=None):
     df_user_activity['userId'] = df_user_activity['userId'].fillna('ANON_' + df_user_activity['anonymousId'].astype('string'))
     df_user_activity['userId'] = df_user_activity['userId'].astype('string')
 
-    # Вычисляем разряженную матрицу: в строках userId, в столбцах filmId, в значениях 1\0 (в зависимости от оценки)
-    df_matrix = pd.pivot_table(df_user_activity, index='userId', columns='filmId', values='state', aggfunc='sum')
-    df_matrix = df_matrix.fillna(0).reset_index()
-
-    # Вычисляем расстояние между пользователями
-    logging.info('Start calculating pairwise_distances between users')
-
-    # Если передали userId, то вычисляем расстояние только м\у этим юзером и остальными, 
-    # А не для всех пар юзеров
-    # braycurtis, hamming, cosine
-    metric = 'braycurtis'
-    if user_id:
-        user_key_id = 'ANON_' + user_id if len(df_matrix[df_matrix['userId']==user_id]) == 0 else user_id
-    
-        one_user = df_matrix[df_matrix['userId']==user_key_id]
-        other_users = df_matrix[df_matrix['userId']!=user_key_id]
-        
-        user_similarity_values = pairwise_distances(one_user[one_user.columns[1:]], other_users[other_users.columns[1:]], metric=metric, n_jobs=-1)
-        user_similarity = dict(zip(other_users['userId'], user_similarity_values.tolist()[0]))
-        
-        # Если одним методом ничё не нашли -> идём искать другим
-        similar_users = [key for key, value in user_similarity.items() if 0.01 <= value <= config.DEFAULT_COSINE_LIMIT]
-        if len(similar_users) <= 3:
-            df_matrix = pd.pivot_table(df_user_activity, index='filmId', columns='userId', values='state', aggfunc='sum')
-            df_matrix = df_matrix.fillna(0).reset_index()
+    # Дальше работаем только с целочисленными кодами пользователей и фильмов
+    user_codes, user_ids, film_codes, film_ids = get_user_film_codes(df_user_activity)
+    user_index = {user: i for i, user in enumerate(user_ids)}
+    shape = (len(user_ids), len(film_ids))
+    states = df_user_activity['state'].to_numpy(dtype=np.float64)
 
-            one_user = df_matrix[user_key_id]
-            other_users = df_matrix.drop(user_key_id, axis=1)
+    # Вычисляем разряженную матрицу: в строках userId, в столбцах filmId, в значениях сумма оценок
+    matrix = get_user_item_matrix(user_codes, film_codes, np.nan_to_num(states), shape)
 
-            user_similarity = other_users.corrwith(one_user).to_dict()
-            user_similarity = dict(sorted(user_similarity.items(), reverse=True, key=lambda x: x[1]))
-            user_similarity = {key:config.DEFAULT_COSINE_LIMIT for key in list(user_similarity.keys())[:50]}
-            logging.debug(f'{user_similarity}')
-
-        user_similarity = {user_key_id: user_similarity}
-    else:
-        user_similarity = pairwise_distances(df_matrix[df_matrix.columns[1:]], metric=metric, n_jobs=-1)
-        user_similarity = pd.DataFrame(user_similarity, columns=df_matrix['userId'], index=df_matrix['userId'])
-        user_similarity = user_similarity.to_dict('dict')
-
-    logging.info('Done calculating pairwise_distances between users')
-
-    # Группируем фильмы по пользователям, которые их лайкнули
-    liked_films = df_user_activity[df_user_activity['state']>=1].groupby('userId')['filmId'].agg(lambda x: set(x)).to_dict()
-    disliked_films = df_user_activity[df_user_activity['state']<0].groupby('userId')['filmId'].agg(lambda x: set(x)).to_dict()  
+    # Фильмы, которые пользователи лайкнули и которые уже оценили
+    liked = get_user_item_matrix(user_codes[states>=1], film_codes[states>=1], np.ones((states>=1).sum()), shape)
+    liked.data[:] = 1
+    rated = (states>=1) | (states<0)
+    seen = get_user_item_matrix(user_codes[rated], film_codes[rated], np.ones(rated.sum()), shape)
+    seen.data[:] = 1
 
+    # Вычисляем расстояние между пользователями
+    # Полную матрицу users x users не строим: идём блоками и оставляем только top k соседей
     # Для текущего юзера определяем похожих юзеров
     # И выбираем их фильмы, чтобы порекомендовать текущему
     logging.info('Start finding similar users and films')
-    dict_user_recommendations = {}
-
-    for current_user_id, value_dct in user_similarity.items():
-        similar_users = [key for key, value in value_dct.items() if 0.01 <= value <= config.DEFAULT_COSINE_LIMIT]
-
-        if bool(similar_users):
-            # Берём фильмы текущего пользователя
-            user_liked_films = liked_films.get(current_user_id, set())
-            user_disliked_films = disliked_films.get(current_user_id, set())
-
-            # Вытаскиевам фильмы похожих пользователей и убираем фильмы, кт юзер уже смотрел или лайкнул
-            user_recommended_films = [film_id for user_id in similar_users for film_id in liked_films.get(user_id, [])]
-            user_recommended_films = set(user_recommended_films) - user_liked_films - user_disliked_films
-            dict_user_recommendations[current_user_id] = [user_recommended_films]
-
-            if user_id:
-                logging.info(f'Got {len(user_recommended_films)} recommendations for {current_user_id}')
-
-    logging.info('Done finding similar users and films')
-    return dict_user_recommendations
-
-
-def process_user_recommendations(dict_user_recommendations):
-    if bool(dict_user_recommendations):
-        # Make user recommendations DataFrame
-        df_users_films = pd.DataFrame.from_dict(dict_user_recommendations, orient='index').reset_index()
-        df_users_films.columns = ['userId', 'filmId']
-        df_users_films = df_users_films.explode('filmId')
-        df_users_films = df_users_films[df_users_films['filmId'].isna()==False]
-        logging.info('Put users recommendations in DataFrame')
-
-        # Devide users and anonymus
-        recs = df_users_films
-        recs['anonymousId'] = recs['userId'].apply(lambda x: x.replace('ANON_', '') if 'ANON_' in x else None)
-        recs['userId'] = recs['userId'].apply(lambda x: x if 'ANON_' not in x else None)
-        logging.info('Devide users and anonymus - done')
-
-        # From String To ObjectId
-        recs['anonymousId'] = recs['anonymousId'].apply(lambda x: ObjectId(x) if x else None)
-        recs['userId'] = recs['userId'].apply(lambda x: ObjectId(x) if x else None)
-        recs = recs.to_dict('records')
-        logging.info('Recommendations to records')
-    
+    recommended_users, recommended_films = [], []
+
+    if user_id:
+        user_key_id = 'ANON_' + user_id if user_id not in user_index else user_id
+        user_row = user_index[user_key_id]
+
+        rows, other_rows, _ = get_user_neighbours(matrix, [user_row], config.NUMBER_SIMILAR_USERS)
+
+        # Если одним методом ничё не нашли -> идём искать другим
+        if len(other_rows) <= 3:
+            correlations = get_user_correlations(matrix, user_row)
+            correlations[user_row] = np.nan
+            # Равные корреляции отличаются в последних знаках: округляем и при равенстве берём пользователей
+            # по порядку id, как стабильная сортировка колонок pivot_table
+            correlations = np.round(correlations, 12)
+            other_rows = sorted(np.flatnonzero(~np.isnan(correlations)).tolist(), key=lambda row: (-correlations[row], user_ids[row]))
+            other_rows = np.array(other_rows[:50], dtype=np.int64)
+            rows = np.full(len(other_rows), user_row)
+            logging.debug(f'{[user_ids[row] for row in other_rows]}')
+
+        users, films = get_neighbours_liked_films(rows, other_rows, liked, seen)
+        recommended_users.append(users)
+        recommended_films.append(films)
+        logging.info(f'Got {len(films)} recommendations for {user_key_id}')
     else:
-        recs = {}
+        block_size = config.USER_NEIGHBOURS_BLOCK_SIZE
+        weights = get_braycurtis_weights(matrix)
+
+        for start in range(0, len(user_ids), block_size):
+            rows = np.arange(start, min(start + block_size, len(user_ids)))
+            rows, other_rows, _ = get_user_neighbours(matrix, rows, config.NUMBER_SIMILAR_USERS, weights)
+            users, films = get_neighbours_liked_films(rows, other_rows, liked, seen)
+            recommended_users.append(users)
+            recommended_films.append(films)
+
+    user_recommendations = UserRecommendations(
+        user_ids,
+        film_ids,
+        np.concatenate(recommended_users) if recommended_users else np.array([], dtype=np.int64),
+        np.concatenate(recommended_films) if recommended_films else np.array([], dtype=np.int64)
+    )
+    logging.info(f'Done finding similar users and films: {len(user_recommendations)} recommendations')
+    return user_recommendations
+
+
+def process_user_recommendations(user_recommendations, batch_size=config.MONGO_BATCH_SIZE):
+    """
+        Yield batches of recommendation records.
+        ObjectId are built once per user, records are built only for current batch
+    """
+    if not len(user_recommendations):
+        return
+
+    # Devide users and anonymus, from String To ObjectId
+    users = {}
+    for user_code in np.unique(user_recommendations.user_codes).tolist():
+        user_key = user_recommendations.user_ids[user_code]
+        if 'ANON_' in user_key:
+            users[user_code] = (None, ObjectId(user_key.replace('ANON_', '')))
+        else:
+            users[user_code] = (ObjectId(user_key), None)
+    logging.info('Devide users and anonymus - done')
+
+    film_ids = user_recommendations.film_ids
+    for start in range(0, len(user_recommendations), batch_size):
+        user_codes = user_recommendations.user_codes[start:start+batch_size].tolist()
+        film_codes = user_recommendations.film_codes[start:start+batch_size].tolist()
+        yield [
+            {'userId': users[user_code][0], 'filmId': film_ids[film_code], 'anonymousId': users[user_code][1]}
+            for user_code, film_code in zip(user_codes, film_codes)
+        ]
+
+
+class UserItemMatrix:
+    """
+        Users x films CSR matrix of summed like states (LIKE 1, DISLIKE -1), training data of FilmFactors.
+        Users are sorted by key (get_user_key), so rows don't depend on order of likes. Columns are films of film catalog
+    """
+    def __init__(self, user_keys, matrix):
+        self.user_keys = user_keys
+        self.matrix = matrix
+
+
+    def __len__(self):
+        return len(self.user_keys)
+
+
+    @classmethod
+    def from_likes(cls, user_likes, film_index):
+        """
+            Build matrix from iterable of likes, film_index - {filmId: column}.
+            Likes of films, which are not in film_index, are skipped
+        """
+        user_index = {}
+        user_codes, film_codes, states = [], [], []
+
+        for like in user_likes:
+            column = film_index.get(like.get("filmId"))
+            if column is None:
+                continue
+            user_codes.append(user_index.setdefault(get_user_key(like), len(user_index)))
+            film_codes.append(column)
+            states.append(USER_STATES.get(like.get("state"), 0))
+
+        # Строки сортируем по ключу пользователя
+        user_keys = np.array(list(user_index), dtype=str)
+        order = np.argsort(user_keys, kind='stable')
+        rows = np.empty(len(order), dtype=np.int64)
+        rows[order] = np.arange(len(order))
+
+        matrix = get_user_item_matrix(
+            rows[np.array(user_codes, dtype=np.int64)], np.array(film_codes, dtype=np.int64),
+            states, (len(user_keys), len(film_index))
+        )
+        return cls(user_keys[order], matrix.astype(np.float32))
+
+
+class FilmFactors:
+    """
+        Low-rank factorization of users x films like matrix: films x k matrix V with orthonormal columns.
+        User is folded in by projecting vector of user likes u into factor space, films are scored by V @ (V^T u),
+        so one user costs two dense matvecs over films instead of distances to all users
+    """
+    def __init__(self, film_ids, factors):
+        self.film_ids = film_ids
+        self.film_index = {filmid: i for i, filmid in enumerate(film_ids)}
+        self.factors = factors
+
+
+    def __len__(self):
+        return len(self.film_ids)
+
+
+    @classmethod
+    def train(cls, user_item_matrix, film_ids, number_of_factors, number_of_iterations=5, random_state=0):
+        """
+            Truncated SVD of user_item_matrix, columns of matrix are film_ids.
+            None if there are too few films or likes for number_of_factors
+        """
+        matrix = user_item_matrix.matrix
+        number_of_factors = min(number_of_factors, matrix.shape[1] - 1, matrix.shape[0] - 1)
+        if number_of_factors < 1 or not matrix.nnz:
+            logging.info(f'Not enough likes for film factors: {matrix.shape}')
+            return None
+
+        svd = TruncatedSVD(n_components=number_of_factors, n_iter=number_of_iterations, random_state=random_state)
+        svd.fit(matrix)
+        logging.info(f'Film factors: {number_of_factors}, explained variance {svd.explained_variance_ratio_.sum():.4f}')
+        return cls(film_ids, np.ascontiguousarray(svd.components_.T, dtype=np.float32))
+
+
+    def to_snapshot(self):
+        return {'factor_film_ids': encode_object_ids(self.film_ids), 'film_factors': self.factors}
+
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        if 'film_factors' not in snapshot:
+            return None
+        return cls(decode_object_ids(snapshot['factor_film_ids']), snapshot['film_factors'])
+
+
+    def get_user_vector(self, user_likes):
+        """
+            Summed like states of user over films, likes of unknown films are skipped
+        """
+        vector = np.zeros(len(self.film_ids), dtype=np.float32)
+        for like in user_likes:
+            row = self.film_index.get(like.get("filmId"))
+            if row is not None:
+                vector[row] += USER_STATES.get(like.get("state"), 0)
+        return vector
+
+
+    def score(self, user_vectors):
+        """
+            Fold-in: scores of all films V @ (V^T u), for vector or films x users matrix of users
+        """
+        return self.factors @ (self.factors.T @ user_vectors)
+
+
+    def recommend(self, user_likes, k, exclude_ids=()):
+        """
+            Top k films as [(filmId, score)] for user with user_likes, rated and excluded films are skipped.
+            Empty list if user has no likes of known films
+        """
+        return self.recommend_many([user_likes], k, [exclude_ids])[0]
+
+
+    def recommend_many(self, users_likes, k, exclude_ids=None):
+        """
+            Recommend for many users: users are folded in together by two matrix-matrix products
+        """
+        exclude_ids = exclude_ids or [()] * len(users_likes)
+        if not users_likes:
+            return []
+
+        user_vectors = np.column_stack([self.get_user_vector(user_likes) for user_likes in users_likes])
+        scores = self.score(user_vectors)
+
+        recommendations = []
+        for i, user_likes in enumerate(users_likes):
+            if not user_vectors[:, i].any():
+                recommendations.append([])
+                continue
+
+            user_scores = scores[:, i]
+            keep = np.ones(len(user_scores), dtype=bool)
+            keep[[self.film_index[filmid] for filmid in exclude_ids[i] if filmid in self.film_index]] = False
+            keep[[self.film_index[like.get("filmId")] for like in user_likes if like.get("filmId") in self.film_index]] = False
+
+            # Рекомендуем только фильмы с положительной оценкой
+            rows = top_k(user_scores, k, np.flatnonzero(keep & (user_scores > 0)))
+            recommendations.append([(self.film_ids[row], round(float(user_scores[row]), 4)) for row in rows.tolist()])
 
-    return recs
+        return recommendations
+
+
+# Факторы фильмов из текущей версии снапшота модели
+film_factors = SnapshotStore(MODEL_SNAPSHOT, FilmFactors.from_snapshot)
@@ -24,9 +24,12 @@ class GlobalConfig():
     MONGO_FILMS_LIKES_TABLE: Optional[str] = "like_dislike"
     MONGO_USER_RECOMS_TABLE: Optional[str] = "ml_user_recommendations"
     MONGO_FILMS_TOP_TABLE: Optional[str] = "ml_film_top"
+    MONGO_FILMS_TOP_SEGMENTS_TABLE: Optional[str] = "ml_film_top_segments"
     MONGO_USER_ACTIVITY_TABLE: Optional[str] = "ml_user_activity"
     MONGO_FILM_RECOMS_TABLE: Optional[str] = "ml_film_recommendations"
     MONGO_USER_PROFILES: Optional[str] = "ml_user_profiles"
+    MONGO_FILM_FEATURES_TABLE: Optional[str] = "ml_film_features"
+    MONGO_SERVICE_STATE_TABLE: Optional[str] = "ml_service_state"
 
     ### SERVICE
     DEFAULT_TOP_LIMIT: Optional[int] = int(os.environ.get('DEFAULT_TOP_LIMIT'))
@@ -35,8 +38,90 @@ class GlobalConfig():
     DEFAULT_FILM_MISSED_RATING: Optional[float] = float(os.environ.get('DEFAULT_FILM_MISSED_RATING'))
     DEFAULT_ACTIVITY_TRIGGER_LIMIT: Optional[int] = int(os.environ.get('DEFAULT_ACTIVITY_TRIGGER_LIMIT'))
     NUMBER_SIMILAR_FILMS: Optional[int] = int(os.environ.get('NUMBER_SIMILAR_FILMS'))
+    NUMBER_SIMILAR_USERS: Optional[int] = int(os.environ.get('NUMBER_SIMILAR_USERS', 50))
+    USER_NEIGHBOURS_BLOCK_SIZE: Optional[int] = int(os.environ.get('USER_NEIGHBOURS_BLOCK_SIZE', 1000))
     LOGGIN_LEVEL: Optional[str] = os.environ.get('LOGGIN_LEVEL')
     NUMBER_QUERY_FILMS: Optional[int] = int(os.environ.get('NUMBER_QUERY_FILMS'))
+    # index - candidates from in-memory inverted index, catalog - score all films,
+    # query - score NUMBER_QUERY_FILMS films found in Mongo by helpers.get_filter,
+    # neighbours - aggregate precomputed ml_film_recommendations of liked films,
+    # factors - fold-in of user likes into film factors of model snapshot (index, if there are no factors)
+    FILM_CANDIDATES_MODE: Optional[str] = os.environ.get('FILM_CANDIDATES_MODE', 'index')
+    FILM_CATALOG_REFRESH_SECONDS: Optional[int] = int(os.environ.get('FILM_CATALOG_REFRESH_SECONDS', 3600))
+    # Сколько пользователей batch пересчёта рекомендаций читаются и скорятся вместе
+    RECOMMENDATIONS_BATCH_SIZE: Optional[int] = int(os.environ.get('RECOMMENDATIONS_BATCH_SIZE', 500))
+
+    ### TOP FILMS
+    # python - ratings are read from Mongo and averaged in service,
+    # aggregation - mean rating is calculated by Mongo aggregation pipeline and $merge-d on server
+    TOP_FILMS_MODE: Optional[str] = os.environ.get('TOP_FILMS_MODE', 'python')
+    # Сколько фильмов хранить в ТОПе каждого жанра и страны
+    NUMBER_SEGMENT_TOP_FILMS: Optional[int] = int(os.environ.get('NUMBER_SEGMENT_TOP_FILMS', 100))
+
+    ### FILM RECOMMENDATIONS
+    NUMBER_FILM_NEIGHBOURS: Optional[int] = int(os.environ.get('NUMBER_FILM_NEIGHBOURS', 50))
+    FILM_NEIGHBOURS_BLOCK_SIZE: Optional[int] = int(os.environ.get('FILM_NEIGHBOURS_BLOCK_SIZE', 1000))
+    # 0 - content features only
+    FILM_CO_LIKE_WEIGHT: Optional[float] = float(os.environ.get('FILM_CO_LIKE_WEIGHT', 0))
+    # Сколько последних лайков пользователя берём в режиме neighbours
+    NUMBER_NEIGHBOUR_SOURCE_FILMS: Optional[int] = int(os.environ.get('NUMBER_NEIGHBOUR_SOURCE_FILMS', 50))
+
+    ### MONGO
+    MONGO_BATCH_SIZE: Optional[int] = int(os.environ.get('MONGO_BATCH_SIZE', 10000))
+    MONGO_MAX_POOL_SIZE: Optional[int] = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+    MONGO_MIN_POOL_SIZE: Optional[int] = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+    MONGO_CONNECT_TIMEOUT_MS: Optional[int] = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 20000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: Optional[int] = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000))
+    # 0 - without timeout
+    MONGO_SOCKET_TIMEOUT_MS: Optional[int] = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 0))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 0))
+    # Создавать недостающие индексы из indexes.INDEXES при старте API и worker.py, 0 - не создавать
+    MONGO_ENSURE_INDEXES: Optional[int] = int(os.environ.get('MONGO_ENSURE_INDEXES', 1))
+
+    ### PROFILES
+    # Shard processes to build user profiles, each keeps profiles of its users; 1 - in current process
+    PROFILE_WORKERS: Optional[int] = int(os.environ.get('PROFILE_WORKERS', 1))
+
+    # Сколько самых частых признаков каждого типа (жанры, страны, персоны, слова) хранить в профиле, 0 - все
+    PROFILE_MAX_FEATURES: Optional[int] = int(os.environ.get('PROFILE_MAX_FEATURES', 500))
+
+    ### SNAPSHOTS
+    # Каталог версий снапшотов модели (.npy), API процессы мапят их в память
+    SNAPSHOT_DIR: Optional[str] = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+    SNAPSHOT_KEEP_VERSIONS: Optional[int] = int(os.environ.get('SNAPSHOT_KEEP_VERSIONS', 3))
+    # Как часто API проверяет, что появилась новая версия снапшота
+    SNAPSHOT_REFRESH_SECONDS: Optional[float] = float(os.environ.get('SNAPSHOT_REFRESH_SECONDS', 60))
+    # Размерность факторов фильмов (truncated SVD матрицы лайков), 0 - факторы не обучаются
+    FILM_FACTORS_NUMBER: Optional[int] = int(os.environ.get('FILM_FACTORS_NUMBER', 64))
+    FILM_FACTORS_ITERATIONS: Optional[int] = int(os.environ.get('FILM_FACTORS_ITERATIONS', 5))
+
+    ### WORKER
+    # Как часто worker.py опрашивает like_dislike и сколько лайков читает за раз
+    WORKER_POLL_SECONDS: Optional[float] = float(os.environ.get('WORKER_POLL_SECONDS', 1))
+    WORKER_POLL_BATCH_SIZE: Optional[int] = int(os.environ.get('WORKER_POLL_BATCH_SIZE', 1000))
+    # События одного пользователя за это время схлопываются в один пересчёт
+    WORKER_COALESCE_SECONDS: Optional[float] = float(os.environ.get('WORKER_COALESCE_SECONDS', 5))
+    # Очередь пользователей полна -> tailer ждёт, пока applier её разберёт
+    WORKER_QUEUE_MAX_USERS: Optional[int] = int(os.environ.get('WORKER_QUEUE_MAX_USERS', 10000))
+    WORKER_BATCH_USERS: Optional[int] = int(os.environ.get('WORKER_BATCH_USERS', 200))
+    # 0 - без /metrics
+    WORKER_METRICS_PORT: Optional[int] = int(os.environ.get('WORKER_METRICS_PORT', 8081))
+
+    ### JOBS
+    # Задачи с разными коллекциями идут параллельно: 4 потока хватает на одну задачу каждой группы
+    JOBS_MAX_WORKERS: Optional[int] = int(os.environ.get('JOBS_MAX_WORKERS', 4))
+
+    ### METRICS
+    # Тайминги запросов дольше SLOW_REQUEST_MS пишутся в лог с уровнем INFO, остальные - с DEBUG
+    SLOW_REQUEST_MS: Optional[float] = float(os.environ.get('SLOW_REQUEST_MS', 100))
+
+    ### CACHE
+    FILM_CACHE_SIZE: Optional[int] = int(os.environ.get('FILM_CACHE_SIZE', 100000))
+    # Признаки, пересчитанные в другом процессе, обновятся в кэше этого процесса не позже чем через TTL
+    FILM_CACHE_TTL_SECONDS: Optional[float] = float(os.environ.get('FILM_CACHE_TTL_SECONDS', 600))
+    FILM_QUERY_CHUNK_SIZE: Optional[int] = int(os.environ.get('FILM_QUERY_CHUNK_SIZE', 1000))
+    RECOMMENDATIONS_CACHE_SIZE: Optional[int] = int(os.environ.get('RECOMMENDATIONS_CACHE_SIZE', 100000))
+    RECOMMENDATIONS_CACHE_TTL_SECONDS: Optional[float] = float(os.environ.get('RECOMMENDATIONS_CACHE_TTL_SECONDS', 300))
 
 
 config = GlobalConfig()
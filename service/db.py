@@ -1,24 +1,241 @@
-from pymongo import MongoClient
+import uuid
+import threading
+from pymongo import MongoClient, ReplaceOne, DeleteMany, monitoring
+from pymongo.errors import CollectionInvalid
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
+from metrics import metrics, observe_mongo
 from config import config
 
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+        Connection pool events counter
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checked_out": 0,
+            "checked_in": 0,
+            "checkout_failed": 0,
+            "pool_cleared": 0,
+        }
+
+    def increment(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats["connections_open"] = stats["connections_created"] - stats["connections_closed"]
+        stats["connections_in_use"] = stats["checked_out"] - stats["checked_in"]
+        stats["max_pool_size"] = config.MONGO_MAX_POOL_SIZE
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.increment("pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.increment("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.increment("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.increment("checkout_failed")
+
+    def connection_checked_out(self, event):
+        self.increment("checked_out")
+
+    def connection_checked_in(self, event):
+        self.increment("checked_in")
+
+
+class CommandStatsListener(monitoring.CommandListener):
+    """
+        Mongo commands counter: every command is one round trip to server
+    """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe_mongo_command(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        metrics.observe_mongo_command(event.command_name, event.duration_micros / 1e6, failed=True)
+
+
+# helpers.get_film_features_record читает не больше staff[:10]
+FILM_STAFF_SLICE = 10
+
+# Проекции документов, которые читает сервис: только используемые поля, длинный staff обрезается $slice.
+# Методы чтения KMongoDb принимают имя проекции вместо select_query
+PROJECTIONS = {
+    # Фильм -> признаки для ml_film_features и inverted index: persons нужны все, но только personId и proffession
+    "film_features": {
+        "nameRu":1, "nameOriginal":1, "genres":1, "countries":1,
+        "staff.personId":1, "staff.proffession":1,
+    },
+    # Фильм -> признаки для профилей и скоринга кандидатов, без inverted index
+    "film_scoring": {
+        "nameRu":1, "nameOriginal":1, "genres":1, "countries":1,
+        "staff": {"$slice": FILM_STAFF_SLICE},
+    },
+    # Признаки из ml_film_features для профилей и скоринга кандидатов
+    "features_scoring": {"persons":0, "contentHash":0},
+    # Рейтинги для ТОПа фильмов
+    "film_top": {
+        "rating":1, "ratingFilmCritics":1, "ratingGoodReview":1, "ratingImdb":1, "ratingKinopoisk":1,
+        "genres":1, "countries":1,
+    },
+}
+
+# Документы без декодирования: поля декодируются при первом обращении
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def get_projection(select_query):
+    """
+        Projection by name from PROJECTIONS, other select queries are returned as is
+    """
+    return PROJECTIONS[select_query] if isinstance(select_query, str) else select_query
+
+
+# Один клиент (и пул соединений) на весь процесс
+pool_stats = PoolStatsListener()
+command_stats = CommandStatsListener()
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+        Get process-wide MongoClient, create it on first call
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MongoClient(
+                config.MONGO_CONNECTION_URI,
+                maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+                minPoolSize=config.MONGO_MIN_POOL_SIZE,
+                connectTimeoutMS=config.MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=config.MONGO_SOCKET_TIMEOUT_MS or None,
+                waitQueueTimeoutMS=config.MONGO_WAIT_QUEUE_TIMEOUT_MS or None,
+                event_listeners=[pool_stats, command_stats]
+            )
+    return _client
+
+
+def close_client():
+    """
+        Close process-wide MongoClient
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def get_pool_stats():
+    return pool_stats.get_stats()
+
+
+def chunked(records, chunk_size):
+    """
+        Split iterable of records into lists of chunk_size records
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def get_index_key(key):
+    """
+        Index keys [(field, direction)] as hashable tuple, server may return directions as floats
+    """
+    return tuple((field, int(direction) if isinstance(direction, float) else direction) for field, direction in key)
+
+
 class KMongoDb:
     """
-        MongoDB class
+        MongoDB class.
+        Calls and documents are counted by methods, which go to Mongo;
+        iter_chunks & get_records_by_ids are counted as iter_records & get_records
     """
-    def __init__(self, database):
-        self.client = MongoClient(config.MONGO_CONNECTION_URI)
+    def __init__(self, database, client=None):
+        self.client = client if client is not None else get_client()
         self.database = self.client[database]
 
 
+    @observe_mongo(None)
     def create_collection(self, collection):
         """
             Create collection if not exists
         """
         if collection not in self.database.list_collection_names():
-            self.database[collection]
+            try:
+                self.database.create_collection(collection)
+            except CollectionInvalid:
+                # Коллекцию успел создать другой процесс
+                pass
+
+
+    @observe_mongo(None)
+    def ensure_indexes(self, collection, indexes):
+        """
+            Create collection & indexes (IndexModel), which it doesn't have yet.
+            Indexes are compared by keys, so index with the same keys and another name is not recreated.
+            Names of created indexes
+        """
+        self.create_collection(collection)
+        existing_keys = {get_index_key(info["key"]) for info in self.database[collection].index_information().values()}
+        missing_indexes = [index for index in indexes if get_index_key(index.document["key"].items()) not in existing_keys]
+
+        if missing_indexes:
+            self.database[collection].create_indexes(missing_indexes)
+        return [index.document["name"] for index in missing_indexes]
+
+
+    @observe_mongo(None)
+    def explain(self, collection, find_query={}, sort=None):
+        """
+            Winning plan of find query
+        """
+        records = self.database[collection].find(find_query)
+        if sort:
+            records = records.sort(sort)
+
+        return records.explain()["queryPlanner"]["winningPlan"]
 
 
+    @observe_mongo()
     def get_one_record(self, collection, find_query={}, select_query=None):
+        select_query = get_projection(select_query)
         if select_query:
             record = self.database[collection].find_one(find_query, select_query)
         else:
@@ -27,10 +244,12 @@ class KMongoDb:
         return record
 
 
-    def get_records(self, collection, find_query={}, select_query=None, limit=10**6):
+    @observe_mongo()
+    def get_records(self, collection, find_query={}, select_query=None, limit=0):
         """
-            Get records from collection by queries params
+            Get records from collection by queries params, limit=0 means no limit
         """
+        select_query = get_projection(select_query)
         if select_query:
             records = self.database[collection].find(find_query, select_query).limit(limit)
         else:
@@ -39,14 +258,65 @@ class KMongoDb:
         return list(records)
 
 
+    @observe_mongo()
+    def iter_records(self, collection, find_query={}, select_query=None, sort=None, batch_size=config.MONGO_BATCH_SIZE, limit=0, raw=False):
+        """
+            Stream records from collection, cursor fetches batch_size records per round trip, limit=0 means no limit.
+            raw=True - RawBSONDocument records for hot scans, which read only some fields
+        """
+        mongo_collection = self.database[collection]
+        if raw:
+            mongo_collection = mongo_collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+
+        records = mongo_collection.find(find_query, get_projection(select_query), batch_size=batch_size, limit=limit)
+        if sort:
+            records = records.sort(sort)
+
+        for record in records:
+            yield record
+
+
+    def iter_chunks(self, collection, find_query={}, select_query=None, sort=None, chunk_size=config.MONGO_BATCH_SIZE, raw=False):
+        """
+            Stream records from collection as lists of chunk_size records
+        """
+        records = self.iter_records(collection, find_query, select_query, sort=sort, batch_size=chunk_size, raw=raw)
+        yield from chunked(records, chunk_size)
+
+
+    def get_records_by_ids(self, collection, ids, select_query=None, chunk_size=1000):
+        """
+            Get records by _id list with chunked $in queries
+        """
+        ids = list(ids)
+        records = []
+
+        for i in range(0, len(ids), chunk_size):
+            find_query = {"_id": {"$in": ids[i:i+chunk_size]}}
+            records.extend(self.get_records(collection, find_query=find_query, select_query=select_query))
+
+        return records
+
+
+    @observe_mongo(None)
     def count_records(self, collection, find_query={}):
         """
-            Count records from collection by query
+            Count records from collection by query, without query - from collection metadata
         """
-        number_of_records = self.database[collection].count(find_query)
-        return number_of_records
+        if not find_query:
+            return self.database[collection].estimated_document_count()
+        return self.database[collection].count_documents(find_query)
+
 
+    @observe_mongo(None)
+    def estimate_records(self, collection):
+        """
+            Fast count of records from collection metadata
+        """
+        return self.database[collection].estimated_document_count()
 
+
+    @observe_mongo()
     def get_sorted_limited_records(self, 
             collection,
             sort_field,
@@ -58,7 +328,8 @@ class KMongoDb:
             Get sorted values from collection by query & limit results
         """
 
-        ascending = 1 if True else -1
+        ascending = 1 if ascending else -1
+        select_query = get_projection(select_query)
 
         if select_query:
             records = self.database[collection].find(find_query, select_query).sort(sort_field, ascending).limit(limit)
@@ -68,6 +339,7 @@ class KMongoDb:
         return list(records)
 
 
+    @observe_mongo('record')
     def insert_one_record(self, collection, record, delete_record=False, delete_query={}):
         """
             Insert records with\without old records deletion
@@ -78,6 +350,7 @@ class KMongoDb:
         self.database[collection].insert_one(record)
 
 
+    @observe_mongo('records')
     def insert_records(self, collection, records, delete_records=False, delete_query={}):
         """
             Insert records with\without old records deletion
@@ -86,3 +359,124 @@ class KMongoDb:
             self.database[collection].delete_many(delete_query)
 
         self.database[collection].insert_many(records)
+
+
+    @observe_mongo()
+    def replace_collection(self, collection, batches, indexes=None):
+        """
+            Atomically replace collection content.
+            Batches of records are inserted into staging collection, indexes are built there
+            and then staging collection is renamed to collection with dropTarget.
+            Readers see old records until rename, on error old records stay untouched
+        """
+        staging_collection = f'{collection}_staging_{uuid.uuid4().hex[:8]}'
+        self.database.create_collection(staging_collection)
+
+        try:
+            number_of_records = 0
+            for records in batches:
+                if records:
+                    self.database[staging_collection].insert_many(records, ordered=False)
+                    number_of_records += len(records)
+
+            if indexes:
+                self.database[staging_collection].create_indexes(indexes)
+
+            self.database[staging_collection].rename(collection, dropTarget=True)
+        except Exception:
+            self.database.drop_collection(staging_collection)
+            raise
+
+        return number_of_records
+
+
+    @observe_mongo(None)
+    def aggregate_into_collections(self, source_collection, pipeline, collections):
+        """
+            Replace content of several collections with result of one aggregation pipeline over source_collection.
+            collections - {collection: indexes}, every record of pipeline has "collection" field with its target.
+            Pipeline is executed on server once and $merge-d into one staging collection, its records are split
+            into staging collections of targets, which are swapped in like in replace_collection,
+            so records don't cross the wire. Returns {collection: number of records}
+        """
+        suffix = uuid.uuid4().hex[:8]
+        split_collection = f'{source_collection}_split_{suffix}'
+        staging_collections = {collection: f'{collection}_staging_{suffix}' for collection in collections}
+        self.database.create_collection(split_collection)
+
+        try:
+            merge = {"$merge": {"into": split_collection, "whenMatched": "replace", "whenNotMatched": "insert"}}
+            self.database[source_collection].aggregate(pipeline + [merge], allowDiskUse=True)
+
+            numbers_of_records = {}
+            for collection, staging_collection in staging_collections.items():
+                self.database.create_collection(staging_collection)
+                self.database[split_collection].aggregate([
+                    {"$match": {"collection": collection}},
+                    {"$unset": "collection"},
+                    {"$merge": {"into": staging_collection, "whenMatched": "replace", "whenNotMatched": "insert"}},
+                ], allowDiskUse=True)
+                numbers_of_records[collection] = self.database[staging_collection].estimated_document_count()
+
+                if collections[collection]:
+                    self.database[staging_collection].create_indexes(collections[collection])
+
+            for collection, staging_collection in staging_collections.items():
+                self.database[staging_collection].rename(collection, dropTarget=True)
+        except Exception:
+            for staging_collection in staging_collections.values():
+                self.database.drop_collection(staging_collection)
+            raise
+        finally:
+            self.database.drop_collection(split_collection)
+
+        return numbers_of_records
+
+
+    @observe_mongo('record')
+    def replace_one_record(self, collection, find_query, record):
+        """
+            Replace one record found by query, insert if not found
+        """
+        self.database[collection].replace_one(find_query, record, upsert=True)
+
+
+    @observe_mongo('records')
+    def replace_records(self, collection, delete_query, records, key_fields):
+        """
+            Replace records matched by delete_query with new records in one ordered bulk_write:
+            records are upserted by key_fields, other matched records are deleted
+        """
+        keys = [{field: record.get(field) for field in key_fields} for record in records]
+        requests = [DeleteMany({"$and": [delete_query, {"$nor": keys}]})] if keys else [DeleteMany(delete_query)]
+        requests += [ReplaceOne(key, record, upsert=True) for key, record in zip(keys, records)]
+        self.database[collection].bulk_write(requests, ordered=True)
+
+
+    @observe_mongo(None)
+    def delete_records(self, collection, find_query):
+        """
+            Delete records by query
+        """
+        self.database[collection].delete_many(find_query)
+
+
+    @observe_mongo(None)
+    def update_one_record(self, collection, find_query, update_query, upsert=False):
+        """
+            Update one record by query
+        """
+        self.database[collection].update_one(find_query, update_query, upsert=upsert)
+
+
+    @observe_mongo('records')
+    def upsert_records(self, collection, records, key_fields):
+        """
+            Replace records matched by key_fields, insert missing ones
+        """
+        requests = [
+            ReplaceOne({field: record.get(field) for field in key_fields}, record, upsert=True)
+            for record in records
+        ]
+        if requests:
+            self.database[collection].bulk_write(requests, ordered=False)
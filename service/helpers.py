@@ -1,6 +1,67 @@
 import re
+import zlib
+import bisect
+import hashlib
+import bson
 from collections import Counter
 from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from config import config
+
+# Версия формата профиля: 2 - texts как {слово: количество}, watchedFilms без дублей и отсортированы,
+# словари признаков ограничены PROFILE_MAX_FEATURES
+PROFILE_VERSION = 2
+PROFILE_FEATURES = ["genres", "countries", "directors", "actors", "texts"]
+
+# Версия формата признаков в ml_film_features, поля фильма для признаков - db.PROJECTIONS["film_features"]
+FILM_FEATURES_VERSION = 1
+
+# Регулярки для clear_text компилируем один раз
+NOT_WORD_PATTERN = re.compile(r"[^а-яa-zё0-9]", flags=re.IGNORECASE)
+SPACES_PATTERN = re.compile(r'\s+')
+
+
+def get_film_content_hash(film):
+    # Hash of film read with "film_features" projection -> features are recalculated only for changed films.
+    # RawBSONDocument is hashed as is, without decoding
+    content = film.raw if isinstance(film, RawBSONDocument) else bson.encode(film)
+    return hashlib.md5(content + b'featuresVersion:%d' % FILM_FEATURES_VERSION).hexdigest()
+
+
+# Байты BSON документа после int32 длины, если первое поле - _id типа ObjectId: тип 0x07, имя "_id\0"
+RAW_OBJECTID_PREFIX = b'\x07_id\x00'
+
+
+def get_raw_document_id(document):
+    # _id of RawBSONDocument from its bytes. Any item access of RawBSONDocument decodes the whole document,
+    # Mongo returns _id as the first field, so it is read without decoding. Other documents are indexed as usual
+    if isinstance(document, RawBSONDocument) and document.raw[4:9] == RAW_OBJECTID_PREFIX:
+        return ObjectId(document.raw[9:21])
+    return document["_id"]
+
+
+def get_film_features_record(film, content_hash=None):
+    """
+        Film features, which are used by profiles, scoring and inverted index.
+        Film with already calculated features (record of ml_film_features) is returned as is
+    """
+    if film.get("featuresVersion") == FILM_FEATURES_VERSION:
+        return film
+
+    staff = film.get("staff") or []
+    return {
+        "_id": film.get("_id"),
+        "contentHash": content_hash or get_film_content_hash(film),
+        "featuresVersion": FILM_FEATURES_VERSION,
+        "genres": film.get("genres") or [],
+        "countries": film.get("countries") or [],
+        # Не могут бы ключи типа ObjectId, поэтому приводим к строке
+        "directors": [str(person["personId"]) for person in staff[:1] if person["proffession"]=="DIRECTOR"],
+        "actors": [str(person["personId"]) for person in staff[:10] if person["proffession"]=="ACTOR"],
+        "profileActors": [str(person["personId"]) for person in staff[:4] if person["proffession"]=="ACTOR"],
+        "persons": list(dict.fromkeys(str(person["personId"]) for person in staff)),
+        "texts": clear_text(film.get("nameRu", '') + ' ' + film.get("nameOriginal", '')),
+    }
 
 
 def update_user_profile(profile, film, like):
@@ -9,63 +70,203 @@ def update_user_profile(profile, film, like):
     prf_countries = profile.get("countries", {})
     prf_director = profile.get("directors", {})
     prf_actors = profile.get("actors", {})
-    prf_texts = profile.get("texts", [])
+    prf_texts = profile.get("texts", {})
 
     # Ger film features
-    film_genres = {genre:1 for genre in film.get("genres", [])[:3]}
-    film_countries = {country:1 for country in film.get("countries", [])[:2]}
-
-    # Не могут бы ключи типа ObjectId, поэтому приводим к строке
-    film_director = {str(person["personId"]): 1 for person in film.get("staff", [])[:1] if person["proffession"]=="DIRECTOR"}
-    film_actors = {str(person["personId"]): 1 for person in film.get("staff", [])[:4] if person["proffession"]=="ACTOR"}
-    film_text = clear_text(film.get("nameRu", '') + ' ' + film.get("nameOriginal", ''))
+    features = get_film_features_record(film)
+    film_genres = dict.fromkeys(features["genres"][:3], 1)
+    film_countries = dict.fromkeys(features["countries"][:2], 1)
+    film_director = dict.fromkeys(features["directors"], 1)
+    film_actors = dict.fromkeys(features["profileActors"], 1)
+    film_text = features["texts"]
 
     # Union film & profile
-    new_genres = dict(Counter(prf_genres) + Counter(film_genres))
-    new_countries = dict(Counter(prf_countries) + Counter(film_countries))
-    new_director = dict(Counter(prf_director) + Counter(film_director))
-    new_actors = dict(Counter(prf_actors) + Counter(film_actors))
-    new_texts = prf_texts + film_text
+    # Счётчики обновляем на месте, порядок ключей тот же, что и при сложении Counter
+    new_genres = add_features(prf_genres, film_genres)
+    new_countries = add_features(prf_countries, film_countries)
+    new_director = add_features(prf_director, film_director)
+    new_actors = add_features(prf_actors, film_actors)
+    new_texts = add_features(prf_texts, film_text)
 
     # Update profile
     profile['userId'] = like.get("userId")
     profile['anonymousId'] = like.get("anonymousId")
-    profile['genres'] = new_genres
-    profile['countries'] = new_countries
-    profile['directors'] = new_director
-    profile['actors'] = new_actors
-    profile['texts'] = new_texts
+    profile['genres'] = prune_features(new_genres)
+    profile['countries'] = prune_features(new_countries)
+    profile['directors'] = prune_features(new_director)
+    profile['actors'] = prune_features(new_actors)
+    profile['texts'] = prune_features(new_texts)
 
     return profile
 
 
+def add_features(profile_features, film_features):
+    for feature in film_features:
+        profile_features[feature] = profile_features.get(feature, 0) + 1
+    return profile_features
+
+
+def prune_features(features, max_features=None):
+    """
+        Keep max_features most frequent features, ties are kept in order of insertion
+        like in get_profile_top_features. Features are pruned, when there are twice more of them,
+        so new features have time to get weight
+    """
+    max_features = config.PROFILE_MAX_FEATURES if max_features is None else max_features
+    if not max_features or len(features) <= 2 * max_features:
+        return features
+
+    top_features = sorted(features.items(), key=lambda x: x[1], reverse=True)[:max_features]
+    top_features = {feature for feature, _ in top_features}
+    return {feature: weight for feature, weight in features.items() if feature in top_features}
+
+
 def update_watched_films(profile, like):
-    profile['watchedFilms'] = profile.get('watchedFilms', []) + [like.get('filmId')]
+    # watchedFilms отсортированы: повторный лайк того же фильма не добавляет дубль
+    watched_films = profile.setdefault('watchedFilms', [])
+    filmid = like.get('filmId')
+    if filmid is None:
+        return profile
+
+    position = bisect.bisect_left(watched_films, filmid)
+    if position == len(watched_films) or watched_films[position] != filmid:
+        watched_films.insert(position, filmid)
     return profile
 
 
+def migrate_user_profile(profile):
+    """
+        Convert profile of old format: texts list -> token counts, watchedFilms -> sorted unique ids,
+        prune feature weights. Profiles of current version are returned as is
+    """
+    if profile is None or profile.get("profileVersion") == PROFILE_VERSION:
+        return profile
+
+    if isinstance(profile.get("texts"), list):
+        profile["texts"] = dict(Counter(profile["texts"]))
+    for feature in PROFILE_FEATURES:
+        if feature in profile:
+            profile[feature] = prune_features(profile[feature])
+
+    if "watchedFilms" in profile:
+        profile["watchedFilms"] = sorted(set(filmid for filmid in profile["watchedFilms"] if filmid is not None))
+    profile["profileVersion"] = PROFILE_VERSION
+    return profile
+
+
+def get_user_key(record):
+    # Потому что юзеры и анонимы в разных таблицах и у них могу попасться одинаковые айдишники
+    userid = record.get("userId")
+    anonymousid = record.get("anonymousId")
+    return str(userid) if userid is not None else 'ANON_' + str(anonymousid)
+
+
+def get_user_shard(user_key, number_of_shards):
+    # Stable hash: the same user goes to the same shard in every process
+    return zlib.crc32(user_key.encode()) % number_of_shards
+
+
+def fold_user_like(profile, like, films):
+    # Liked film -> update profile features
+    if like["state"] == "LIKE":
+        film = films.get(like.get("filmId"))
+        if film is not None:
+            profile = update_user_profile(profile, film, like)
+
+    # Update watched films
+    profile = update_watched_films(profile, like)
+    profile['profileVersion'] = PROFILE_VERSION
+
+    # updatedAt последнего учтённого лайка: по нему повторно пришедшие лайки не складываются второй раз
+    updated_at = like.get("updatedAt")
+    if updated_at is not None and (profile.get("likesUpdatedAt") is None or updated_at > profile["likesUpdatedAt"]):
+        profile["likesUpdatedAt"] = updated_at
+    return profile
+
+
+def is_folded_like(like, folded_at):
+    # folded_at - likesUpdatedAt сохранённого профиля, лайки не новее него уже в профиле
+    updated_at = like.get("updatedAt")
+    return folded_at is not None and updated_at is not None and updated_at <= folded_at
+
+
+def build_user_profiles(user_likes, films, users_profiles=None, folded_at=None):
+    # films - {filmId: film}, already fetched for all liked films
+    # folded_at - {user_key: likesUpdatedAt} of stored profiles, their older likes are skipped
+    users_profiles = {} if users_profiles is None else users_profiles
+    folded_at = {} if folded_at is None else folded_at
+
+    for like in user_likes:
+        useruniqid = get_user_key(like)
+        if is_folded_like(like, folded_at.get(useruniqid)):
+            continue
+        # Ids are set explicitly: profile of user with dislikes only must be found by ids too
+        user_profile = users_profiles.get(useruniqid) or {"userId": like.get("userId"), "anonymousId": like.get("anonymousId")}
+        users_profiles[useruniqid] = fold_user_like(user_profile, like, films)
+
+    return users_profiles
+
+
+# Профили и фильмы шарда в процессе воркера ProfileShards: живут между чанками лайков,
+# профили в main процесс отдаются один раз
+_shard_profiles = {}
+_shard_folded_at = {}
+_shard_films = {}
+
+
+def init_profiles_shard():
+    _shard_profiles.clear()
+    _shard_folded_at.clear()
+    _shard_films.clear()
+
+
+def fold_profiles_shard(user_likes, films, users_profiles, folded_at):
+    # films - films, which are not sent to the shard yet
+    # users_profiles, folded_at - stored profiles of users, which came to the shard the first time
+    _shard_films.update(films)
+    _shard_profiles.update(users_profiles)
+    _shard_folded_at.update(folded_at)
+    build_user_profiles(user_likes, _shard_films, _shard_profiles, _shard_folded_at)
+    return len(_shard_profiles)
+
+
+def collect_profiles_shard():
+    return _shard_profiles
+
+
+def get_liked_film_ids(user_likes):
+    return [like.get("filmId") for like in user_likes if like["state"] == "LIKE"]
+
+
 def clear_text(text):
+    # \xa0 заменяется вместе с остальными символами, которые не буквы и не цифры
     text = text.strip()    
-    text = re.sub(r"[^а-яa-zё0-9]", ' ', text, flags=re.IGNORECASE)
-    text = re.sub(r'\s+', ' ', text)
-    text = re.sub('\xa0', ' ', text)
+    text = NOT_WORD_PATTERN.sub(' ', text)
+    text = SPACES_PATTERN.sub(' ', text)
     text = text.lower()
     text = [word for word in text.split(' ') if len(word)>3]
     return text
 
 
-def get_filter(user_profile):
-    # Get filters for Mongo
+def get_profile_top_features(user_profile):
+    # Most frequent profile features -> used to search candidate films
     genres = sorted(user_profile.get("genres", {}).items(), key=lambda x: x[1], reverse=True)[:5]
     countries = sorted(user_profile.get("countries", {}).items(), key=lambda x: x[1], reverse=True)[:5]
     directors = sorted(user_profile.get("directors", {}).items(), key=lambda x: x[1], reverse=True)[:10]
     actors = sorted(user_profile.get("actors", {}).items(), key=lambda x: x[1], reverse=True)[:10]
-    
-    # Get
+
     genres = [genre[0] for genre in genres]
     countries = [country[0] for country in countries]
-    directors = [ObjectId(director[0]) for director in directors]
-    actors = [ObjectId(actor[0]) for actor in actors]
+    directors = [director[0] for director in directors]
+    actors = [actor[0] for actor in actors]
+    return genres, countries, directors, actors
+
+
+def get_filter(user_profile):
+    # Get filters for Mongo
+    genres, countries, directors, actors = get_profile_top_features(user_profile)
+    directors = [ObjectId(director) for director in directors]
+    actors = [ObjectId(actor) for actor in actors]
 
     # Make find query
     find_query = {
@@ -81,13 +282,12 @@ def get_filter(user_profile):
 
 def get_film_similarity(film, user_profile):
     # Film
-    film_genres = {genre:1 for genre in film.get("genres", [])[:3]}
-    film_countries = {country:1 for country in film.get("countries", [])[:2]}
-
-    # Не могут бы ключи типа ObjectId, поэтому приводим к строке
-    film_directors = {str(person["personId"]): 1 for person in film.get("staff", [])[:1] if person["proffession"]=="DIRECTOR"}
-    film_actors = {str(person["personId"]): 1 for person in film.get("staff", [])[:10] if person["proffession"]=="ACTOR"}
-    film_text = clear_text(film.get("nameRu", '') + ' ' + film.get("nameOriginal", ''))
+    features = get_film_features_record(film)
+    film_genres = dict.fromkeys(features["genres"][:3], 1)
+    film_countries = dict.fromkeys(features["countries"][:2], 1)
+    film_directors = dict.fromkeys(features["directors"], 1)
+    film_actors = dict.fromkeys(features["actors"], 1)
+    film_text = features["texts"]
 
     # User
     user_genres = user_profile.get("genres")
@@ -0,0 +1,158 @@
+"""
+    Indexes of service collections and check of query plans.
+
+    INDEXES is applied at API & worker startup (MONGO_ENSURE_INDEXES), only missing indexes are created.
+    Collections, which are rebuilt with replace_collection, get the same indexes on staging collection.
+
+    python indexes.py          - create missing indexes
+    python indexes.py --check  - explain query shapes of service, exit code 1 if some of them is COLLSCAN
+"""
+import sys
+import logging
+import argparse
+import datetime
+from bson import ObjectId
+from pymongo import IndexModel
+from helpers import get_filter
+from db import KMongoDb, get_client, close_client
+from config import config
+
+# Logger
+logging.getLogger(__name__)
+
+
+INDEXES = {
+    config.MONGO_FILMS_TABLE: [
+        IndexModel([("genres", 1)]),
+        IndexModel([("countries", 1)]),
+        IndexModel([("staff.personId", 1)]),
+    ],
+    config.MONGO_FILMS_LIKES_TABLE: [
+        IndexModel([("userId", 1), ("updatedAt", -1)]),
+        IndexModel([("anonymousId", 1), ("updatedAt", -1)]),
+        IndexModel([("updatedAt", 1), ("_id", 1)]),
+    ],
+    config.MONGO_USER_PROFILES: [
+        IndexModel([("userId", 1)]),
+        IndexModel([("anonymousId", 1)]),
+    ],
+    config.MONGO_USER_RECOMS_TABLE: [
+        IndexModel([("userId", 1), ("rank", 1)]),
+        IndexModel([("anonymousId", 1), ("rank", 1)]),
+    ],
+    config.MONGO_FILM_RECOMS_TABLE: [
+        IndexModel([("filmId", 1)], unique=True),
+    ],
+    config.MONGO_FILMS_TOP_TABLE: [
+        IndexModel([("meanRating", -1)]),
+        IndexModel([("filmId", 1)]),
+    ],
+    config.MONGO_FILMS_TOP_SEGMENTS_TABLE: [
+        IndexModel([("segment", 1), ("value", 1)]),
+    ],
+}
+
+
+def get_query_shapes():
+    """
+        Queries of service as (name, collection, find_query, sort) with sample values.
+        Full scans by design (all likes for co-likes, profiles migration) are not here
+    """
+    userid, filmid, personid = ObjectId(), ObjectId(), ObjectId()
+    updated_at = datetime.datetime.utcnow()
+    user_query = {"$or": [{"userId": userid}, {"anonymousId": userid}]}
+    users_query = {"$or": [{"userId": {"$in": [userid]}}, {"anonymousId": {"$in": [userid]}}]}
+    profile = {
+        "genres": {"драма": 1},
+        "countries": {"США": 1},
+        "directors": {str(personid): 1},
+        "actors": {str(personid): 1},
+        "watchedFilms": [filmid],
+    }
+
+    return [
+        ("user likes", config.MONGO_FILMS_LIKES_TABLE, user_query, [("updatedAt", -1)]),
+        ("block likes", config.MONGO_FILMS_LIKES_TABLE, users_query, [("updatedAt", -1)]),
+        ("neighbour source likes", config.MONGO_FILMS_LIKES_TABLE, {"userId": userid, "state": "LIKE"}, [("updatedAt", -1)]),
+        ("anonymous neighbour source likes", config.MONGO_FILMS_LIKES_TABLE, {"anonymousId": userid, "state": "LIKE"}, [("updatedAt", -1)]),
+        ("likes after watermark", config.MONGO_FILMS_LIKES_TABLE, {"updatedAt": {"$gt": updated_at}}, [("updatedAt", 1)]),
+        ("tailer likes", config.MONGO_FILMS_LIKES_TABLE,
+            {"$or": [{"updatedAt": {"$gt": updated_at}}, {"updatedAt": updated_at, "_id": {"$gt": filmid}}]},
+            [("updatedAt", 1), ("_id", 1)]),
+        ("user profile", config.MONGO_USER_PROFILES, user_query, None),
+        ("block profiles", config.MONGO_USER_PROFILES, users_query, None),
+        ("incremental profiles", config.MONGO_USER_PROFILES,
+            {"$or": [{"userId": {"$in": [userid]}}, {"userId": None, "anonymousId": {"$in": [userid]}}]}, None),
+        ("user recommendations", config.MONGO_USER_RECOMS_TABLE, user_query, [("rank", 1)]),
+        ("candidate films", config.MONGO_FILMS_TABLE, get_filter(profile), None),
+        ("films by ids", config.MONGO_FILMS_TABLE, {"_id": {"$in": [filmid]}}, None),
+        ("film features by ids", config.MONGO_FILM_FEATURES_TABLE, {"_id": {"$in": [filmid]}}, None),
+        ("film neighbours", config.MONGO_FILM_RECOMS_TABLE, {"filmId": {"$in": [filmid]}}, None),
+        ("top films", config.MONGO_FILMS_TOP_TABLE, {}, [("meanRating", -1)]),
+    ]
+
+
+def ensure_indexes(mongo_db, indexes=INDEXES):
+    """
+        Create missing indexes of INDEXES, safe to call on every start
+    """
+    for collection, collection_indexes in indexes.items():
+        created_indexes = mongo_db.ensure_indexes(collection, collection_indexes)
+        if created_indexes:
+            logging.info(f'Indexes of {collection} created: {", ".join(created_indexes)}')
+
+
+def get_plan_stages(plan):
+    """
+        Names of all stages of explain() plan tree
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(get_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(get_plan_stages(value))
+    return stages
+
+
+def check_query_plans(mongo_db):
+    """
+        Explain every query shape, [(name, collection, stages)] of shapes, which fall back to COLLSCAN
+    """
+    failed_shapes = []
+    for name, collection, find_query, sort in get_query_shapes():
+        stages = get_plan_stages(mongo_db.explain(collection, find_query, sort))
+        logging.info(f'{name} ({collection}): {" <- ".join(stages)}')
+        if "COLLSCAN" in stages:
+            failed_shapes.append((name, collection, stages))
+
+    return failed_shapes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create indexes of service collections or check query plans')
+    parser.add_argument('--check', action='store_true', help='fail if some query of service is COLLSCAN')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s: %(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    get_client()
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
+    try:
+        if not args.check:
+            ensure_indexes(mongo_db)
+            return 0
+
+        failed_shapes = check_query_plans(mongo_db)
+        for name, collection, stages in failed_shapes:
+            logging.error(f'COLLSCAN: {name} ({collection})')
+        return 1 if failed_shapes else 0
+    finally:
+        close_client()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
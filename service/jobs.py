@@ -0,0 +1,188 @@
+import time
+import uuid
+import logging
+import threading
+import traceback
+import contextvars
+from contextlib import ExitStack
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics import request_timings
+from snapshots import MODEL_SNAPSHOT
+from config import config
+
+# Logger
+logging.getLogger(__name__)
+
+# Job, который выполняется в текущем потоке -> нужен для set_progress
+_current = threading.local()
+
+# Коллекции (и снапшоты), которые пишет задача. Задачи с общей коллекцией выполняются по очереди,
+# остальные - параллельно. Задача без записи здесь блокирует только задачи со своим именем
+JOB_TARGETS = {
+    'top_films': [config.MONGO_FILMS_TOP_TABLE, config.MONGO_FILMS_TOP_SEGMENTS_TABLE],
+    'film_features': [config.MONGO_FILM_FEATURES_TABLE, f'snapshot:{MODEL_SNAPSHOT}'],
+    'film_recommendations': [config.MONGO_FILM_RECOMS_TABLE],
+    'model_snapshot': [f'snapshot:{MODEL_SNAPSHOT}'],
+    'user_recommendations': [config.MONGO_USER_PROFILES, config.MONGO_SERVICE_STATE_TABLE],
+    'migrate_user_profiles': [config.MONGO_USER_PROFILES],
+}
+
+
+class Job:
+    """
+        Long-running calculation, executed by JobManager
+    """
+    def __init__(self, name, kwargs):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.stage = None
+        self.progress = 0.0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.future = None
+
+
+    def to_dict(self):
+        return {
+            'jobId': self.id,
+            'name': self.name,
+            'params': self.kwargs,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': round(self.progress, 4),
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """
+        Runs jobs on a bounded thread pool.
+
+        Submission of a job, which is already queued or running with the same params,
+        returns existing job. Jobs, which write the same collections (targets), run one by one:
+        a job waits for locks of all its targets, taken in sorted order. While waiting it holds
+        a worker thread of the pool.
+    """
+    def __init__(self, max_workers, max_finished_jobs=100, targets=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_finished_jobs = max_finished_jobs
+        self.targets = JOB_TARGETS if targets is None else targets
+        self.jobs = OrderedDict()
+        self.active_jobs = {}
+        self.target_locks = {}
+        self.lock = threading.Lock()
+
+
+    def submit(self, name, function, **kwargs):
+        """
+            Submit job or get already active job with the same name & params
+        """
+        return self.submit_job(name, function, kwargs)
+
+
+    def call(self, name, function, **kwargs):
+        """
+            Submit job and wait for its result. Stage timings of the job go to the HTTP request of caller,
+            if the job is started by this call
+        """
+        return self.submit_job(name, function, kwargs, request_timings.get()).future.result()
+
+
+    def submit_job(self, name, function, kwargs, timings=None):
+        key = (name, tuple(sorted(kwargs.items())))
+
+        with self.lock:
+            job = self.active_jobs.get(key)
+            if job is not None:
+                logging.info(f'Job {name} {kwargs} is already {job.status}: {job.id}')
+                return job
+
+            job = Job(name, kwargs)
+            self.jobs[job.id] = job
+            self.active_jobs[key] = job
+            for target in self.get_targets(name):
+                self.target_locks.setdefault(target, threading.Lock())
+            self.remove_finished_jobs()
+
+            # Задача выполняется в пустом контексте: асинхронная задача переживает запрос, который её запустил,
+            # и не должна писать в его тайминги. Тайминги передаются, только если вызывающий ждёт результат
+            job.future = self.executor.submit(contextvars.Context().run, self.run, job, key, function, timings)
+
+        logging.info(f'Job {name} {kwargs} submitted: {job.id}')
+        return job
+
+
+    def run(self, job, key, function, timings=None):
+        _current.job = job
+        request_timings.set(timings)
+
+        try:
+            with ExitStack() as stack:
+                for target in self.get_targets(job.name):
+                    stack.enter_context(self.target_locks[target])
+
+                job.status = 'running'
+                job.started_at = time.time()
+                logging.info(f'Job {job.name} started: {job.id}')
+
+                result = function(**job.kwargs)
+
+            job.status = 'done'
+            job.progress = 1.0
+            logging.info(f'Job {job.name} done: {job.id}')
+            return result
+
+        except Exception as err:
+            job.status = 'failed'
+            job.error = f'{str(err)}\n{traceback.format_exc()}'
+            logging.exception(f'Job {job.name} failed: {job.id}')
+            raise
+
+        finally:
+            job.finished_at = time.time()
+            _current.job = None
+            with self.lock:
+                self.active_jobs.pop(key, None)
+
+
+    def get_targets(self, name):
+        return sorted(set(self.targets.get(name, [name])))
+
+
+    def remove_finished_jobs(self):
+        finished_jobs = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished_jobs[:max(0, len(finished_jobs) - self.max_finished_jobs)]:
+            self.jobs.pop(job_id)
+
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+
+    def list(self):
+        return list(self.jobs.values())
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def set_progress(progress, stage=None):
+    """
+        Update progress of the job running in current thread, no-op outside of jobs
+    """
+    job = getattr(_current, 'job', None)
+    if job is not None:
+        job.progress = min(max(progress, 0.0), 1.0)
+        job.stage = stage if stage is not None else job.stage
+
+
+job_manager = JobManager(config.JOBS_MAX_WORKERS)
@@ -0,0 +1,272 @@
+import time
+import inspect
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# Logger
+logging.getLogger(__name__)
+
+# Тайминги этапов текущего HTTP запроса, заполняются stage_timer
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+# Стек вложенных этапов текущего потока
+_local = threading.local()
+
+
+class Metrics:
+    """
+        Process-wide counters: stage timings, KMongoDb calls, Mongo commands, HTTP requests and caches
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.mongo_calls = {}
+        self.mongo_commands = {}
+        self.requests = {}
+        self.caches = {}
+        self.gauges = {}
+
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+        timings = request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+    def observe_mongo_call(self, method, collection, documents, seconds):
+        with self.lock:
+            stats = self.mongo_calls.setdefault((method, collection), [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += documents
+            stats[2] += seconds
+
+
+    def observe_mongo_command(self, command, seconds, failed=False):
+        with self.lock:
+            stats = self.mongo_commands.setdefault(command, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += int(failed)
+            stats[2] += seconds
+
+
+    def observe_request(self, method, endpoint, status_code, seconds):
+        with self.lock:
+            stats = self.requests.setdefault((method, endpoint, str(status_code)), [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+
+    def register_cache(self, name, cache):
+        """
+            Cache with hits & misses counters, they are read on render
+        """
+        self.caches[name] = cache
+
+
+    def register_gauges(self, prefix, function):
+        """
+            function() -> {name: number}, rendered as prefix_name gauges
+        """
+        self.gauges[prefix] = function
+
+
+    def clear(self):
+        with self.lock:
+            self.stages.clear()
+            self.mongo_calls.clear()
+            self.mongo_commands.clear()
+            self.requests.clear()
+
+
+    def render(self):
+        """
+            Metrics in Prometheus text format
+        """
+        with self.lock:
+            stages = {stage: list(stats) for stage, stats in self.stages.items()}
+            mongo_calls = {key: list(stats) for key, stats in self.mongo_calls.items()}
+            mongo_commands = {command: list(stats) for command, stats in self.mongo_commands.items()}
+            requests = {key: list(stats) for key, stats in self.requests.items()}
+
+        lines = []
+        add_metric(lines, 'kinoki_stage_seconds', 'summary', 'Self time of calculation stages',
+                   [({'stage': stage}, stats[1], stats[0]) for stage, stats in stages.items()])
+        add_metric(lines, 'kinoki_stage_seconds_max', 'gauge', 'Max self time of one stage run',
+                   [({'stage': stage}, stats[2]) for stage, stats in stages.items()])
+
+        labels = lambda key: {'method': key[0], 'collection': key[1]}
+        add_metric(lines, 'kinoki_mongo_calls_total', 'counter', 'KMongoDb method calls',
+                   [(labels(key), stats[0]) for key, stats in mongo_calls.items()])
+        add_metric(lines, 'kinoki_mongo_documents_total', 'counter', 'Documents read or written by KMongoDb methods',
+                   [(labels(key), stats[1]) for key, stats in mongo_calls.items()])
+        add_metric(lines, 'kinoki_mongo_call_seconds_total', 'counter', 'Time spent in KMongoDb methods',
+                   [(labels(key), stats[2]) for key, stats in mongo_calls.items()])
+
+        add_metric(lines, 'kinoki_mongo_commands_total', 'counter', 'Mongo commands (round trips)',
+                   [({'command': command}, stats[0]) for command, stats in mongo_commands.items()])
+        add_metric(lines, 'kinoki_mongo_command_failures_total', 'counter', 'Failed Mongo commands',
+                   [({'command': command}, stats[1]) for command, stats in mongo_commands.items()])
+        add_metric(lines, 'kinoki_mongo_command_seconds_total', 'counter', 'Duration of Mongo commands',
+                   [({'command': command}, stats[2]) for command, stats in mongo_commands.items()])
+
+        labels = lambda key: {'method': key[0], 'endpoint': key[1], 'status': key[2]}
+        add_metric(lines, 'kinoki_http_request_seconds', 'summary', 'HTTP requests duration',
+                   [(labels(key), stats[1], stats[0]) for key, stats in requests.items()])
+
+        caches = self.caches.items()
+        add_metric(lines, 'kinoki_cache_hits_total', 'counter', 'Cache hits',
+                   [({'cache': name}, cache.hits) for name, cache in caches])
+        add_metric(lines, 'kinoki_cache_misses_total', 'counter', 'Cache misses',
+                   [({'cache': name}, cache.misses) for name, cache in caches])
+        add_metric(lines, 'kinoki_cache_hit_ratio', 'gauge', 'Cache hits / (hits + misses)',
+                   [({'cache': name}, cache.hits / max(cache.hits + cache.misses, 1)) for name, cache in caches])
+        add_metric(lines, 'kinoki_cache_size', 'gauge', 'Records in cache',
+                   [({'cache': name}, len(cache)) for name, cache in caches])
+
+        for prefix, function in list(self.gauges.items()):
+            add_gauges(lines, prefix, function())
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    labels = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return '{' + labels + '}' if labels else ''
+
+
+def format_value(value):
+    return str(value) if isinstance(value, int) else f'{value:.6f}'
+
+
+def add_metric(lines, name, metric_type, description, samples):
+    """
+        Add metric samples as Prometheus text: (labels, value) or (labels, sum, count) for summary
+    """
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} {metric_type}')
+
+    for sample in samples:
+        labels = format_labels(sample[0])
+        if metric_type == 'summary':
+            lines.append(f'{name}_sum{labels} {format_value(sample[1])}')
+            lines.append(f'{name}_count{labels} {format_value(sample[2])}')
+        else:
+            lines.append(f'{name}{labels} {format_value(sample[1])}')
+
+
+def add_gauges(lines, prefix, values):
+    """
+        Add {name: number} as gauges prefix_name
+    """
+    for name, value in values.items():
+        if isinstance(value, (int, float)):
+            add_metric(lines, f'{prefix}_{name}', 'gauge', name.replace('_', ' '), [({}, value)])
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+        Measure self time of stage: time of nested stages is counted in nested stages only,
+        so stages of one calculation sum up to its total time
+    """
+    stack = _local.__dict__.setdefault('stack', [])
+    frame = [0.0]
+    stack.append(frame)
+    started_at = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started_at
+        stack.pop()
+        if stack:
+            stack[-1][0] += seconds
+        metrics.observe_stage(stage, seconds - frame[0])
+
+
+def timed_iter(stage, records):
+    """
+        Iterate records and measure time of getting them as stage, e.g. reading cursor chunks
+    """
+    iterator = iter(records)
+    while True:
+        with stage_timer(stage):
+            record = next(iterator, StopIteration)
+        if record is StopIteration:
+            return
+        yield record
+
+
+def count_documents(value):
+    if value is None or isinstance(value, bool):
+        return 0
+    if isinstance(value, dict):
+        return 1
+    if isinstance(value, int):
+        return value
+    return len(value) if hasattr(value, '__len__') else 0
+
+
+def observe_mongo(documents='result'):
+    """
+        Count calls, documents and time of KMongoDb method.
+        documents - what to count: 'result' - returned records (or number of records),
+        name of argument - written records, None - count calls only
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, collection, *args, **kwargs):
+            started_at = time.perf_counter()
+            result = method(self, collection, *args, **kwargs)
+            seconds = time.perf_counter() - started_at
+
+            if documents == 'result' and inspect.isgenerator(result):
+                return observe_mongo_records(method.__name__, collection, result, seconds)
+
+            if documents == 'result':
+                number_of_documents = count_documents(result)
+            elif documents is not None:
+                number_of_documents = count_documents(signature.bind(self, collection, *args, **kwargs).arguments.get(documents))
+            else:
+                number_of_documents = 0
+
+            metrics.observe_mongo_call(method.__name__, collection, number_of_documents, seconds)
+            return result
+
+        return wrapper
+    return decorator
+
+
+def observe_mongo_records(method, collection, records, seconds):
+    """
+        Streamed records are counted when cursor is exhausted or closed
+    """
+    number_of_documents = 0
+    try:
+        while True:
+            started_at = time.perf_counter()
+            record = next(records, StopIteration)
+            seconds += time.perf_counter() - started_at
+            if record is StopIteration:
+                return
+            number_of_documents += 1
+            yield record
+    finally:
+        metrics.observe_mongo_call(method, collection, number_of_documents, seconds)
+
+
+metrics = Metrics()
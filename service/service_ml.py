@@ -1,14 +1,29 @@
 import logging
 import traceback
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from config import config
 from calculations_user import *
-from helpers import update_user_profile, update_watched_films
-from helpers import get_film_similarity, get_filter
-from db import KMongoDb
+from helpers import build_user_profiles, fold_user_like, get_liked_film_ids, get_user_key, get_user_shard
+from helpers import init_profiles_shard, fold_profiles_shard, collect_profiles_shard
+from helpers import get_filter, migrate_user_profile, PROFILE_VERSION
+from helpers import get_film_content_hash, get_film_features_record, get_raw_document_id
+from calculations_film import FilmScoringEngine, film_catalog, iter_film_features
+from calculations_film import get_co_likes_matrix, get_similar_films
+from cache import film_cache, recommendations_cache
+from jobs import set_progress
+from metrics import stage_timer, timed_iter
+from snapshots import save_snapshot, get_current_version, MODEL_SNAPSHOT
+from db import KMongoDb, chunked
+from indexes import INDEXES
 
 # Logger
 logging.getLogger(__name__)
 
+# Ключ watermark профилей в коллекции состояния сервиса
+PROFILES_WATERMARK = "user_profiles"
+
 
 def return_request_like_response(function):
     """Decorator to return request-like response"""
@@ -36,185 +51,472 @@ def calculate_top_films():
         на основе рейтингов с разных площадок.
 
         Те фильмы, у которых рейтинг выше DEFAULT_TOP_RATING, кладём в отдельную коллекцию
-        предварительно очистив её от старых записей.
+        предварительно очистив её от старых записей. Заодно считаем ТОПы каждого жанра и страны.
+
+        В режиме TOP_FILMS_MODE=aggregation всё считается в Mongo, фильмы в сервис не читаются.
     """
     # Подключаемся к базе
     mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
 
+    top_indexes = INDEXES[config.MONGO_FILMS_TOP_TABLE]
+    segment_indexes = INDEXES[config.MONGO_FILMS_TOP_SEGMENTS_TABLE]
+
+    if config.TOP_FILMS_MODE == 'aggregation':
+        with stage_timer('write_top_films'):
+            numbers_of_records = mongo_db.aggregate_into_collections(
+                config.MONGO_FILMS_TABLE,
+                get_top_films_pipeline(config.NUMBER_SEGMENT_TOP_FILMS),
+                {config.MONGO_FILMS_TOP_TABLE: top_indexes, config.MONGO_FILMS_TOP_SEGMENTS_TABLE: segment_indexes}
+            )
+        number_of_top_films = numbers_of_records[config.MONGO_FILMS_TOP_TABLE]
+        number_of_segments = numbers_of_records[config.MONGO_FILMS_TOP_SEGMENTS_TABLE]
+        logging.info(f'{number_of_top_films} top films and {number_of_segments} top segments calculated in Mongo')
+
+        recommendations_cache.delete(recommendations_cache.TOP_FILMS_KEY)
+        return
+
     # Получаем фильмы
-    select_query = {
-        "rating":1, "ratingFilmCritics":1, 
-        "ratingGoodReview":1, "ratingImdb":1, "ratingKinopoisk":1, 
-    }
-    films = mongo_db.get_records(config.MONGO_FILMS_TABLE, select_query=select_query)
-    top_films = prepare_top_films(films)
+    # Идём по коллекции чанками, чтобы не держать весь каталог в памяти
+    top_films = []
+    number_of_films = 0
+    total_films = mongo_db.estimate_records(config.MONGO_FILMS_TABLE) or 1
+    for films in timed_iter('fetch_films', mongo_db.iter_chunks(config.MONGO_FILMS_TABLE, select_query="film_top")):
+        with stage_timer('prepare_top_films'):
+            top_films.extend(prepare_top_films(films, segment_keys=TOP_SEGMENTS.values()))
+        number_of_films += len(films)
+        set_progress(0.9 * number_of_films / total_films, 'top films')
     logging.info('Got top films')
 
-    mongo_db.create_collection(config.MONGO_FILMS_TOP_TABLE)
-    logging.info(f'{config.MONGO_FILMS_TOP_TABLE} collection created')
+    with stage_timer('prepare_top_segments'):
+        top_segments = prepare_top_segments(top_films, config.NUMBER_SEGMENT_TOP_FILMS)
 
-    mongo_db.insert_records(config.MONGO_FILMS_TOP_TABLE, top_films, delete_records=True)
-    logging.info(f'{len(top_films)} top films inserted')
+    # Пишем во временную коллекцию и подменяем ею старую одним rename
+    with stage_timer('write_top_films'):
+        records = ({'filmId': film['filmId'], 'meanRating': film['meanRating']} for film in top_films)
+        mongo_db.replace_collection(config.MONGO_FILMS_TOP_TABLE, chunked(records, config.MONGO_BATCH_SIZE), top_indexes)
+        mongo_db.replace_collection(config.MONGO_FILMS_TOP_SEGMENTS_TABLE, chunked(top_segments, config.MONGO_BATCH_SIZE), segment_indexes)
+    logging.info(f'{len(top_films)} top films and {len(top_segments)} top segments inserted')
 
+    recommendations_cache.delete(recommendations_cache.TOP_FILMS_KEY)
 
-# @return_request_like_response
-# def calculate_recommendations_all():
-#     """
-#         Подготавливаем рекомендации для всех пользователей.
-#     """
 
-#     # Подключаемся к базе
-#     mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
+# @return_request_like_response
+def calculate_film_features():
+    """
+        Считаем признаки фильмов (жанры, страны, персоны, слова названия) один раз
+        и складываем в ml_film_features. Пересчитываем только фильмы, у которых поменялся
+        hash фильма в проекции film_features, признаки удалённых фильмов удаляем.
+        Фильмы читаются как RawBSONDocument: hash считается по байтам, _id берётся из байт документа,
+        так что неизменённые фильмы не декодируются (обращение к любому полю декодирует весь документ).
+    """
+    # Подключаемся к базе
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
 
-#     ### ACTIVITY
-#     # Collect users activity
-#     user_likes = mongo_db.get_records(config.MONGO_FILMS_LIKES_TABLE)
-#     df_user_activity = prepare_user_activity(user_likes)
-#     logging.info(f'Got users activity: {len(df_user_activity)}')
+    # Hashes of already calculated features
+    with stage_timer('fetch_film_features'):
+        select_query = {"contentHash":1}
+        hashes = {record["_id"]: record.get("contentHash") for record in mongo_db.iter_records(config.MONGO_FILM_FEATURES_TABLE, select_query=select_query)}
+    logging.info(f'Got features of {len(hashes)} films')
+
+    film_ids = set()
+    number_of_changed = 0
+    total_films = mongo_db.estimate_records(config.MONGO_FILMS_TABLE) or 1
+
+    for films in timed_iter('fetch_films', mongo_db.iter_chunks(config.MONGO_FILMS_TABLE, select_query="film_features", raw=True)):
+        with stage_timer('film_features'):
+            records = []
+            for film in films:
+                filmid = get_raw_document_id(film)
+                film_ids.add(filmid)
+                content_hash = get_film_content_hash(film)
+                if hashes.get(filmid) != content_hash:
+                    records.append(get_film_features_record(film, content_hash))
+
+        if records:
+            with stage_timer('write_film_features'):
+                mongo_db.upsert_records(config.MONGO_FILM_FEATURES_TABLE, records, key_fields=["_id"])
+            for record in records:
+                film_cache.delete(record["_id"])
+            number_of_changed += len(records)
+
+        set_progress(0.9 * len(film_ids) / total_films, 'film features')
+
+    # Features of deleted films
+    deleted_ids = [filmid for filmid in hashes if filmid not in film_ids]
+    with stage_timer('write_film_features'):
+        for chunk in chunked(deleted_ids, config.FILM_QUERY_CHUNK_SIZE):
+            mongo_db.delete_records(config.MONGO_FILM_FEATURES_TABLE, {"_id": {"$in": chunk}})
+    logging.info(f'Film features: {number_of_changed} films updated, {len(deleted_ids)} deleted, {len(film_ids)} films total')
+
+    # Каталог перечитает признаки при следующем обращении, сохранённый снапшот модели устарел - сохраняем новую версию
+    if number_of_changed or deleted_ids:
+        film_catalog.loaded_at = 0
+        if get_current_version(MODEL_SNAPSHOT) is not None:
+            set_progress(0.9, 'model snapshot')
+            save_model_snapshot(mongo_db)
 
-#     # Insert users activity
-#     mongo_db.create_collection(config.MONGO_USER_ACTIVITY_TABLE)
-#     logging.info(f'{config.MONGO_USER_ACTIVITY_TABLE} collection created')
 
-#     user_activity_records = df_user_activity.to_dict('records')
-#     mongo_db.insert_records(config.MONGO_USER_ACTIVITY_TABLE, user_activity_records, delete_records=True)
-#     logging.info(f'{len(user_activity_records)} users activity inserted')
+# @return_request_like_response
+def calculate_film_recommendations():
+    """
+        Для каждого фильма считаем NUMBER_FILM_NEIGHBOURS самых похожих фильмов
+        по тем же признакам, что и get_film_similarity (+ совместные лайки с весом FILM_CO_LIKE_WEIGHT).
+        Результат складываем в ml_film_recommendations.
+    """
+    # Подключаемся к базе
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
 
-#     ### RECOMMENDATIONS
-#     # Make user recommendations
-#     dict_users_recommendations = prepare_user_recommendations(df_user_activity)
-#     logging.info('Got similar users and films')
+    # Film features
+    with stage_timer('film_features'):
+        engine = FilmScoringEngine.from_films(timed_iter('fetch_films', iter_film_features(mongo_db)))
+    logging.info(f'Got films: {len(engine)}')
+    set_progress(0.1, 'film features')
+
+    # Co-likes
+    co_likes = None
+    if config.FILM_CO_LIKE_WEIGHT:
+        user_codes, film_rows, users = [], [], {}
+        select_query = {"userId":1, "anonymousId":1, "filmId":1}
+        likes = mongo_db.iter_chunks(config.MONGO_FILMS_LIKES_TABLE, find_query={"state": "LIKE"}, select_query=select_query)
+        for user_likes in timed_iter('fetch_likes', likes):
+            for like in user_likes:
+                row = engine.film_index.get(like.get("filmId"))
+                if row is not None:
+                    user_codes.append(users.setdefault(get_user_key(like), len(users)))
+                    film_rows.append(row)
+
+        with stage_timer('co_likes'):
+            co_likes = get_co_likes_matrix(np.array(user_codes, dtype=np.int64), np.array(film_rows, dtype=np.int64), len(engine))
+        logging.info(f'Got co-likes of {len(users)} users')
+
+    # Similar films
+    set_progress(0.2, 'similar films')
+    records = get_similar_films(
+        engine,
+        config.NUMBER_FILM_NEIGHBOURS,
+        co_likes=co_likes,
+        co_like_weight=config.FILM_CO_LIKE_WEIGHT,
+        block_size=config.FILM_NEIGHBOURS_BLOCK_SIZE
+    )
 
-#     # Merge films with recommendations
-#     user_recommendations = process_user_recommendations(dict_users_recommendations)
-#     logging.info('Got films with user recommend for')
+    # Похожие фильмы пишем чанками сразу по мере расчёта, время расчёта считается в similar_films
+    indexes = INDEXES[config.MONGO_FILM_RECOMS_TABLE]
+    with stage_timer('write_film_recommendations'):
+        records = timed_iter('similar_films', records)
+        number_of_records = mongo_db.replace_collection(config.MONGO_FILM_RECOMS_TABLE, chunked(records, config.MONGO_BATCH_SIZE), indexes)
+    logging.info(f'{number_of_records} film recommendations inserted')
 
-#     # Insert into Mongo
-#     mongo_db.create_collection(config.MONGO_USER_RECOMS_TABLE)
-#     logging.info(f'{config.MONGO_USER_RECOMS_TABLE} collection created')
 
-#     mongo_db.insert_records(config.MONGO_USER_RECOMS_TABLE, user_recommendations, delete_records=True)
-#     logging.info(f'{len(user_recommendations)} recommendations inserted')
+# @return_request_like_response
+def calculate_model_snapshot():
+    """
+        Сохраняем новую версию снапшота модели: матрица признаков фильмов, словари признаков,
+        inverted index, id фильмов и факторы фильмов, обученные на матрице лайков users x films.
+        API процессы мапят текущую версию в память и подхватывают новую без перезапуска.
+    """
+    # Подключаемся к базе
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
+    save_model_snapshot(mongo_db)
 
 
-# @return_request_like_response
-# def calculate_recommendations_one(user_id):
-#     """
-#         Подготавливаем рекомендации для конкретного пользователя
-#     """
-#     # Подключаемся к базе
-#     mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
-
-#     # Find certain user likes & ratings
-#     # Ищем по userId ИЛИ anonymousId
-#     find_query = {
-#         "$or": [
-#             {"userId": ObjectId(user_id)}, 
-#             {"anonymousId": ObjectId(user_id)}
-#         ]
-#     }
-#     user_likes = mongo_db.get_sorted_limited_records(config.MONGO_FILMS_LIKES_TABLE, 
-#                                                     find_query=find_query, 
-#                                                     sort_field="updatedAt", 
-#                                                     limit=config.DEFAULT_ACTIVITY_TRIGGER_LIMIT*3)
-#     df_one_user_activity = prepare_user_activity(user_likes)
-#     logging.info(f'Got user activity: {len(df_one_user_activity)}')
-
-#     # Get all users activity
-#     find_query = {
-#         "$and": [
-#             {"userId": {"$ne": ObjectId(user_id)}}, 
-#             {"anonymousId": {"$ne": ObjectId(user_id)}}
-#         ]
-#     }
-#     other_users_activity = mongo_db.get_records(config.MONGO_USER_ACTIVITY_TABLE, find_query=find_query, select_query={"_id":0})
-
-#     # Union data
-#     df_other_users_activity = pd.DataFrame(other_users_activity)
-#     df_user_activity = pd.concat([df_one_user_activity, df_other_users_activity], axis=0)
-#     logging.info(f'Got all users activity: {len(df_user_activity)}')
-
-#     # Make recommendations
-#     dict_user_recommendations = prepare_user_recommendations(df_user_activity, user_id)
-#     logging.info('Got similar users and films')
-
-#     # Get recommended films
-#     user_recommendations = process_user_recommendations(dict_user_recommendations)
-#     logging.info(f'Got {len(user_recommendations)} recommendations for user: {user_id}')
-
-#     # Insert new recommendations
-#     if bool(user_recommendations):
-#         delete_query = {
-#             "$or": [
-#                 {"userId": ObjectId(user_id)}, 
-#                 {"anonymousId": ObjectId(user_id)}
-#             ]
-#         }
-#         mongo_db.insert_records(config.MONGO_USER_RECOMS_TABLE, user_recommendations, delete_records=True, delete_query=delete_query)
-#         logging.info(f'{len(user_recommendations)} recommendations for {user_id} inserted')
-
-#         # Insert new user activity
-#         one_user_activity = df_one_user_activity.to_dict('records')
-#         mongo_db.insert_records(config.MONGO_USER_ACTIVITY_TABLE, one_user_activity, delete_records=True, delete_query=delete_query)
-#         logging.info(f'{len(one_user_activity)} user activity for {user_id} inserted')
-#     else:
-#         logging.info(f'No recommendations for: {user_id} found...')
+def save_model_snapshot(mongo_db):
+    """
+        Новая версия снапшота модели из текущих признаков фильмов и лайков
+    """
+    # Film features
+    with stage_timer('film_features'):
+        engine = FilmScoringEngine.from_films(timed_iter('fetch_films', iter_film_features(mongo_db)), with_index=True)
+    logging.info(f'Got films: {len(engine)}')
+    set_progress(0.4, 'film features')
+
+    # User x film likes, колонки - строки матрицы фильмов
+    select_query = {"userId":1, "anonymousId":1, "filmId":1, "state":1}
+    likes = timed_iter('fetch_likes', mongo_db.iter_chunks(config.MONGO_FILMS_LIKES_TABLE, select_query=select_query))
+    with stage_timer('user_items'):
+        user_item_matrix = UserItemMatrix.from_likes((like for user_likes in likes for like in user_likes), engine.film_index)
+    logging.info(f'Got likes of {len(user_item_matrix)} users')
+    set_progress(0.8, 'user items')
+
+    # Факторы фильмов для режима factors
+    factors = None
+    if config.FILM_FACTORS_NUMBER:
+        with stage_timer('train_factors'):
+            factors = FilmFactors.train(user_item_matrix, engine.film_ids, config.FILM_FACTORS_NUMBER, config.FILM_FACTORS_ITERATIONS)
+    set_progress(0.9, 'film factors')
+
+    with stage_timer('write_snapshot'):
+        arrays = engine.to_snapshot()
+        if factors is not None:
+            arrays.update(factors.to_snapshot())
+        meta = {"films": len(engine), "users": len(user_item_matrix), "factors": factors.factors.shape[1] if factors is not None else 0}
+        version = save_snapshot(MODEL_SNAPSHOT, arrays, meta)
+
+    # Этот процесс подхватывает новую версию сразу, остальные - через SNAPSHOT_REFRESH_SECONDS
+    film_catalog.snapshots.reset()
+    film_factors.reset()
+    logging.info(f'Model snapshot {version} saved')
 
 
 # @return_request_like_response
-def calculate_recommendations_all():
+def calculate_recommendations_all(full_rebuild:bool=False):
     """
-        Подготавливаем рекомендации для всех пользователей.
+        Подготавливаем профили для всех пользователей.
+
+        По умолчанию работаем инкрементально: берём только лайки новее сохранённого
+        watermark по updatedAt и докидываем их в уже существующие профили.
+        Если watermark ещё нет или full_rebuild=True -> пересобираем все профили с нуля.
+
+        Инкрементальный режим только добавляет: изменённые лайки (LIKE -> DISLIKE)
+        из профиля не вычитаются, это исправляет периодический full_rebuild.
     """
 
     # Подключаемся к базе
     mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
 
-    # Collect users likes
-    user_likes = mongo_db.get_records(config.MONGO_FILMS_LIKES_TABLE)
-    logging.info(f'Got user likes: {len(user_likes)}')
+    # Get last processed like
+    watermark = mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": PROFILES_WATERMARK})
+    if full_rebuild or watermark is None:
+        logging.info('Full rebuild of user profiles')
+        last_updated_at = rebuild_user_profiles(mongo_db)
+    else:
+        logging.info(f'Incremental update of user profiles since {watermark["updatedAt"]}')
+        last_updated_at = update_user_profiles(mongo_db, watermark["updatedAt"])
+
+    # Save new watermark
+    if last_updated_at is not None:
+        mongo_db.update_one_record(
+            config.MONGO_SERVICE_STATE_TABLE,
+            {"_id": PROFILES_WATERMARK},
+            {"$set": {"updatedAt": last_updated_at}},
+            upsert=True
+        )
+        logging.info(f'User profiles watermark: {last_updated_at}')
+
+
+def get_last_updated_at(user_likes, last_updated_at=None):
+    """
+        Max updatedAt over likes
+    """
+    for like in user_likes:
+        updated_at = like.get("updatedAt")
+        if updated_at is not None and (last_updated_at is None or updated_at > last_updated_at):
+            last_updated_at = updated_at
+    return last_updated_at
+
+
+class ProfileShards:
+    """
+        Profiles folded in current process or sharded by user between PROFILE_WORKERS processes.
+        Each shard process keeps profiles of its users and fetched films between chunks: it gets only likes,
+        not sent films and stored profiles of its users, profiles are collected once by collect(). Likes order is kept,
+        so result is the same as build_user_profiles.
+        spawn, потому что fork процесса с потоками (uvicorn, pymongo) может зависнуть
+    """
+    def __init__(self, number_of_shards):
+        self.number_of_shards = number_of_shards
+        self.user_keys = {}
+        self.users_profiles = {}
+        self.folded_at = {}
+        self.executors = []
+        self.shards_film_ids = []
+        self.futures = []
+
+
+    def __enter__(self):
+        if self.number_of_shards > 1:
+            context = multiprocessing.get_context('spawn')
+            # Один процесс на шард: все чанки шарда попадают в процесс с его профилями
+            self.executors = [
+                ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=init_profiles_shard)
+                for _ in range(self.number_of_shards)
+            ]
+            self.shards_film_ids = [set() for _ in range(self.number_of_shards)]
+        return self
+
+
+    def __exit__(self, *args):
+        for executor in self.executors:
+            executor.shutdown(cancel_futures=True)
+
+
+    def __contains__(self, user_key):
+        return user_key in self.user_keys
+
+
+    def update(self, user_likes, films, users_profiles=None, folded_at=None):
+        """
+            Fold chunk of likes. users_profiles, folded_at - stored profiles of users, which are not in shards yet
+        """
+        users_profiles = {} if users_profiles is None else users_profiles
+        folded_at = {} if folded_at is None else folded_at
+        for like in user_likes:
+            self.user_keys.setdefault(get_user_key(like))
+
+        if not self.executors:
+            self.users_profiles.update(users_profiles)
+            self.folded_at.update(folded_at)
+            build_user_profiles(user_likes, films, self.users_profiles, self.folded_at)
+            return
 
+        # Пока шарды складывают этот чанк, main процесс читает следующий
+        self.wait()
+        shards = [[] for _ in range(self.number_of_shards)]
+        for like in user_likes:
+            shards[get_user_shard(get_user_key(like), self.number_of_shards)].append(like)
+
+        for executor, shard_film_ids, shard_likes in zip(self.executors, self.shards_film_ids, shards):
+            if shard_likes:
+                shard_keys = {get_user_key(like) for like in shard_likes}
+                shard_profiles = {key: users_profiles[key] for key in shard_keys if key in users_profiles}
+                shard_folded_at = {key: folded_at[key] for key in shard_keys if key in folded_at}
+                shard_films = {
+                    filmid: films[filmid] for filmid in get_liked_film_ids(shard_likes)
+                    if filmid in films and filmid not in shard_film_ids
+                }
+                shard_film_ids.update(shard_films)
+                self.futures.append(executor.submit(fold_profiles_shard, shard_likes, shard_films, shard_profiles, shard_folded_at))
+
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+
+    def collect(self):
+        """
+            All profiles: {user_key: profile}, sharded profiles in order of the first like
+        """
+        if not self.executors:
+            return self.users_profiles
+
+        self.wait()
+        shards_profiles = {}
+        for executor in self.executors:
+            shards_profiles.update(executor.submit(collect_profiles_shard).result())
+        return {user_key: shards_profiles[user_key] for user_key in self.user_keys}
+
+
+def rebuild_user_profiles(mongo_db):
+    """
+        Пересобираем все профили пользователей с нуля
+    """
     # Create user profile based on likes
-    users_profiles = {}
+    # Лайки читаем чанками, фильмы подгружаем для каждого чанка
     logging.info('Start calculating user profiles')
+    number_of_likes = 0
+    last_updated_at = None
 
-    for like in user_likes:
-        userid = like.get("userId")
-        anonymousid = like.get("anonymousId")
-
-        # Потому что юзеры и анонимы в разных таблицах и у них могу попасться одинаковые айдишники
-        useruniqid = str(userid) if userid is not None else 'ANON_' + str(anonymousid)
-        user_profile = users_profiles.get(useruniqid, {})
-
-        if like["state"] == "LIKE":
-            # Get liked film
-            filmid = like.get("filmId")
-            find_query = {"_id":filmid}
-            select_query = {
-                "nameRu":1, "nameOriginal":1,
-                "type":1, "countries":1, "genres":1, "staff":1
-            }
-            film = mongo_db.get_one_record(config.MONGO_FILMS_TABLE, find_query, select_query)
+    total_likes = mongo_db.estimate_records(config.MONGO_FILMS_LIKES_TABLE) or 1
 
-            # Update user profile
-            user_profile = update_user_profile(user_profile, film, like)
+    with ProfileShards(config.PROFILE_WORKERS) as shards:
+        for user_likes in timed_iter('fetch_likes', mongo_db.iter_chunks(config.MONGO_FILMS_LIKES_TABLE)):
+            with stage_timer('fetch_films'):
+                films = film_cache.get_films(mongo_db, get_liked_film_ids(user_likes))
+            with stage_timer('build_profiles'):
+                shards.update(user_likes, films)
+            last_updated_at = get_last_updated_at(user_likes, last_updated_at)
+            number_of_likes += len(user_likes)
+            set_progress(0.9 * number_of_likes / total_likes, 'user profiles')
 
-        # Update watched films
-        user_profile = update_watched_films(user_profile, like)
-        users_profiles[useruniqid] = user_profile
+        with stage_timer('build_profiles'):
+            users_profiles = shards.collect()
 
+    logging.info(f'Got user likes: {number_of_likes}')
     logging.info('User profiles calculated')
 
     # Insert user profiles
-    mongo_db.create_collection(config.MONGO_USER_PROFILES)
-    logging.info(f'{config.MONGO_USER_PROFILES} collection created')
+    set_progress(0.9, 'insert user profiles')
+    indexes = INDEXES[config.MONGO_USER_PROFILES]
+    records = chunked(users_profiles.values(), config.MONGO_BATCH_SIZE)
+    with stage_timer('write_profiles'):
+        number_of_records = mongo_db.replace_collection(config.MONGO_USER_PROFILES, records, indexes)
+    logging.info(f'{number_of_records} user profiles inserted')
+
+    return last_updated_at
+
 
+def update_user_profiles(mongo_db, last_updated_at):
+    """
+        Докидываем в профили только лайки новее last_updated_at,
+        сохраняем только изменённые профили.
+        Лайки, которые уже учёл worker или пересчёт одного пользователя (не новее likesUpdatedAt профиля), пропускаем
+    """
+    # Collect new likes in historical order
+    find_query = {"updatedAt": {"$gt": last_updated_at}}
+    number_of_likes = 0
+
+    with ProfileShards(config.PROFILE_WORKERS) as shards:
+        likes = mongo_db.iter_chunks(config.MONGO_FILMS_LIKES_TABLE, find_query=find_query, sort=[("updatedAt", 1)])
+        for user_likes in timed_iter('fetch_likes', likes):
+            # Get profiles of active users, which are not loaded yet
+            users_profiles = {}
+            folded_at = {}
+            new_likes = [like for like in user_likes if get_user_key(like) not in shards]
+            user_ids = list({like["userId"] for like in new_likes if like.get("userId") is not None})
+            anonymous_ids = list({like["anonymousId"] for like in new_likes if like.get("userId") is None})
+            profiles_query = {
+                "$or": [
+                    {"userId": {"$in": user_ids}},
+                    {"userId": None, "anonymousId": {"$in": anonymous_ids}}
+                ]
+            }
+            with stage_timer('fetch_profiles'):
+                for profile in mongo_db.iter_records(config.MONGO_USER_PROFILES, find_query=profiles_query):
+                    user_key = get_user_key(profile)
+                    if user_key not in users_profiles:
+                        users_profiles[user_key] = migrate_user_profile(profile)
+                        folded_at[user_key] = profile.get("likesUpdatedAt")
+
+            # Fold new likes into profiles
+            with stage_timer('fetch_films'):
+                films = film_cache.get_films(mongo_db, get_liked_film_ids(user_likes))
+            with stage_timer('build_profiles'):
+                shards.update(user_likes, films, users_profiles, folded_at)
+            last_updated_at = get_last_updated_at(user_likes, last_updated_at)
+            number_of_likes += len(user_likes)
+
+        with stage_timer('build_profiles'):
+            users_profiles = shards.collect()
+
+    logging.info(f'Got new user likes: {number_of_likes}')
+    if not number_of_likes:
+        return None
+
+    # Upsert changed profiles only
+    set_progress(0.9, 'upsert user profiles')
     records = list(users_profiles.values())
-    mongo_db.insert_records(config.MONGO_USER_PROFILES, records, delete_records=True)
-    logging.info('User profiles inserted')
+    with stage_timer('write_profiles'):
+        mongo_db.upsert_records(config.MONGO_USER_PROFILES, records, key_fields=["userId", "anonymousId"])
+    logging.info(f'{len(records)} user profiles upserted')
+
+    return last_updated_at
 
 
 # @return_request_like_response
+def migrate_user_profiles():
+    """
+        Переводим сохранённые профили старого формата в формат PROFILE_VERSION
+    """
+    # Подключаемся к базе
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
+
+    find_query = {"profileVersion": {"$ne": PROFILE_VERSION}}
+    total_profiles = mongo_db.count_records(config.MONGO_USER_PROFILES, find_query) or 1
+    number_of_profiles = 0
+
+    # _id профиля сохраняется, поэтому upsert по userId/anonymousId заменяет тот же документ
+    for profiles in timed_iter('fetch_profiles', mongo_db.iter_chunks(config.MONGO_USER_PROFILES, find_query=find_query)):
+        with stage_timer('migrate_profiles'):
+            profiles = [migrate_user_profile(profile) for profile in profiles]
+        with stage_timer('write_profiles'):
+            mongo_db.upsert_records(config.MONGO_USER_PROFILES, profiles, key_fields=["userId", "anonymousId"])
+        number_of_profiles += len(profiles)
+        set_progress(number_of_profiles / total_profiles, 'migrate user profiles')
+
+    logging.info(f'{number_of_profiles} user profiles migrated to version {PROFILE_VERSION}')
+
+
 def calculate_recommendations_one(user_id:str):
     """
         Подготавливаем рекомендации для конкретного пользователя
@@ -229,108 +531,403 @@ def calculate_recommendations_one(user_id:str):
             {"anonymousId": ObjectId(user_id)}
         ]
     }
-    user_profile = mongo_db.get_one_record(config.MONGO_USER_PROFILES, find_query=find_query)
-    first_time_user = False
+    with stage_timer('fetch_profile'):
+        user_profile = migrate_user_profile(mongo_db.get_one_record(config.MONGO_USER_PROFILES, find_query=find_query))
+    profile_changed = False
 
     # If new user
     if user_profile is None:
-        # Костыыыль)
-        first_time_user = True
-        user_profile = {}
-
         # Create user profile
-        user_likes = mongo_db.get_sorted_limited_records(
-            config.MONGO_FILMS_LIKES_TABLE,
-            sort_field='updatedAt',
-            find_query=find_query,
-            limit=config.DEFAULT_ACTIVITY_TRIGGER_LIMIT
-        )
+        with stage_timer('fetch_likes'):
+            # Последние DEFAULT_ACTIVITY_TRIGGER_LIMIT лайков, как в calculate_recommendations_block
+            user_likes = mongo_db.get_sorted_limited_records(
+                config.MONGO_FILMS_LIKES_TABLE,
+                sort_field='updatedAt',
+                ascending=False,
+                find_query=find_query,
+                limit=config.DEFAULT_ACTIVITY_TRIGGER_LIMIT
+            )
         logging.debug(f'Got user likes: {len(user_likes)} for {user_id}')
 
-        user_profile['userId'] = user_likes[0].get("userId")
-        user_profile['anonymousId'] = user_likes[0].get("anonymousId")
-
         # Iterate over likes
-        for like in user_likes:
-            if like["state"] == "LIKE":
-                # Get liked film
-                filmid = like.get("filmId")
-                find_film_query = {"_id":filmid}
-                select_query = {
-                    "nameRu":1, "nameOriginal":1,
-                    "type":1, "countries":1, "genres":1, "staff":1
-                }
-                film = mongo_db.get_one_record(config.MONGO_FILMS_TABLE, find_film_query, select_query)
-
-                # Update user profile
-                user_profile = update_user_profile(user_profile, film, like)
-
-            # Update watched films
-            user_profile = update_watched_films(user_profile, like)
-
-    # Get user preferences
-    filter = get_filter(user_profile)
-    select_query = {
-        "nameRu":1, "nameOriginal":1,
-        "genres":1, "countries":1, "staff":1
-    }
-    films = mongo_db.get_records(config.MONGO_FILMS_TABLE, find_query=filter, select_query=select_query, limit=config.NUMBER_QUERY_FILMS)
-
-    # Calculate similarity
-    similarity = {}
-    for film in films:
-        filmid, sim = get_film_similarity(film, user_profile)
-        similarity[filmid] = sim
-
-    # Sort most recommended
-    recommended_films = sorted(similarity.items(), key=lambda x: x[1], reverse=True)[:config.NUMBER_SIMILAR_FILMS]
+        with stage_timer('fetch_films'):
+            films = film_cache.get_films(mongo_db, get_liked_film_ids(user_likes))
+        with stage_timer('build_profiles'):
+            user_profile = fold_user_likes({}, user_likes, films)
+        profile_changed = True
+
+    else:
+        # Докидываем в профиль только лайки новее уже учтённых, как update_user_profiles
+        folded_at = get_profile_folded_at(user_profile, get_profiles_watermark(mongo_db))
+        if folded_at is not None:
+            with stage_timer('fetch_likes'):
+                user_likes = list(mongo_db.iter_records(
+                    config.MONGO_FILMS_LIKES_TABLE,
+                    find_query={"$and": [find_query, {"updatedAt": {"$gt": folded_at}}]},
+                    sort=[("updatedAt", 1)]
+                ))
+            logging.debug(f'Got new user likes: {len(user_likes)} for {user_id}')
+
+            with stage_timer('fetch_films'):
+                films = film_cache.get_films(mongo_db, get_liked_film_ids(user_likes))
+            with stage_timer('build_profiles'):
+                for like in user_likes:
+                    user_profile = fold_user_like(user_profile, like, films)
+            profile_changed = bool(user_likes)
+
+    # Get most recommended films
+    recommended_films = get_recommended_films(mongo_db, user_profile)
 
     # Make values to insert
     userid = user_profile.get('userId')
-    anonymusid = user_profile.get('anonymusId')
-    recommendations = [{'userId': userid, 'anonymusId': anonymusid, 'filmId': film[0]} for film in recommended_films]
+    anonymousid = user_profile.get('anonymousId')
+    recommendations = [
+        {'userId': userid, 'anonymousId': anonymousid, 'filmId': film[0], 'rank': rank}
+        for rank, film in enumerate(recommended_films)
+    ]
 
-    # Insert into collection
+    # Replace user recommendations in one bulk_write: without moment, when user has no recommendations
     delete_query = {
         "$or": [
             {"userId": ObjectId(user_id)}, 
             {"anonymousId": ObjectId(user_id)}
         ]
     }
-    mongo_db.insert_records(config.MONGO_USER_RECOMS_TABLE, recommendations, delete_records=True, delete_query=delete_query)
+    with stage_timer('write_recommendations'):
+        mongo_db.replace_records(config.MONGO_USER_RECOMS_TABLE, delete_query, recommendations, key_fields=['userId', 'anonymousId', 'filmId'])
     logging.info(f'{len(recommendations)} recommendations for {user_id} inserted')
 
+    # Следующий GET /recommendations/{user_id} прочитает новые рекомендации из Mongo
+    recommendations_cache.delete(str(ObjectId(user_id)))
+
     # Update user profile
-    user_profile = user_profile if not first_time_user else {} #Костыыыыль)
+    if profile_changed:
+        with stage_timer('write_profile'):
+            mongo_db.replace_one_record(config.MONGO_USER_PROFILES, delete_query, user_profile)
+        logging.info(f'User profile for {user_id} inserted')
 
-    user_likes = mongo_db.get_sorted_limited_records(
-        config.MONGO_FILMS_LIKES_TABLE,
-        sort_field='updatedAt',
-        find_query=find_query,
-        limit=config.DEFAULT_ACTIVITY_TRIGGER_LIMIT
-    )
-    logging.debug(f'Got user likes: {len(user_likes)} for {user_id}')
 
+def get_profiles_watermark(mongo_db):
+    """
+        updatedAt последнего лайка, учтённого в профилях calculate_recommendations_all, None если профили не считались
+    """
+    watermark = mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": PROFILES_WATERMARK})
+    return watermark["updatedAt"] if watermark is not None else None
+
+
+def get_profile_folded_at(user_profile, profiles_watermark):
+    """
+        updatedAt, до которого лайки уже сложены в профиль. Профили без likesUpdatedAt собраны
+        calculate_recommendations_all до watermark; без watermark новых лайков не докидываем,
+        такие профили пересоберёт ближайший full rebuild
+    """
+    folded_at = user_profile.get("likesUpdatedAt")
+    return folded_at if folded_at is not None else profiles_watermark
+
+
+def calculate_recommendations_many(user_ids:list):
+    """
+        Подготавливаем рекомендации для списка пользователей, так же как calculate_recommendations_one,
+        но блоками по RECOMMENDATIONS_BATCH_SIZE пользователей: профили и лайки блока читаем одним запросом,
+        кандидатов скорим вместе, рекомендации и профили пишем одним bulk_write
+    """
+    # Подключаемся к базе
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
+
+    response = {'users': 0, 'recommendations': 0, 'skippedUsers': []}
+    user_ids = list(dict.fromkeys(ObjectId(user_id) for user_id in user_ids))
+    for block_user_ids in chunked(user_ids, config.RECOMMENDATIONS_BATCH_SIZE):
+        block_response = calculate_recommendations_block(mongo_db, block_user_ids)
+        for key, value in block_response.items():
+            response[key] += value
+
+    logging.info(f'Recommendations for {response["users"]} users inserted: {response["recommendations"]}, '
+                 f'skipped users: {len(response["skippedUsers"])}')
+    return response
+
+
+def calculate_recommendations_block(mongo_db, user_ids):
+    """
+        Рекомендации для блока пользователей (ObjectId): userId или anonymousId
+    """
+    find_query = {
+        "$or": [
+            {"userId": {"$in": user_ids}},
+            {"anonymousId": {"$in": user_ids}}
+        ]
+    }
+
+    # Get user profiles
+    with stage_timer('fetch_profile'):
+        users_profiles = {}
+        for user_profile in mongo_db.get_records(config.MONGO_USER_PROFILES, find_query=find_query):
+            user_profile = migrate_user_profile(user_profile)
+            for userid in (user_profile.get("userId"), user_profile.get("anonymousId")):
+                if userid is not None:
+                    users_profiles.setdefault(userid, user_profile)
+
+    # Последние DEFAULT_ACTIVITY_TRIGGER_LIMIT лайков новых пользователей
+    users_likes = {userid: [] for userid in user_ids if userid not in users_profiles}
+    if users_likes:
+        new_users_query = {
+            "$or": [
+                {"userId": {"$in": list(users_likes)}},
+                {"anonymousId": {"$in": list(users_likes)}}
+            ]
+        }
+        with stage_timer('fetch_likes'):
+            for like in mongo_db.iter_records(config.MONGO_FILMS_LIKES_TABLE, find_query=new_users_query, sort=[("updatedAt", -1)]):
+                for userid in {like.get("userId"), like.get("anonymousId")}:
+                    user_likes = users_likes.get(userid)
+                    if user_likes is not None and len(user_likes) < config.DEFAULT_ACTIVITY_TRIGGER_LIMIT:
+                        user_likes.append(like)
+
+    # В существующие профили докидываем только лайки новее уже учтённых, как update_user_profiles.
+    # Профиль, найденный и по userId, и по anonymousId, собирает лайки обоих id один раз
+    profiles_likes = {}
+    profiles_watermark = get_profiles_watermark(mongo_db) if len(users_likes) < len(user_ids) else None
+    folded_at = {}
+    for userid in user_ids:
+        if userid in users_profiles:
+            folded_at[userid] = get_profile_folded_at(users_profiles[userid], profiles_watermark)
+    folded_user_ids = [userid for userid, updated_at in folded_at.items() if updated_at is not None]
+    if folded_user_ids:
+        folded_users_query = {
+            "$or": [
+                {"userId": {"$in": folded_user_ids}},
+                {"anonymousId": {"$in": folded_user_ids}}
+            ],
+            "updatedAt": {"$gt": min(folded_at[userid] for userid in folded_user_ids)}
+        }
+        with stage_timer('fetch_likes'):
+            for like in mongo_db.iter_records(config.MONGO_FILMS_LIKES_TABLE, find_query=folded_users_query, sort=[("updatedAt", 1)]):
+                for userid in {like.get("userId"), like.get("anonymousId")}:
+                    if folded_at.get(userid) is not None and like["updatedAt"] > folded_at[userid]:
+                        profiles_likes.setdefault(id(users_profiles[userid]), {})[like["_id"]] = like
+
+    # Пользователей без профиля и без лайков посчитать нельзя
+    skipped_user_ids = [userid for userid in user_ids if userid not in users_profiles and not users_likes[userid]]
+    user_ids = [userid for userid in user_ids if userid in users_profiles or users_likes[userid]]
+    if not user_ids:
+        return {'users': 0, 'recommendations': 0, 'skippedUsers': [str(userid) for userid in skipped_user_ids]}
+
+    liked_film_ids = [filmid for user_likes in users_likes.values() for filmid in get_liked_film_ids(user_likes)]
+    liked_film_ids += [filmid for user_likes in profiles_likes.values() for filmid in get_liked_film_ids(user_likes.values())]
+    with stage_timer('fetch_films'):
+        films = film_cache.get_films(mongo_db, liked_film_ids)
+
+    # Профили новых пользователей собираем из лайков, в существующие докидываем новые лайки
+    profiles = {}
+    with stage_timer('build_profiles'):
+        for userid in user_ids:
+            if userid not in users_profiles:
+                users_profiles[userid] = fold_user_likes({}, users_likes[userid], films)
+                profiles[id(users_profiles[userid])] = users_profiles[userid]
+            elif id(users_profiles[userid]) in profiles_likes and id(users_profiles[userid]) not in profiles:
+                user_profile = users_profiles[userid]
+                for like in profiles_likes[id(user_profile)].values():
+                    user_profile = fold_user_like(user_profile, like, films)
+                profiles[id(user_profile)] = user_profile
+
+    # Get most recommended films
+    user_profiles = [users_profiles[userid] for userid in user_ids]
+    recommended_films = get_recommended_films_many(mongo_db, user_profiles)
+
+    # Make values to insert
+    recommendations = [
+        {'userId': user_profile.get('userId'), 'anonymousId': user_profile.get('anonymousId'), 'filmId': film[0], 'rank': rank}
+        for user_profile, user_films in zip(user_profiles, recommended_films)
+        for rank, film in enumerate(user_films)
+    ]
+
+    # Replace recommendations of all users in one bulk_write
+    delete_query = {
+        "$or": [
+            {"userId": {"$in": user_ids}},
+            {"anonymousId": {"$in": user_ids}}
+        ]
+    }
+    with stage_timer('write_recommendations'):
+        mongo_db.replace_records(config.MONGO_USER_RECOMS_TABLE, delete_query, recommendations, key_fields=['userId', 'anonymousId', 'filmId'])
+
+    for userid in user_ids:
+        recommendations_cache.delete(str(userid))
+
+    # Save new & changed user profiles only
+    profiles = list(profiles.values())
+    if profiles:
+        with stage_timer('write_profile'):
+            mongo_db.upsert_records(config.MONGO_USER_PROFILES, profiles, key_fields=["userId", "anonymousId"])
+
+    return {'users': len(user_ids), 'recommendations': len(recommendations), 'skippedUsers': [str(userid) for userid in skipped_user_ids]}
+
+
+def fold_user_likes(user_profile, user_likes, films):
+    """
+        Fold likes into profile, ids of profile are taken from the latest like
+    """
     user_profile['userId'] = user_likes[0].get("userId")
     user_profile['anonymousId'] = user_likes[0].get("anonymousId")
-
-    # Iterate over likes
     for like in user_likes:
-        if like["state"] == "LIKE":
-            # Get liked film
-            filmid = like.get("filmId")
-            find_film_query = {"_id":filmid}
-            select_query = {
-                "nameRu":1, "nameOriginal":1,
-                "type":1, "countries":1, "genres":1, "staff":1
-            }
-            film = mongo_db.get_one_record(config.MONGO_FILMS_TABLE, find_film_query, select_query)
+        user_profile = fold_user_like(user_profile, like, films)
+    return user_profile
+
+
+def get_recommended_films(mongo_db, user_profile):
+    """
+        Самые похожие на профиль пользователя фильмы: [(filmId, similarity)]
+    """
+    if config.FILM_CANDIDATES_MODE == 'factors':
+        films = get_factor_films(mongo_db, user_profile)
+        if films:
+            return films
+
+    if config.FILM_CANDIDATES_MODE in ('index', 'factors'):
+        # Кандидаты из in-memory inverted index, без запроса в Mongo
+        with stage_timer('candidates'):
+            engine = film_catalog.get(mongo_db)
+            rows = engine.get_candidates(user_profile)
+        with stage_timer('scoring'):
+            return engine.recommend(user_profile, config.NUMBER_SIMILAR_FILMS, rows=rows)
+
+    if config.FILM_CANDIDATES_MODE == 'neighbours':
+        return get_neighbour_films(mongo_db, user_profile)
+
+    if config.FILM_CANDIDATES_MODE == 'catalog':
+        # Весь каталог, кроме просмотренных фильмов
+        with stage_timer('candidates'):
+            engine = film_catalog.get(mongo_db)
+        with stage_timer('scoring'):
+            return engine.recommend(
+                user_profile,
+                config.NUMBER_SIMILAR_FILMS,
+                exclude_ids=user_profile.get("watchedFilms", []),
+                min_score=1
+            )
+
+    # Get user preferences
+    with stage_timer('candidates'):
+        filter = get_filter(user_profile)
+        films = mongo_db.get_records(config.MONGO_FILMS_TABLE, find_query=filter, select_query={"_id":1}, limit=config.NUMBER_QUERY_FILMS)
+
+        # Готовые признаки фильмов из кэша, порядок фильмов как в ответе Mongo
+        film_ids = [film["_id"] for film in films]
+        features = film_cache.get_films(mongo_db, film_ids)
+        films = [features[filmid] for filmid in film_ids if filmid in features]
+
+    # Calculate similarity
+    with stage_timer('scoring'):
+        engine = FilmScoringEngine.from_films(films)
+        return engine.recommend(user_profile, config.NUMBER_SIMILAR_FILMS)
+
+
+def get_recommended_films_many(mongo_db, user_profiles):
+    """
+        get_recommended_films для списка профилей. В режимах index, catalog и factors
+        кандидаты всех пользователей скорятся вместе одним произведением матриц
+    """
+    recommended_films = [[] for _ in user_profiles]
+    if config.FILM_CANDIDATES_MODE == 'factors':
+        recommended_films = get_factor_films_many(mongo_db, user_profiles)
+
+    if config.FILM_CANDIDATES_MODE in ('index', 'factors'):
+        # Пользователи без рекомендаций по факторам - через inverted index, как и в get_recommended_films
+        positions = [i for i, films in enumerate(recommended_films) if not films]
+        with stage_timer('candidates'):
+            engine = film_catalog.get(mongo_db)
+            rows = [engine.get_candidates(user_profiles[i]) for i in positions]
+        with stage_timer('scoring'):
+            films = engine.recommend_many([user_profiles[i] for i in positions], config.NUMBER_SIMILAR_FILMS, rows=rows)
+        for i, user_films in zip(positions, films):
+            recommended_films[i] = user_films
+        return recommended_films
+
+    if config.FILM_CANDIDATES_MODE == 'catalog':
+        with stage_timer('candidates'):
+            engine = film_catalog.get(mongo_db)
+        with stage_timer('scoring'):
+            return engine.recommend_many(
+                user_profiles,
+                config.NUMBER_SIMILAR_FILMS,
+                exclude_ids=[user_profile.get("watchedFilms", []) for user_profile in user_profiles],
+                min_score=1
+            )
+
+    # query, neighbours: кандидаты у каждого пользователя свои
+    return [get_recommended_films(mongo_db, user_profile) for user_profile in user_profiles]
+
+
+def get_factor_films(mongo_db, user_profile):
+    """
+        Fold-in лайков пользователя в факторы фильмов снапшота: [(filmId, score)].
+        Пустой список, если факторов нет или у пользователя нет лайков фильмов из снапшота
+    """
+    return get_factor_films_many(mongo_db, [user_profile])[0]
+
+
+def get_factor_films_many(mongo_db, user_profiles):
+    """
+        get_factor_films для списка профилей: все лайки пользователей читаем одним запросом
+    """
+    with stage_timer('candidates'):
+        factors = film_factors.get()
+        if factors is None:
+            return [[] for _ in user_profiles]
+
+        # Как и в расчёте одного пользователя: по userId, а у анонимов - по anonymousId
+        user_keys = [
+            ("userId", profile.get("userId")) if profile.get("userId") is not None else ("anonymousId", profile.get("anonymousId"))
+            for profile in user_profiles
+        ]
+        find_query = {"$or": [
+            {field: {"$in": [value for key_field, value in user_keys if key_field == field]}}
+            for field in ("userId", "anonymousId")
+        ]}
+        select_query = {"userId":1, "anonymousId":1, "filmId":1, "state":1}
+        users_likes = {user_key: [] for user_key in user_keys}
+        for like in mongo_db.get_records(config.MONGO_FILMS_LIKES_TABLE, find_query=find_query, select_query=select_query):
+            for user_key in (("userId", like.get("userId")), ("anonymousId", like.get("anonymousId"))):
+                if user_key in users_likes:
+                    users_likes[user_key].append(like)
+
+    with stage_timer('scoring'):
+        return factors.recommend_many(
+            [users_likes[user_key] for user_key in user_keys],
+            config.NUMBER_SIMILAR_FILMS,
+            exclude_ids=[profile.get("watchedFilms", []) for profile in user_profiles]
+        )
+
+
+def get_neighbour_films(mongo_db, user_profile):
+    """
+        Суммируем похожесть предпосчитанных соседей последних лайкнутых фильмов: [(filmId, similarity)]
+    """
+    if user_profile.get("userId") is not None:
+        find_query = {"userId": user_profile.get("userId"), "state": "LIKE"}
+    else:
+        find_query = {"anonymousId": user_profile.get("anonymousId"), "state": "LIKE"}
+
+    with stage_timer('candidates'):
+        user_likes = mongo_db.get_sorted_limited_records(
+            config.MONGO_FILMS_LIKES_TABLE,
+            sort_field='updatedAt',
+            ascending=False,
+            find_query=find_query,
+            select_query={"filmId":1},
+            limit=config.NUMBER_NEIGHBOUR_SOURCE_FILMS
+        )
+        liked_films = [like.get("filmId") for like in user_likes]
 
-            # Update user profile
-            user_profile = update_user_profile(user_profile, film, like)
+        # Neighbours of liked films
+        find_query = {"filmId": {"$in": liked_films}}
+        neighbours = mongo_db.get_records(config.MONGO_FILM_RECOMS_TABLE, find_query=find_query, select_query={"similarFilms":1})
 
-        # Update watched films
-        user_profile = update_watched_films(user_profile, like)
+    with stage_timer('scoring'):
+        watched_films = set(user_profile.get("watchedFilms", [])) | set(liked_films)
+        similarity = {}
+        for record in neighbours:
+            for film in record.get("similarFilms", []):
+                if film["filmId"] not in watched_films:
+                    similarity[film["filmId"]] = similarity.get(film["filmId"], 0) + film["similarity"]
 
-    mongo_db.insert_one_record(config.MONGO_USER_PROFILES, user_profile, delete_record=True, delete_query=delete_query)
-    logging.info(f'User profile for {user_id} inserted')
+        return sorted(similarity.items(), key=lambda x: x[1], reverse=True)[:config.NUMBER_SIMILAR_FILMS]
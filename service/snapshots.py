@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import numpy as np
+from bson import ObjectId
+from scipy import sparse
+from config import config
+
+# Logger
+logging.getLogger(__name__)
+
+# Файл с текущей версией снапшота, переписывается атомарно через os.replace
+CURRENT_FILE = 'CURRENT'
+META_FILE = 'meta.json'
+
+# Снапшот модели: матрица признаков фильмов, inverted index и факторы фильмов
+MODEL_SNAPSHOT = 'model'
+
+
+class Snapshot:
+    """
+        Loaded snapshot version: arrays (and data, indices, indptr of CSR matrices) are memory-mapped
+        read-only .npy files, so all processes, which load the same version, share pages through OS page cache
+    """
+    def __init__(self, name, version, path, arrays, meta):
+        self.name = name
+        self.version = version
+        self.path = path
+        self.arrays = arrays
+        self.meta = meta
+
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+
+def get_snapshot_path(name, directory=None):
+    return os.path.join(directory or config.SNAPSHOT_DIR, name)
+
+
+def get_current_version(name, directory=None):
+    """
+        Current version of snapshot or None, if snapshot was never saved
+    """
+    try:
+        with open(os.path.join(get_snapshot_path(name, directory), CURRENT_FILE), encoding='utf-8') as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def save_snapshot(name, arrays, meta=None, directory=None, keep_versions=None):
+    """
+        Save arrays {key: np.ndarray or sparse matrix} as new version of snapshot and make it current.
+        Version is written into temporary directory and renamed, then CURRENT is replaced,
+        so readers never see half-written version. Old versions over keep_versions are removed
+    """
+    path = get_snapshot_path(name, directory)
+    keep_versions = config.SNAPSHOT_KEEP_VERSIONS if keep_versions is None else keep_versions
+    os.makedirs(path, exist_ok=True)
+
+    # Версии сортируются по времени создания
+    created_at = time.time_ns()
+    version = time.strftime('%Y%m%dT%H%M%S', time.gmtime(created_at // 10**9)) + f'_{created_at % 10**9:09d}'
+    temporary_path = os.path.join(path, f'.{version}.tmp')
+    os.makedirs(temporary_path)
+
+    try:
+        shapes = {}
+        for key, array in arrays.items():
+            # Sparse matrix -> data, indices, indptr: каждый массив отдельно мапится в память
+            if sparse.issparse(array):
+                array = array.tocsr()
+                shapes[key] = list(array.shape)
+                parts = {f'{key}_data': array.data, f'{key}_indices': array.indices, f'{key}_indptr': array.indptr}
+            else:
+                parts = {key: array}
+
+            for part, values in parts.items():
+                np.save(os.path.join(temporary_path, f'{part}.npy'), np.ascontiguousarray(values), allow_pickle=False)
+
+        meta = dict(meta or {}, name=name, version=version, createdAt=created_at / 10**9, arrays=sorted(arrays), shapes=shapes)
+        with open(os.path.join(temporary_path, META_FILE), 'w', encoding='utf-8') as file:
+            json.dump(meta, file, ensure_ascii=False)
+
+        os.rename(temporary_path, os.path.join(path, version))
+    except Exception:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        raise
+
+    current_path = os.path.join(path, f'.{CURRENT_FILE}.{version}.tmp')
+    with open(current_path, 'w', encoding='utf-8') as file:
+        file.write(version)
+    os.replace(current_path, os.path.join(path, CURRENT_FILE))
+    logging.info(f'Snapshot {name} saved: {version}')
+
+    remove_old_versions(name, directory, keep_versions)
+    return version
+
+
+def remove_old_versions(name, directory=None, keep_versions=None):
+    """
+        Remove old versions, current version is never removed.
+        Processes, which still use removed version, keep reading it: mapped files live until unmapped
+    """
+    path = get_snapshot_path(name, directory)
+    current_version = get_current_version(name, directory)
+    versions = sorted(version for version in os.listdir(path) if not version.startswith('.') and version != CURRENT_FILE)
+
+    for version in versions[:max(0, len(versions) - max(keep_versions, 1))]:
+        if version != current_version:
+            shutil.rmtree(os.path.join(path, version), ignore_errors=True)
+
+
+def load_snapshot(name, version=None, directory=None):
+    """
+        Load version (current by default) of snapshot with memory-mapped arrays, None if there is no snapshot
+    """
+    version = version or get_current_version(name, directory)
+    if version is None:
+        return None
+
+    path = os.path.join(get_snapshot_path(name, directory), version)
+    with open(os.path.join(path, META_FILE), encoding='utf-8') as file:
+        meta = json.load(file)
+
+    arrays = {}
+    for key in meta['arrays']:
+        if key in meta['shapes']:
+            arrays[key] = sparse.csr_matrix(
+                tuple(load_array(path, f'{key}_{part}') for part in ('data', 'indices', 'indptr')),
+                shape=tuple(meta['shapes'][key]), copy=False
+            )
+        else:
+            arrays[key] = load_array(path, key)
+
+    return Snapshot(name, version, path, arrays, meta)
+
+
+def load_array(path, key):
+    return np.load(os.path.join(path, f'{key}.npy'), mmap_mode='r', allow_pickle=False)
+
+
+def encode_object_ids(object_ids):
+    """
+        ObjectIds as (n, 12) uint8 array
+    """
+    return np.frombuffer(b''.join(objectid.binary for objectid in object_ids), dtype=np.uint8).reshape(-1, 12)
+
+
+def decode_object_ids(array):
+    data = array.tobytes()
+    return [ObjectId(data[i:i+12]) for i in range(0, len(data), 12)]
+
+
+class SnapshotStore:
+    """
+        Current version of snapshot, loaded by builder(snapshot).
+        CURRENT is checked not more often than every refresh_seconds, new version is loaded and swapped in,
+        while it is loading, other threads keep using previous version
+    """
+    def __init__(self, name, builder, refresh_seconds=None, directory=None):
+        self.name = name
+        self.builder = builder
+        self.refresh_seconds = config.SNAPSHOT_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        self.directory = directory
+        self.version = None
+        self.value = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+
+    def get(self):
+        """
+            Value built from current version, None if snapshot was never saved
+        """
+        if time.time() - self.checked_at > self.refresh_seconds and self.lock.acquire(blocking=(self.value is None)):
+            try:
+                self.refresh()
+            finally:
+                self.lock.release()
+
+        return self.value
+
+
+    def refresh(self):
+        self.checked_at = time.time()
+        version = get_current_version(self.name, self.directory)
+        if version is None or version == self.version:
+            return
+
+        logging.info(f'Loading snapshot {self.name}: {version}')
+        try:
+            value = self.builder(load_snapshot(self.name, version, self.directory))
+        except Exception:
+            # Битая версия не должна ломать запросы: продолжаем работать на предыдущей
+            logging.exception(f'Snapshot {self.name} {version} is not loaded')
+            return
+
+        self.value, self.version = value, version
+        logging.info(f'Snapshot {self.name} loaded: {version}')
+
+
+    def reset(self):
+        """
+            Check CURRENT on next get, e.g. after snapshot is saved by this process
+        """
+        self.checked_at = 0
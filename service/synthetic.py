@@ -0,0 +1,503 @@
+import random
+import logging
+import datetime
+import itertools
+import bson
+from bson import ObjectId, Decimal128
+from bson.raw_bson import RawBSONDocument
+from db import get_projection
+
+# Logger
+logging.getLogger(__name__)
+
+# Словари для названий и атрибутов синтетических фильмов
+GENRES = [
+    'драма', 'комедия', 'боевик', 'триллер', 'ужасы', 'фантастика', 'мелодрама', 'детектив',
+    'приключения', 'аниме', 'мультфильм', 'документальный', 'криминал', 'фэнтези', 'военный'
+]
+COUNTRIES = ['США', 'Россия', 'Франция', 'Великобритания', 'Япония', 'Германия', 'Корея Южная', 'Италия', 'Испания', 'Индия']
+WORDS = [
+    'любовь', 'война', 'город', 'последний', 'ночь', 'дорога', 'тайна', 'море', 'дом', 'зима',
+    'star', 'night', 'dream', 'house', 'river', 'summer', 'dark', 'king', 'lost', 'world'
+]
+RATING_FIELDS = ['rating', 'ratingFilmCritics', 'ratingImdb', 'ratingKinopoisk']
+
+
+def get_object_id(rnd):
+    return ObjectId(rnd.getrandbits(96).to_bytes(12, 'big'))
+
+
+def get_rating(rnd, max_rating, missed_share):
+    if rnd.random() < missed_share:
+        return None
+    return Decimal128(str(round(rnd.uniform(1, max_rating), 1)))
+
+
+def generate_films(number_of_films, number_of_persons=None, missed_rating_share=0.2, seed=0):
+    """
+        Yield film documents like in `film` collection: Decimal128 ratings (ratingGoodReview in 0..100),
+        genres, countries and staff with personId & proffession
+    """
+    rnd = random.Random(seed)
+    persons = [get_object_id(rnd) for _ in range(number_of_persons or max(10, number_of_films // 2))]
+
+    for _ in range(number_of_films):
+        staff = [{'personId': rnd.choice(persons), 'proffession': 'DIRECTOR', 'name': 'director'}]
+        staff += [
+            {'personId': rnd.choice(persons), 'proffession': rnd.choice(['ACTOR', 'ACTOR', 'ACTOR', 'PRODUCER', 'WRITER']), 'name': 'person'}
+            for _ in range(rnd.randint(0, 30))
+        ]
+        film = {
+            '_id': get_object_id(rnd),
+            'nameRu': ' '.join(rnd.sample(WORDS[:10], rnd.randint(1, 3))),
+            'nameOriginal': ' '.join(rnd.sample(WORDS[10:], rnd.randint(1, 3))),
+            'type': rnd.choice(['FILM', 'FILM', 'FILM', 'TV_SERIES']),
+            'genres': rnd.sample(GENRES, rnd.randint(1, 4)),
+            'countries': rnd.sample(COUNTRIES, rnd.randint(1, 3)),
+            'staff': staff,
+        }
+
+        for field in RATING_FIELDS:
+            rating = get_rating(rnd, 10, missed_rating_share)
+            if rating is not None:
+                film[field] = rating
+
+        rating = get_rating(rnd, 100, missed_rating_share)
+        if rating is not None:
+            film['ratingGoodReview'] = rating
+
+        yield film
+
+
+def generate_likes(number_of_likes, film_ids, number_of_users, anonymous_share=0.3, dislike_share=0.3, seed=0):
+    """
+        Yield like documents like in `like_dislike` collection, sorted by updatedAt.
+        Popularity of films and activity of users are skewed: few films and users get most of likes
+    """
+    rnd = random.Random(seed)
+    users = [(get_object_id(rnd), rnd.random() < anonymous_share) for _ in range(number_of_users)]
+
+    # Zipf-like weights, cumulative for random.choices
+    film_weights = list(itertools.accumulate(1 / (i + 1) ** 0.8 for i in range(len(film_ids))))
+    user_weights = list(itertools.accumulate(1 / (i + 1) ** 0.5 for i in range(len(users))))
+    started_at = datetime.datetime(2023, 1, 1)
+
+    batch_size = 10000
+    for start in range(0, number_of_likes, batch_size):
+        size = min(batch_size, number_of_likes - start)
+        films = rnd.choices(film_ids, cum_weights=film_weights, k=size)
+        likers = rnd.choices(users, cum_weights=user_weights, k=size)
+
+        for i, (filmid, (userid, anonymous)) in enumerate(zip(films, likers), start):
+            like = {
+                '_id': get_object_id(rnd),
+                'filmId': filmid,
+                'state': 'DISLIKE' if rnd.random() < dislike_share else 'LIKE',
+                'createdAt': started_at + datetime.timedelta(seconds=i),
+                'updatedAt': started_at + datetime.timedelta(seconds=i),
+            }
+            like['anonymousId' if anonymous else 'userId'] = userid
+            yield like
+
+
+def get_value(record, field):
+    """
+        Values of (dotted) field, arrays are unwound like in Mongo: staff.personId -> all persons
+    """
+    values = [record]
+    for key in field.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                value = [item.get(key) for item in value if isinstance(item, dict)]
+                next_values.extend(item for item in value)
+            elif isinstance(value, dict) and key in value:
+                next_values.append(value[key])
+        values = next_values
+
+    # Массивы сравниваются поэлементно
+    result = []
+    for value in values:
+        result.extend(value if isinstance(value, list) else [value])
+    return result
+
+
+def match_value(values, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+        return all(match_operator(values, operator, operand) for operator, operand in condition.items())
+    if condition is None:
+        return not values or None in values
+    return condition in values
+
+
+def match_operator(values, operator, operand):
+    if operator == '$in':
+        return any(match_value(values, item) for item in operand)
+    if operator == '$nin':
+        return not any(match_value(values, item) for item in operand)
+    if operator == '$ne':
+        return not match_value(values, operand)
+    if operator == '$gt':
+        return any(value is not None and value > operand for value in values)
+    if operator == '$gte':
+        return any(value is not None and value >= operand for value in values)
+    if operator == '$lt':
+        return any(value is not None and value < operand for value in values)
+    if operator == '$lte':
+        return any(value is not None and value <= operand for value in values)
+    if operator == '$exists':
+        return bool(values) == bool(operand)
+    raise NotImplementedError(f'Operator {operator} is not supported')
+
+
+def match(record, find_query):
+    """
+        Check record by subset of Mongo query language, which is used by service
+    """
+    for field, condition in find_query.items():
+        if field == '$or':
+            if not any(match(record, query) for query in condition):
+                return False
+        elif field == '$and':
+            if not all(match(record, query) for query in condition):
+                return False
+        elif field == '$nor':
+            if any(match(record, query) for query in condition):
+                return False
+        elif not match_value(get_value(record, field), condition):
+            return False
+    return True
+
+
+def project(record, select_query):
+    """
+        Projection like in Mongo: inclusion or exclusion of fields, dotted fields of subdocuments
+        (staff.personId) and {"$slice": n} of arrays, fields keep order of document
+    """
+    select_query = get_projection(select_query)
+    if not select_query:
+        return record
+
+    fields = {field: value for field, value in select_query.items() if field != '_id'}
+    include = any(value and not isinstance(value, dict) for value in fields.values())
+    result = {}
+    for field, value in record.items():
+        if field == '_id':
+            if select_query.get('_id', 1):
+                result[field] = value
+            continue
+
+        option = fields.get(field)
+        nested = {key[len(field) + 1:]: value for key, value in fields.items() if key.startswith(field + '.')}
+        if isinstance(option, dict) and '$slice' in option:
+            result[field] = value[:option['$slice']] if isinstance(value, list) else value
+        elif option is not None:
+            if option:
+                result[field] = value
+        elif nested and include:
+            nested['_id'] = 0
+            if isinstance(value, list):
+                result[field] = [project(item, nested) for item in value if isinstance(item, dict)]
+            elif isinstance(value, dict):
+                result[field] = project(value, nested)
+        elif not include:
+            result[field] = value
+
+    return result
+
+
+def sort_records(records, sort):
+    """
+        Sort records by [(field, direction)], missed values go first like in Mongo
+    """
+    records = list(records)
+    for field, direction in reversed(sort):
+        records.sort(key=lambda record: (record.get(field) is not None, record.get(field)), reverse=direction < 0)
+    return records
+
+
+class InMemoryCollection:
+    """
+        Collection of documents. Every read encodes and decodes document with BSON
+        like a round trip to Mongo, so results are independent copies.
+        Equality and $in on indexed fields don't scan collection
+    """
+    def __init__(self, indexed_fields=()):
+        self.records = {}
+        self.indexes = {field: {} for field in indexed_fields}
+        self.sequence = itertools.count()
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def insert(self, record):
+        record = bson.decode(bson.encode(record))
+        record.setdefault('_id', ObjectId())
+        if record['_id'] in self.records:
+            raise ValueError(f'Duplicate _id {record["_id"]}')
+
+        position = next(self.sequence)
+        self.records[record['_id']] = (position, record)
+        for field, index in self.indexes.items():
+            for value in set(map(str, get_value(record, field))) or {'None'}:
+                index.setdefault(value, {})[record['_id']] = position
+        return record['_id']
+
+
+    def delete(self, recordid):
+        _, record = self.records.pop(recordid)
+        for field, index in self.indexes.items():
+            for value in set(map(str, get_value(record, field))) or {'None'}:
+                index.get(value, {}).pop(recordid, None)
+
+
+    def get_index_candidates(self, find_query):
+        """
+            Ids of records, which can match query by one of indexes, None - full scan
+        """
+        if '$or' in find_query and len(find_query) == 1:
+            candidates = {}
+            for query in find_query['$or']:
+                query_candidates = self.get_index_candidates(query)
+                if query_candidates is None:
+                    return None
+                candidates.update(query_candidates)
+            return candidates
+
+        for field, condition in find_query.items():
+            if field not in self.indexes:
+                continue
+            if isinstance(condition, dict) and set(condition) == {'$in'}:
+                values = condition['$in']
+            elif isinstance(condition, dict):
+                continue
+            else:
+                values = [condition]
+
+            candidates = {}
+            for value in values:
+                candidates.update(self.indexes[field].get(str(value), {}))
+            return candidates
+
+        return None
+
+
+    def find(self, find_query=None):
+        """
+            Yield (id, record) of matched records in insertion order
+        """
+        find_query = find_query or {}
+        candidates = self.get_index_candidates(find_query)
+
+        if candidates is None:
+            items = self.records.items()
+        else:
+            ids = sorted(candidates, key=candidates.get)
+            items = ((recordid, self.records[recordid]) for recordid in ids if recordid in self.records)
+
+        for recordid, (_, record) in items:
+            if match(record, find_query):
+                yield recordid
+
+
+    def read(self, recordid):
+        return bson.decode(bson.encode(self.records[recordid][1]))
+
+
+class InMemoryMongoDb:
+    """
+        In-memory stand-in for db.KMongoDb with the same methods,
+        supports queries, which are used by service. Used by benchmarks
+    """
+    # Поля, по которым сервис ищет документы (как индексы в Mongo)
+    INDEXED_FIELDS = {
+        'film': ['_id'],
+        'like_dislike': ['userId', 'anonymousId'],
+        'ml_user_profiles': ['userId', 'anonymousId'],
+        'ml_user_recommendations': ['userId', 'anonymousId'],
+        'ml_film_recommendations': ['filmId'],
+    }
+
+    def __init__(self, database=None, indexed_fields=None):
+        self.database = database
+        self.indexed_fields = self.INDEXED_FIELDS if indexed_fields is None else indexed_fields
+        self.collections = {}
+
+
+    def __call__(self, database=None):
+        # Можно подставить вместо класса KMongoDb: KMongoDb(database) вернёт эту же базу
+        return self
+
+
+    def dump(self, skip=()):
+        """
+            Copy of all collections except skip as BSON documents, restore() returns database to it
+        """
+        return {
+            name: [bson.encode(record) for _, record in collection.records.values()]
+            for name, collection in self.collections.items() if name not in skip
+        }
+
+
+    def restore(self, dump, skip=()):
+        for name in [name for name in self.collections if name not in skip]:
+            del self.collections[name]
+
+        for name, documents in dump.items():
+            collection = self.get_collection(name)
+            for document in documents:
+                collection.insert(bson.decode(document))
+
+
+    def get_collection(self, collection):
+        if collection not in self.collections:
+            self.collections[collection] = InMemoryCollection(self.indexed_fields.get(collection, []))
+        return self.collections[collection]
+
+
+    def get_cursor(self, collection, find_query={}, select_query=None, sort=None, limit=0):
+        collection = self.get_collection(collection)
+        records = (collection.read(recordid) for recordid in collection.find(find_query))
+
+        if sort:
+            records = sort_records(records, sort)
+        if limit:
+            records = itertools.islice(records, limit)
+
+        return (project(record, select_query) for record in records)
+
+
+    def create_collection(self, collection):
+        self.get_collection(collection)
+
+
+    def ensure_indexes(self, collection, indexes):
+        # Индексов в памяти нет
+        self.create_collection(collection)
+        return []
+
+
+    def explain(self, collection, find_query={}, sort=None):
+        raise NotImplementedError('Query plans are not supported in memory')
+
+
+    def get_one_record(self, collection, find_query={}, select_query=None):
+        return next(self.get_cursor(collection, find_query, select_query, limit=1), None)
+
+
+    def get_records(self, collection, find_query={}, select_query=None, limit=0):
+        return list(self.get_cursor(collection, find_query, select_query, limit=limit))
+
+
+    def iter_records(self, collection, find_query={}, select_query=None, sort=None, batch_size=None, limit=0, raw=False):
+        records = self.get_cursor(collection, find_query, select_query, sort=sort, limit=limit)
+        if raw:
+            return (RawBSONDocument(bson.encode(record)) for record in records)
+        return records
+
+
+    def iter_chunks(self, collection, find_query={}, select_query=None, sort=None, chunk_size=10000, raw=False):
+        records = self.iter_records(collection, find_query, select_query, sort=sort, raw=raw)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+    def get_records_by_ids(self, collection, ids, select_query=None, chunk_size=1000):
+        return self.get_records(collection, {"_id": {"$in": list(ids)}}, select_query)
+
+
+    def count_records(self, collection, find_query={}):
+        return sum(1 for _ in self.get_collection(collection).find(find_query))
+
+
+    def estimate_records(self, collection):
+        return len(self.get_collection(collection))
+
+
+    def get_sorted_limited_records(self, collection, sort_field, ascending=False, find_query={}, select_query=None, limit=0):
+        sort = [(sort_field, 1 if ascending else -1)]
+        return list(self.get_cursor(collection, find_query, select_query, sort=sort, limit=limit))
+
+
+    def delete_records(self, collection, find_query={}):
+        collection = self.get_collection(collection)
+        for recordid in list(collection.find(find_query)):
+            collection.delete(recordid)
+
+
+    def insert_one_record(self, collection, record, delete_record=False, delete_query={}):
+        if delete_record:
+            self.delete_records(collection, delete_query)
+        self.get_collection(collection).insert(record)
+
+
+    def insert_records(self, collection, records, delete_records=False, delete_query={}):
+        if delete_records:
+            self.delete_records(collection, delete_query)
+        for record in records:
+            self.get_collection(collection).insert(record)
+
+
+    def replace_collection(self, collection, batches, indexes=None):
+        staging = InMemoryCollection(self.indexed_fields.get(collection, []))
+        number_of_records = 0
+        for records in batches:
+            for record in records:
+                staging.insert(record)
+            number_of_records += len(records)
+
+        self.collections[collection] = staging
+        return number_of_records
+
+
+    def aggregate_into_collections(self, source_collection, pipeline, collections):
+        raise NotImplementedError('Aggregation pipelines are not supported, use TOP_FILMS_MODE=python')
+
+
+    def replace_one_record(self, collection, find_query, record):
+        recordid = next(self.get_collection(collection).find(find_query), None)
+        if recordid is not None:
+            self.get_collection(collection).delete(recordid)
+            record = dict(record, _id=recordid)
+        self.get_collection(collection).insert(record)
+
+
+    def replace_records(self, collection, delete_query, records, key_fields):
+        keys = [{field: record.get(field) for field in key_fields} for record in records]
+        self.delete_records(collection, {"$and": [delete_query, {"$nor": keys}]} if keys else delete_query)
+        for key, record in zip(keys, records):
+            self.replace_one_record(collection, key, record)
+
+
+    def update_one_record(self, collection, find_query, update_query, upsert=False):
+        if set(update_query) != {'$set'}:
+            raise NotImplementedError('Only $set updates are supported')
+
+        record = self.get_one_record(collection, find_query)
+        if record is None and not upsert:
+            return
+        record = dict(record or {key: value for key, value in find_query.items() if not key.startswith('$')})
+        record.update(update_query['$set'])
+        self.replace_one_record(collection, find_query, record)
+
+
+    def upsert_records(self, collection, records, key_fields):
+        for record in records:
+            self.replace_one_record(collection, {field: record.get(field) for field in key_fields}, record)
+
+
+def load_synthetic_data(mongo_db, number_of_films, number_of_likes, number_of_users, seed=0):
+    """
+        Fill `film` and `like_dislike` collections of mongo_db with synthetic documents
+    """
+    films = list(generate_films(number_of_films, seed=seed))
+    mongo_db.insert_records('film', films)
+
+    film_ids = [film['_id'] for film in films]
+    mongo_db.insert_records('like_dislike', generate_likes(number_of_likes, film_ids, number_of_users, seed=seed))
+    logging.info(f'Synthetic data loaded: {number_of_films} films, {number_of_likes} likes, {number_of_users} users')
@@ -0,0 +1,94 @@
+"""
+    Tests run on in-memory database (synthetic.InMemoryMongoDb) without Mongo,
+    KMongoDb methods are tested on mongomock:
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import os
+import sys
+
+# Модули сервиса импортируются из каталога service, как при запуске api.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Обязательные переменные окружения config, если тесты запускаются без .env
+TEST_ENV = {
+    'MONGO_INITDB_DATABASE': 'test',
+    'DEFAULT_TOP_LIMIT': '100',
+    'DEFAULT_TOP_RATING': '7',
+    'DEFAULT_COSINE_LIMIT': '0.8',
+    'DEFAULT_FILM_MISSED_RATING': '5',
+    'DEFAULT_ACTIVITY_TRIGGER_LIMIT': '3',
+    'NUMBER_SIMILAR_FILMS': '20',
+    'NUMBER_QUERY_FILMS': '500',
+    'LOGGIN_LEVEL': 'INFO',
+}
+for key, value in TEST_ENV.items():
+    os.environ.setdefault(key, value)
+
+import pytest
+import service_ml
+from config import config
+from cache import film_cache, recommendations_cache
+from calculations_film import film_catalog
+from calculations_user import film_factors
+from db import KMongoDb
+from synthetic import InMemoryMongoDb, generate_films, generate_likes
+
+
+def clear_caches():
+    film_cache.clear()
+    recommendations_cache.clear()
+    film_catalog.engine = None
+    # Загруженная версия снапшота остаётся, пока в каталоге нет новой -> забываем её явно
+    for store in (film_catalog.snapshots, film_factors):
+        store.value, store.version = None, None
+        store.reset()
+
+
+def use_in_memory_db(monkeypatch):
+    """
+        New empty in-memory database, which service_ml uses instead of Mongo, with clean caches
+    """
+    mongo_db = InMemoryMongoDb(config.MONGO_INITDB_DATABASE)
+    monkeypatch.setattr(service_ml, 'KMongoDb', mongo_db)
+    clear_caches()
+    return mongo_db
+
+
+@pytest.fixture
+def mongo_db(monkeypatch, tmp_path):
+    # Снапшоты модели пишутся в каталог теста, а не в рабочий каталог
+    monkeypatch.setattr(config, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    yield use_in_memory_db(monkeypatch)
+    clear_caches()
+
+
+@pytest.fixture
+def kmongo_db():
+    """
+        KMongoDb on mongomock client: methods of KMongoDb itself, which InMemoryMongoDb replaces
+    """
+    mongomock = pytest.importorskip('mongomock')
+    return KMongoDb(config.MONGO_INITDB_DATABASE, client=mongomock.MongoClient())
+
+
+@pytest.fixture
+def films():
+    return list(generate_films(100, seed=1))
+
+
+@pytest.fixture
+def likes(films):
+    # Отсортированы по updatedAt
+    return list(generate_likes(3000, [film['_id'] for film in films], 80, seed=1))
+
+
+def get_profiles(mongo_db):
+    """
+        Profiles by user key without _id, which differs between rebuilds
+    """
+    return {
+        str(profile.get('userId') or profile.get('anonymousId')): {key: value for key, value in profile.items() if key != '_id'}
+        for profile in mongo_db.get_records(config.MONGO_USER_PROFILES)
+    }
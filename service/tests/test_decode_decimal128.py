@@ -0,0 +1,45 @@
+import random
+import numpy as np
+from bson import Decimal128
+from calculations_user import decode_decimal128
+
+
+def decode_one_by_one(values):
+    return np.array([np.nan if value is None else float(value.to_decimal()) for value in values])
+
+
+def assert_same_floats(actual, expected):
+    assert np.array_equal(actual, expected, equal_nan=True)
+    # -0.0 == 0.0, поэтому знак проверяется отдельно
+    numbers = ~np.isnan(expected)
+    assert np.array_equal(np.signbit(actual[numbers]), np.signbit(expected[numbers]))
+
+
+def test_decode_random_decimals():
+    rnd = random.Random(1)
+    values = []
+    for _ in range(5000):
+        digits = rnd.choice([1, 2, 3, 15, 16, 17, 34])
+        coefficient = rnd.randrange(10 ** digits)
+        # Рейтинги кинопоиска и imdb - небольшие экспоненты, остальные уходят в поштучное преобразование
+        exponent = rnd.randint(-3, 1) if rnd.random() < 0.5 else rnd.randint(-40, 40)
+        sign = rnd.choice(['', '-'])
+        values.append(Decimal128(f'{sign}{coefficient}E{exponent}'))
+
+    assert_same_floats(decode_decimal128(values), decode_one_by_one(values))
+
+
+def test_decode_special_values():
+    values = [Decimal128(value) for value in [
+        'NaN', '-NaN', 'Infinity', '-Infinity', '0', '-0', '0E-20', '-0E+30',
+        '7.5', '-7.5', '9007199254740992', '9007199254740993', '1E22', '1E23', '1E-22', '1E-23',
+        '1E-6176', '-1E-6176', '9999999999999999999999999999999999E+6111', '-1E+6144',
+        '1E-400', '1E+400', '123456789012345678901234567890.1234',
+    ]]
+    values += [None]
+
+    assert_same_floats(decode_decimal128(values), decode_one_by_one(values))
+
+
+def test_decode_empty_list():
+    assert decode_decimal128([]).shape == (0,)
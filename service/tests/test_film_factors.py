@@ -0,0 +1,38 @@
+import numpy as np
+from calculations_user import UserItemMatrix, FilmFactors
+from helpers import get_user_key
+
+
+def test_fold_in_reproduces_svd_reconstruction(films, likes):
+    film_ids = [film['_id'] for film in films]
+    film_index = {filmid: i for i, filmid in enumerate(film_ids)}
+    user_item_matrix = UserItemMatrix.from_likes(likes, film_index)
+    matrix = user_item_matrix.matrix.toarray().astype(np.float64)
+
+    # Ранг с заметным разрывом сингулярных чисел: подпространство randomized SVD совпадает с точным
+    _, singular_values, vt = np.linalg.svd(matrix, full_matrices=False)
+    k = max(range(5, 20), key=lambda k: singular_values[k - 1] / singular_values[k])
+    factors = FilmFactors.train(user_item_matrix, film_ids, k, number_of_iterations=30)
+    reconstruction = matrix @ vt[:k].T @ vt[:k]
+
+    users_likes = {}
+    for like in likes:
+        users_likes.setdefault(get_user_key(like), []).append(like)
+
+    for row, user_key in enumerate(user_item_matrix.user_keys.tolist()):
+        user_likes = users_likes[user_key]
+        recommendations = factors.recommend(user_likes, 10)
+
+        # Ранжирование строки rank-k реконструкции среди неоценённых фильмов с положительной оценкой
+        scores = reconstruction[row].copy()
+        scores[[film_index[like['filmId']] for like in user_likes]] = -np.inf
+        candidates = np.flatnonzero(scores > 1e-3)
+        assert min(10, len(candidates)) <= len(recommendations) <= 10
+
+        recommended = [film_index[filmid] for filmid, _ in recommendations]
+        assert np.allclose([score for _, score in recommendations], scores[recommended], atol=1e-3)
+        # Порядок совпадает с точностью до почти равных оценок
+        assert np.all(np.diff(scores[recommended]) <= 1e-3)
+        not_recommended = np.setdiff1d(candidates, recommended)
+        if len(not_recommended):
+            assert scores[recommended].min() >= scores[not_recommended].max() - 1e-3
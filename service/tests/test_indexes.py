@@ -0,0 +1,53 @@
+from pymongo import IndexModel
+from indexes import INDEXES, ensure_indexes, check_query_plans, get_plan_stages
+from config import config
+
+
+def get_index_information(kmongo_db):
+    return {collection: kmongo_db.database[collection].index_information() for collection in INDEXES}
+
+
+def test_ensure_indexes_is_idempotent(kmongo_db):
+    ensure_indexes(kmongo_db)
+    index_information = get_index_information(kmongo_db)
+    for collection, indexes in INDEXES.items():
+        assert len(index_information[collection]) == len(indexes) + 1
+
+    # Повторный запуск ничего не создаёт
+    for collection, indexes in INDEXES.items():
+        assert kmongo_db.ensure_indexes(collection, indexes) == []
+    ensure_indexes(kmongo_db)
+    assert get_index_information(kmongo_db) == index_information
+
+
+def test_ensure_indexes_keeps_index_with_other_name(kmongo_db):
+    collection = config.MONGO_FILMS_LIKES_TABLE
+    kmongo_db.database[collection].create_indexes([IndexModel([("userId", 1), ("updatedAt", -1)], name="user_likes")])
+
+    created_indexes = kmongo_db.ensure_indexes(collection, INDEXES[collection])
+
+    assert "userId_1_updatedAt_-1" not in created_indexes
+    assert len(created_indexes) == len(INDEXES[collection]) - 1
+    assert "user_likes" in kmongo_db.database[collection].index_information()
+
+
+class PlansDb:
+    """
+        explain() of every query is index scan, except queries to collscan_collection
+    """
+    def __init__(self, collscan_collection):
+        self.collscan_collection = collscan_collection
+
+    def explain(self, collection, find_query={}, sort=None):
+        if collection == self.collscan_collection:
+            return {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+        return {"stage": "FETCH", "inputStage": {"stage": "OR", "inputStages": [{"stage": "IXSCAN"}, {"stage": "IXSCAN"}]}}
+
+
+def test_check_query_plans_reports_collscan():
+    assert get_plan_stages({"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}) == ["FETCH", "IXSCAN"]
+    assert check_query_plans(PlansDb(None)) == []
+
+    failed_shapes = check_query_plans(PlansDb(config.MONGO_USER_PROFILES))
+    assert failed_shapes
+    assert all(collection == config.MONGO_USER_PROFILES for _, collection, _ in failed_shapes)
@@ -0,0 +1,66 @@
+import threading
+from jobs import JobManager
+
+
+TARGETS = {
+    'profiles': ['ml_user_profiles'],
+    'migrate': ['ml_user_profiles'],
+    'top': ['ml_film_top'],
+}
+
+
+def get_blocking_job(release, events):
+    """
+        Job function which waits for release. Params of jobs are hashed, so shared state is in the closure
+    """
+    started = {}
+
+    def blocking_job(label):
+        events.append(f'{label} started')
+        started[label].set()
+        assert release.wait(5)
+        events.append(f'{label} done')
+        return label
+
+    for label in ['a', 'profiles', 'migrate', 'top']:
+        started[label] = threading.Event()
+    return blocking_job, started
+
+
+def test_job_with_same_params_is_coalesced():
+    job_manager = JobManager(max_workers=4, targets=TARGETS)
+    release, events = threading.Event(), []
+    blocking_job, started = get_blocking_job(release, events)
+
+    job = job_manager.submit('profiles', blocking_job, label='a')
+    assert started['a'].wait(5)
+    assert job_manager.submit('profiles', blocking_job, label='a') is job
+
+    release.set()
+    assert job.future.result(5) == 'a'
+    assert events == ['a started', 'a done']
+    job_manager.shutdown()
+
+
+def test_jobs_with_same_target_run_one_by_one():
+    job_manager = JobManager(max_workers=4, targets=TARGETS)
+    release, events = threading.Event(), []
+    blocking_job, started = get_blocking_job(release, events)
+
+    profiles_job = job_manager.submit('profiles', blocking_job, label='profiles')
+    assert started['profiles'].wait(5)
+    migrate_job = job_manager.submit('migrate', blocking_job, label='migrate')
+    top_job = job_manager.submit('top', blocking_job, label='top')
+
+    # Другая коллекция - задача стартует сразу, миграция ждёт профили
+    assert started['top'].wait(5)
+    assert not started['migrate'].wait(0.2)
+    assert migrate_job.status == 'queued'
+
+    release.set()
+    for job in [profiles_job, migrate_job, top_job]:
+        job.future.result(5)
+
+    assert events.index('profiles done') < events.index('migrate started')
+    assert [job.status for job in [profiles_job, migrate_job, top_job]] == ['done', 'done', 'done']
+    job_manager.shutdown()
@@ -0,0 +1,52 @@
+import datetime
+from bson import ObjectId
+from service_ml import migrate_user_profiles
+from helpers import PROFILE_VERSION
+from config import config
+from conftest import get_profiles
+
+
+def test_migrate_old_profile(mongo_db, monkeypatch):
+    monkeypatch.setattr(config, 'PROFILE_MAX_FEATURES', 2)
+    userid, anonymousid = ObjectId(), ObjectId()
+    film_ids = [ObjectId() for _ in range(3)]
+    likes_updated_at = datetime.datetime(2023, 1, 1)
+    mongo_db.insert_records(config.MONGO_USER_PROFILES, [
+        # Старый формат: texts списком, watchedFilms с повторами и None, признаки без обрезки
+        {
+            'userId': userid, 'anonymousId': None, 'likesUpdatedAt': likes_updated_at,
+            'watchedFilms': [film_ids[2], film_ids[0], film_ids[2], None, film_ids[1]],
+            'genres': {'драма': 5, 'комедия': 1, 'боевик': 3, 'триллер': 1, 'мелодрама': 4},
+            'countries': {'США': 2},
+            'texts': ['дорога', 'любовь', 'дорога'],
+        },
+        {'userId': None, 'anonymousId': anonymousid, 'profileVersion': PROFILE_VERSION, 'genres': {'драма': 1}},
+    ])
+    current_profile = get_profiles(mongo_db)[str(anonymousid)]
+
+    migrate_user_profiles()
+    profiles = get_profiles(mongo_db)
+    assert profiles[str(userid)] == {
+        'userId': userid, 'anonymousId': None, 'likesUpdatedAt': likes_updated_at,
+        'watchedFilms': sorted(film_ids),
+        'genres': {'драма': 5, 'мелодрама': 4},
+        'countries': {'США': 2},
+        'texts': {'дорога': 2, 'любовь': 1},
+        'profileVersion': PROFILE_VERSION,
+    }
+    assert profiles[str(anonymousid)] == current_profile
+    assert len(mongo_db.get_records(config.MONGO_USER_PROFILES)) == 2
+
+    # Повторная миграция ничего не пишет
+    written = []
+    monkeypatch.setattr(mongo_db, 'upsert_records', lambda collection, records, key_fields: written.extend(records))
+    migrate_user_profiles()
+    assert written == []
+    assert get_profiles(mongo_db) == profiles
+
+
+def test_count_records(kmongo_db):
+    kmongo_db.insert_records(config.MONGO_USER_PROFILES, [{'profileVersion': 1}, {'profileVersion': PROFILE_VERSION}, {}])
+
+    assert kmongo_db.count_records(config.MONGO_USER_PROFILES) == 3
+    assert kmongo_db.count_records(config.MONGO_USER_PROFILES, {'profileVersion': {'$ne': PROFILE_VERSION}}) == 2
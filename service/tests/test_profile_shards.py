@@ -0,0 +1,65 @@
+import copy
+from service_ml import ProfileShards, calculate_recommendations_all
+from cache import film_cache
+from helpers import get_user_key, get_liked_film_ids
+from db import chunked
+from config import config
+from conftest import get_profiles
+
+
+def build_profiles(mongo_db, likes, number_of_shards, users_profiles=None, folded_at=None):
+    """
+        Profiles folded by chunks of 500 likes, stored profiles are passed with the first chunk of their user
+    """
+    users_profiles = users_profiles or {}
+    folded_at = folded_at or {}
+    with ProfileShards(number_of_shards) as shards:
+        for user_likes in chunked(likes, 500):
+            user_keys = {get_user_key(like) for like in user_likes if get_user_key(like) not in shards}
+            films = film_cache.get_films(mongo_db, get_liked_film_ids(user_likes))
+            shards.update(
+                user_likes,
+                films,
+                {key: users_profiles[key] for key in user_keys if key in users_profiles},
+                {key: folded_at[key] for key in user_keys if key in folded_at},
+            )
+        return shards.collect()
+
+
+def test_sharded_profiles_equal_serial(mongo_db, films, likes):
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+
+    serial_profiles = build_profiles(mongo_db, likes, 1)
+    sharded_profiles = build_profiles(mongo_db, likes, 2)
+
+    # Тот же порядок пользователей и те же профили
+    assert list(sharded_profiles) == list(serial_profiles)
+    assert sharded_profiles == serial_profiles
+
+
+def test_sharded_update_of_stored_profiles(mongo_db, films, likes):
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    stored_profiles = build_profiles(mongo_db, likes[:2000], 1)
+
+    def update(number_of_shards):
+        users_profiles = copy.deepcopy(stored_profiles)
+        folded_at = {key: profile['likesUpdatedAt'] for key, profile in stored_profiles.items()}
+        # Лайки до likesUpdatedAt профиля уже сложены и пропускаются
+        return build_profiles(mongo_db, likes[1500:], number_of_shards, users_profiles, folded_at)
+
+    serial_profiles = update(1)
+    assert update(2) == serial_profiles
+    full_profiles = build_profiles(mongo_db, likes, 1)
+    assert serial_profiles == {key: full_profiles[key] for key in serial_profiles}
+
+
+def test_rebuild_with_profile_workers(mongo_db, films, likes, monkeypatch):
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes)
+
+    calculate_recommendations_all(full_rebuild=True)
+    serial_profiles = get_profiles(mongo_db)
+
+    monkeypatch.setattr(config, 'PROFILE_WORKERS', 2)
+    calculate_recommendations_all(full_rebuild=True)
+    assert get_profiles(mongo_db) == serial_profiles
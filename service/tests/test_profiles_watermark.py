@@ -0,0 +1,37 @@
+from service_ml import calculate_recommendations_all, PROFILES_WATERMARK
+from config import config
+from conftest import get_profiles
+
+
+def get_watermark(mongo_db):
+    return mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": PROFILES_WATERMARK})["updatedAt"]
+
+
+def test_incremental_update_equals_full_rebuild(mongo_db, films, likes):
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes[:2000])
+
+    calculate_recommendations_all()
+    assert get_watermark(mongo_db) == likes[1999]['updatedAt']
+
+    # Новые лайки докидываются в профили по watermark
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes[2000:])
+    calculate_recommendations_all()
+    assert get_watermark(mongo_db) == likes[-1]['updatedAt']
+    incremental_profiles = get_profiles(mongo_db)
+
+    calculate_recommendations_all(full_rebuild=True)
+    assert get_profiles(mongo_db) == incremental_profiles
+
+
+def test_incremental_update_without_new_likes(mongo_db, films, likes):
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes)
+
+    calculate_recommendations_all()
+    profiles = get_profiles(mongo_db)
+
+    # Лайки до watermark второй раз не складываются
+    calculate_recommendations_all()
+    assert get_profiles(mongo_db) == profiles
+    assert get_watermark(mongo_db) == likes[-1]['updatedAt']
@@ -0,0 +1,24 @@
+import bson
+from bson import ObjectId, raw_bson
+from bson.raw_bson import RawBSONDocument
+from helpers import get_raw_document_id
+
+
+def test_raw_document_id_without_decoding(monkeypatch):
+    film = {'_id': ObjectId(), 'nameRu': 'фильм', 'staff': [{'personId': ObjectId(), 'proffession': 'ACTOR'}]}
+    document = RawBSONDocument(bson.encode(film))
+
+    # Любое обращение к полю RawBSONDocument декодирует документ целиком
+    decoded = []
+    inflate_bson = raw_bson._inflate_bson
+    monkeypatch.setattr(raw_bson, '_inflate_bson', lambda *args: decoded.append(1) or inflate_bson(*args))
+
+    assert get_raw_document_id(document) == film['_id']
+    assert decoded == []
+
+
+def test_raw_document_id_fallback():
+    # _id не первое поле или не ObjectId - обычное обращение к полю
+    for film in [{'nameRu': 'фильм', '_id': ObjectId()}, {'_id': 'film', 'nameRu': 'фильм'}]:
+        assert get_raw_document_id(RawBSONDocument(bson.encode(film))) == film['_id']
+    assert get_raw_document_id({'_id': 1}) == 1
@@ -0,0 +1,65 @@
+import datetime
+import pytest
+from bson import ObjectId
+from service_ml import calculate_film_recommendations, calculate_recommendations_all, calculate_model_snapshot
+from service_ml import calculate_recommendations_one, calculate_recommendations_many
+from calculations_user import film_factors
+from config import config
+from conftest import get_profiles, use_in_memory_db
+
+
+def get_recommendations(mongo_db):
+    records = [
+        {key: value for key, value in record.items() if key != '_id'}
+        for record in mongo_db.get_records(config.MONGO_USER_RECOMS_TABLE)
+    ]
+    return sorted(records, key=lambda record: (str(record.get('userId') or record.get('anonymousId')), record['rank']))
+
+
+def prepare_database(mongo_db, films, likes, new_likes, mode):
+    """
+        Profiles of likes, then new likes after watermark
+    """
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes)
+    calculate_recommendations_all()
+    if mode == 'neighbours':
+        calculate_film_recommendations()
+    if mode == 'factors':
+        calculate_model_snapshot()
+        # Без факторов режим factors молча уходит в inverted index
+        assert film_factors.get() is not None
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, new_likes)
+
+
+@pytest.mark.parametrize('mode', ['index', 'catalog', 'query', 'neighbours', 'factors'])
+def test_batch_equals_one_by_one(mongo_db, films, likes, mode, monkeypatch):
+    monkeypatch.setattr(config, 'FILM_CANDIDATES_MODE', mode)
+
+    # Новый пользователь без профиля и лайки существующего пользователя после watermark
+    user_ids = [str(like.get('userId') or like.get('anonymousId')) for like in likes]
+    user_ids = list(dict.fromkeys(user_ids))[:20]
+    new_userid = ObjectId()
+    new_likes = []
+    for i, film in enumerate(films[:5]):
+        updated_at = likes[-1]['updatedAt'] + datetime.timedelta(seconds=i + 1)
+        new_likes.append({'_id': ObjectId(), 'filmId': film['_id'], 'state': 'LIKE', 'userId': new_userid, 'updatedAt': updated_at})
+        new_likes.append({
+            '_id': ObjectId(), 'filmId': films[-i - 1]['_id'], 'state': 'LIKE',
+            'userId': likes[0].get('userId'), 'anonymousId': likes[0].get('anonymousId'), 'updatedAt': updated_at,
+        })
+    user_ids.append(str(new_userid))
+
+    prepare_database(mongo_db, films, likes, new_likes, mode)
+    for user_id in user_ids:
+        calculate_recommendations_one(user_id)
+    one_by_one = get_recommendations(mongo_db), get_profiles(mongo_db)
+    assert one_by_one[0]
+
+    # То же состояние базы, пользователи считаются одним batch
+    batch_db = use_in_memory_db(monkeypatch)
+    prepare_database(batch_db, films, likes, new_likes, mode)
+    response = calculate_recommendations_many(user_ids)
+
+    assert response['users'] == len(user_ids)
+    assert (get_recommendations(batch_db), get_profiles(batch_db)) == one_by_one
@@ -0,0 +1,47 @@
+import pytest
+from pymongo import IndexModel
+from service_ml import calculate_recommendations_all
+from config import config
+from conftest import get_profiles
+
+
+def test_replace_collection_swaps_staging(kmongo_db):
+    kmongo_db.database.results.insert_many([{"value": 1}, {"value": 2}])
+
+    number_of_records = kmongo_db.replace_collection(
+        "results",
+        [[{"value": 3}], [], [{"value": 4}, {"value": 5}]],
+        [IndexModel([("value", 1)])]
+    )
+
+    assert number_of_records == 3
+    assert [record["value"] for record in kmongo_db.database.results.find()] == [3, 4, 5]
+    assert "value_1" in kmongo_db.database.results.index_information()
+    assert kmongo_db.database.list_collection_names() == ["results"]
+
+
+def test_replace_collection_keeps_records_on_error(kmongo_db):
+    kmongo_db.database.results.insert_many([{"value": 1}, {"value": 2}])
+
+    def batches():
+        yield [{"value": 3}]
+        raise RuntimeError("batch failed")
+
+    with pytest.raises(RuntimeError):
+        kmongo_db.replace_collection("results", batches())
+
+    # Старые записи на месте, staging коллекция удалена
+    assert [record["value"] for record in kmongo_db.database.results.find()] == [1, 2]
+    assert kmongo_db.database.list_collection_names() == ["results"]
+
+
+def test_full_rebuild_replaces_profiles(mongo_db, films, likes):
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes)
+    calculate_recommendations_all()
+    profiles = get_profiles(mongo_db)
+
+    # Профиль пользователя без лайков не переживает full rebuild
+    mongo_db.insert_one_record(config.MONGO_USER_PROFILES, {"userId": None, "anonymousId": "stale", "genres": {}})
+    calculate_recommendations_all(full_rebuild=True)
+    assert get_profiles(mongo_db) == profiles
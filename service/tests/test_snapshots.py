@@ -0,0 +1,80 @@
+import os
+import mmap
+import time
+import numpy as np
+from scipy import sparse
+from snapshots import SnapshotStore, save_snapshot, load_snapshot, get_current_version, CURRENT_FILE
+
+
+def get_arrays(value):
+    return {
+        'values': np.full(5, value, dtype=np.float32),
+        'matrix': sparse.csr_matrix(np.eye(3, dtype=np.float32) * value),
+    }
+
+
+def is_memory_mapped(array):
+    # Массивы CSR матрицы - view на memmap, поэтому идём по цепочке base
+    while array is not None and not isinstance(array, mmap.mmap):
+        array = getattr(array, 'base', None)
+    return array is not None
+
+
+def test_snapshot_is_memory_mapped(tmp_path):
+    version = save_snapshot('test', get_arrays(1), meta={'films': 5}, directory=str(tmp_path))
+    snapshot = load_snapshot('test', directory=str(tmp_path))
+
+    assert snapshot.version == version == get_current_version('test', str(tmp_path))
+    assert snapshot.meta['films'] == 5
+    assert not snapshot['values'].flags.writeable
+    assert all(is_memory_mapped(array) for array in [snapshot['values'], snapshot['matrix'].data, snapshot['matrix'].indices])
+    assert np.array_equal(snapshot['values'], get_arrays(1)['values'])
+    assert (snapshot['matrix'] != get_arrays(1)['matrix']).nnz == 0
+
+
+def test_store_swaps_in_new_version(tmp_path):
+    store = SnapshotStore('test', lambda snapshot: float(snapshot['values'][0]), refresh_seconds=60, directory=str(tmp_path))
+    assert store.get() is None
+
+    save_snapshot('test', get_arrays(1), directory=str(tmp_path))
+    # CURRENT проверяется не чаще refresh_seconds, reset - сразу
+    assert store.get() is None
+    store.reset()
+    assert store.get() == 1
+
+    save_snapshot('test', get_arrays(2), directory=str(tmp_path))
+    assert store.get() == 1
+    store.reset()
+    assert store.get() == 2
+
+
+def test_store_refreshes_after_interval(tmp_path):
+    store = SnapshotStore('test', lambda snapshot: float(snapshot['values'][0]), refresh_seconds=0.05, directory=str(tmp_path))
+    save_snapshot('test', get_arrays(1), directory=str(tmp_path))
+    assert store.get() == 1
+
+    save_snapshot('test', get_arrays(2), directory=str(tmp_path))
+    time.sleep(0.1)
+    assert store.get() == 2
+
+
+def test_old_versions_are_removed(tmp_path):
+    first_version = save_snapshot('test', get_arrays(1), directory=str(tmp_path), keep_versions=1)
+    first_snapshot = load_snapshot('test', directory=str(tmp_path))
+    second_version = save_snapshot('test', get_arrays(2), directory=str(tmp_path), keep_versions=1)
+
+    assert sorted(os.listdir(tmp_path / 'test')) == sorted([CURRENT_FILE, second_version])
+    # Процесс, который ещё держит удалённую версию, читает её из замапленных файлов
+    assert first_snapshot.version == first_version
+    assert float(first_snapshot['values'][0]) == 1
+
+
+def test_broken_version_keeps_previous(tmp_path):
+    store = SnapshotStore('test', lambda snapshot: float(snapshot['values'][0]), refresh_seconds=60, directory=str(tmp_path))
+    save_snapshot('test', get_arrays(1), directory=str(tmp_path))
+    assert store.get() == 1
+
+    (tmp_path / 'test' / CURRENT_FILE).write_text('missing_version')
+    store.reset()
+    assert store.get() == 1
+    assert store.version != 'missing_version'
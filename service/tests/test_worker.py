@@ -0,0 +1,116 @@
+import datetime
+from bson import ObjectId
+from service_ml import calculate_recommendations_all, calculate_recommendations_many
+from worker import CoalescingQueue, ActivityTailer, TAILER_POSITION
+from config import config
+from conftest import get_profiles
+
+
+def test_queue_coalesces_events_of_user():
+    queue = CoalescingQueue(window_seconds=0, max_users=10)
+    for user_id in ['a', 'b', 'a', 'a', 'c']:
+        queue.put(user_id, None)
+
+    assert len(queue) == 3
+    assert queue.get_stats()['coalesced_events'] == 2
+    # Пользователи в порядке первого события
+    assert queue.get_batch(2) == ['a', 'b']
+    assert queue.get_batch(2) == ['c']
+
+
+def test_queue_waits_for_window():
+    queue = CoalescingQueue(window_seconds=60, max_users=10)
+    queue.put('a', None)
+    assert queue.get_batch(10, timeout=0.05) == []
+
+
+def test_queue_low_watermark_and_failed_users():
+    queue = CoalescingQueue(window_seconds=0, max_users=10)
+    queue.put('a', None)
+    queue.put('b', None)
+    users = queue.get_batch(10)
+    queue.put('a', None)
+
+    # Событие a в обработке -> watermark на нём, пока пачка не применена
+    assert queue.get_low_watermark() == 1
+    queue.done(users, failed=True)
+    assert queue.get_low_watermark() == 1
+    assert list(queue.pending) == ['a', 'b']
+
+    queue.done(queue.get_batch(10))
+    assert queue.get_low_watermark() is None
+
+
+def add_likes(mongo_db, films, users, started_at):
+    likes = []
+    for i, userid in enumerate(users):
+        likes.append({
+            '_id': ObjectId(), 'filmId': films[i % len(films)]['_id'], 'state': 'LIKE', 'userId': userid,
+            'updatedAt': started_at + datetime.timedelta(seconds=i // 2),
+        })
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes)
+    return likes
+
+
+def test_tailer_saves_position_of_applied_events(mongo_db, films, likes, monkeypatch):
+    monkeypatch.setattr(config, 'WORKER_POLL_BATCH_SIZE', 4)
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes)
+    calculate_recommendations_all()
+
+    users = [ObjectId() for _ in range(3)]
+    new_likes = add_likes(mongo_db, films, users * 2, likes[-1]['updatedAt'] + datetime.timedelta(seconds=1))
+    new_likes.sort(key=lambda like: (like['updatedAt'], like['_id']))
+
+    queue = CoalescingQueue(window_seconds=0, max_users=10)
+    tailer = ActivityTailer(mongo_db, queue)
+    tailer.load_position()
+    assert tailer.position == (likes[-1]['updatedAt'], None)
+
+    # Две пачки по 4 и 2 лайка, 6 событий от 3 пользователей
+    assert tailer.poll() == 4
+    assert tailer.poll() == 2
+    assert tailer.poll() == 0
+    assert len(queue) == 3
+
+    batch = queue.get_batch(2)
+    tailer.save_position()
+    assert mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": TAILER_POSITION}) is None
+
+    calculate_recommendations_many(batch)
+    queue.done(batch)
+    tailer.save_position()
+    # Третий пользователь ещё в очереди, его первое событие - в первой пачке
+    assert mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": TAILER_POSITION}) is None
+
+    batch = queue.get_batch(10)
+    calculate_recommendations_many(batch)
+    queue.done(batch)
+    tailer.save_position()
+    position = mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": TAILER_POSITION})
+    assert (position['updatedAt'], position['likeId']) == (new_likes[-1]['updatedAt'], new_likes[-1]['_id'])
+
+    # После перезапуска лайки до сохранённой позиции не читаются
+    restarted_tailer = ActivityTailer(mongo_db, CoalescingQueue(window_seconds=0, max_users=10))
+    restarted_tailer.load_position()
+    assert restarted_tailer.poll() == 0
+
+
+def test_repeated_recalculation_does_not_fold_likes_again(mongo_db, films, likes):
+    mongo_db.insert_records(config.MONGO_FILMS_TABLE, films)
+    mongo_db.insert_records(config.MONGO_FILMS_LIKES_TABLE, likes)
+    calculate_recommendations_all()
+
+    userid = likes[0].get('userId') or likes[0].get('anonymousId')
+    add_likes(mongo_db, films, [ObjectId(), ObjectId()], likes[-1]['updatedAt'] + datetime.timedelta(seconds=1))
+    user_ids = [str(userid)] + [str(like['userId']) for like in mongo_db.get_records(
+        config.MONGO_FILMS_LIKES_TABLE, {"updatedAt": {"$gt": likes[-1]['updatedAt']}})]
+
+    # Worker может пересчитать пользователя несколько раз до следующего calculate_recommendations_all
+    calculate_recommendations_many(user_ids)
+    profiles = get_profiles(mongo_db)
+    calculate_recommendations_many(user_ids)
+    assert get_profiles(mongo_db) == profiles
+
+    calculate_recommendations_all()
+    assert get_profiles(mongo_db) == profiles
@@ -0,0 +1,344 @@
+"""
+    Near-real-time updates of user profiles & recommendations.
+
+    Tailer polls like_dislike by (updatedAt, _id) and puts users of new likes into coalescing queue,
+    applier takes users, whose first event waited WORKER_COALESCE_SECONDS, and recalculates them
+    by micro-batches with service_ml.calculate_recommendations_many.
+
+    python worker.py
+"""
+import time
+import signal
+import logging
+import datetime
+import threading
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from service_ml import calculate_recommendations_many, PROFILES_WATERMARK
+from db import KMongoDb, get_client, close_client
+from indexes import ensure_indexes
+from metrics import metrics
+from config import config
+
+# Logger
+logging.getLogger(__name__)
+
+# Позиция tailer в коллекции состояния сервиса
+TAILER_POSITION = "activity_tailer"
+
+
+class CoalescingQueue:
+    """
+        Queue of dirty users. Repeated events of user, which is already queued, are coalesced into one entry.
+        User is ready, when the first queued event waited window_seconds. Queue holds max_users users,
+        put of new user blocks while queue is full (backpressure for tailer).
+
+        Every event gets sequence number, so tailer knows which events are applied:
+        all events with sequence less than get_low_watermark()
+    """
+    def __init__(self, window_seconds, max_users):
+        self.window_seconds = window_seconds
+        self.max_users = max_users
+        self.pending = OrderedDict()
+        self.in_flight = {}
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.stats = {'events': 0, 'coalesced_events': 0, 'applied_users': 0, 'failed_users': 0, 'batches': 0}
+        self.last_applied_lag = 0.0
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def put(self, user_id, event_time, stop_event=None):
+        """
+            Queue event of user, False if stop_event was set while waiting for free space
+        """
+        with self.condition:
+            while user_id not in self.pending and len(self.pending) >= self.max_users:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                self.condition.wait(timeout=1)
+
+            self.sequence += 1
+            self.stats['events'] += 1
+            entry = self.pending.get(user_id)
+            if entry is None:
+                self.pending[user_id] = {'sequence': self.sequence, 'queuedAt': time.monotonic(), 'eventTime': event_time}
+                self.condition.notify_all()
+            else:
+                self.stats['coalesced_events'] += 1
+            return True
+
+
+    def get_batch(self, max_users, timeout=1.0):
+        """
+            Up to max_users ready users, empty list if nobody is ready during timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                # Пользователи лежат в порядке первого события, готовые - в начале очереди
+                users = []
+                for user_id, entry in self.pending.items():
+                    if len(users) >= max_users or now - entry['queuedAt'] < self.window_seconds:
+                        break
+                    users.append(user_id)
+
+                if users:
+                    for user_id in users:
+                        self.in_flight[user_id] = self.pending.pop(user_id)
+                    self.condition.notify_all()
+                    return users
+
+                if now >= deadline:
+                    return []
+                oldest = next(iter(self.pending.values()), None)
+                wait_seconds = self.window_seconds - (now - oldest['queuedAt']) if oldest else deadline - now
+                self.condition.wait(timeout=max(0.01, min(wait_seconds, deadline - now)))
+
+
+    def done(self, users, failed=False):
+        """
+            Mark users as applied. Failed users are queued again with their first event
+        """
+        with self.condition:
+            now = time.monotonic()
+            for user_id in users:
+                entry = self.in_flight.pop(user_id)
+                if failed:
+                    pending_entry = self.pending.get(user_id)
+                    entry['queuedAt'] = now
+                    if pending_entry is not None:
+                        entry['sequence'] = min(entry['sequence'], pending_entry['sequence'])
+                    self.pending[user_id] = entry
+                    self.pending.move_to_end(user_id)
+                elif entry['eventTime'] is not None:
+                    self.last_applied_lag = (datetime.datetime.utcnow() - entry['eventTime']).total_seconds()
+
+            self.stats['batches'] += 1
+            self.stats['failed_users' if failed else 'applied_users'] += len(users)
+            self.condition.notify_all()
+
+
+    def get_low_watermark(self):
+        """
+            Min sequence of not applied events, None if everything is applied
+        """
+        with self.condition:
+            sequences = [entry['sequence'] for entry in self.pending.values()]
+            sequences += [entry['sequence'] for entry in self.in_flight.values()]
+            return min(sequences) if sequences else None
+
+
+    def get_stats(self):
+        with self.condition:
+            now = time.monotonic()
+            oldest = min((entry['queuedAt'] for entry in self.pending.values()), default=now)
+            stats = dict(self.stats)
+            stats['queue_users'] = len(self.pending)
+            stats['in_flight_users'] = len(self.in_flight)
+            stats['queue_oldest_seconds'] = now - oldest
+            stats['applied_lag_seconds'] = self.last_applied_lag
+        return stats
+
+
+class ActivityTailer:
+    """
+        Polls like_dislike for likes after (updatedAt, _id) position, works without replica set.
+        Position is saved after all events before it are applied, so on restart likes
+        are read again from the first not applied one
+    """
+    def __init__(self, mongo_db, queue):
+        self.mongo_db = mongo_db
+        self.queue = queue
+        self.position = None
+        self.saved_position = None
+        self.checkpoints = deque()
+        self.last_event_time = None
+
+
+    def load_position(self):
+        """
+            Saved position, else profiles watermark, else the latest like
+        """
+        state = self.mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": TAILER_POSITION})
+        if state is not None:
+            self.position = (state["updatedAt"], state["likeId"])
+            self.saved_position = self.position
+        else:
+            watermark = self.mongo_db.get_one_record(config.MONGO_SERVICE_STATE_TABLE, {"_id": PROFILES_WATERMARK})
+            if watermark is not None:
+                self.position = (watermark["updatedAt"], None)
+            else:
+                likes = self.mongo_db.get_sorted_limited_records(
+                    config.MONGO_FILMS_LIKES_TABLE,
+                    sort_field='updatedAt',
+                    ascending=False,
+                    select_query={"updatedAt":1},
+                    limit=1
+                )
+                self.position = (likes[0]["updatedAt"], likes[0]["_id"]) if likes else (None, None)
+
+        logging.info(f'Tailer starts after {self.position}')
+
+
+    def get_find_query(self):
+        updated_at, likeid = self.position
+        if updated_at is None:
+            return {}
+        if likeid is None:
+            return {"updatedAt": {"$gt": updated_at}}
+        return {"$or": [{"updatedAt": {"$gt": updated_at}}, {"updatedAt": updated_at, "_id": {"$gt": likeid}}]}
+
+
+    def poll(self, stop_event=None):
+        """
+            Read next likes and queue their users, number of read likes
+        """
+        likes = list(self.mongo_db.iter_records(
+            config.MONGO_FILMS_LIKES_TABLE,
+            find_query=self.get_find_query(),
+            select_query={"userId":1, "anonymousId":1, "updatedAt":1},
+            sort=[("updatedAt", 1), ("_id", 1)],
+            limit=config.WORKER_POLL_BATCH_SIZE
+        ))
+
+        for i, like in enumerate(likes):
+            userid = like.get("userId") or like.get("anonymousId")
+            if userid is not None and not self.queue.put(str(userid), like.get("updatedAt"), stop_event):
+                # Остановились, пока ждали место в очереди: продолжим с этого лайка
+                likes = likes[:i]
+                break
+
+        if likes:
+            self.position = (likes[-1].get("updatedAt"), likes[-1]["_id"])
+            self.last_event_time = likes[-1].get("updatedAt")
+            self.checkpoints.append((self.queue.sequence, self.position))
+        return len(likes)
+
+
+    def save_position(self):
+        """
+            Save the last position, all events before which are applied
+        """
+        low_watermark = self.queue.get_low_watermark()
+        position = None
+        while self.checkpoints and (low_watermark is None or self.checkpoints[0][0] < low_watermark):
+            position = self.checkpoints.popleft()[1]
+
+        if position is not None and position != self.saved_position:
+            self.mongo_db.update_one_record(
+                config.MONGO_SERVICE_STATE_TABLE,
+                {"_id": TAILER_POSITION},
+                {"$set": {"updatedAt": position[0], "likeId": position[1]}},
+                upsert=True
+            )
+            self.saved_position = position
+
+
+    def get_stats(self):
+        poll_lag = 0.0
+        if self.last_event_time is not None:
+            poll_lag = (datetime.datetime.utcnow() - self.last_event_time).total_seconds()
+        return {'poll_lag_seconds': poll_lag, 'pending_checkpoints': len(self.checkpoints)}
+
+
+def run_tailer(tailer, stop_event):
+    while not stop_event.is_set():
+        try:
+            number_of_likes = tailer.poll(stop_event)
+            tailer.save_position()
+        except Exception:
+            logging.exception('Tailer poll failed')
+            number_of_likes = 0
+
+        # Полная пачка -> сразу читаем следующую, иначе ждём новых лайков
+        if number_of_likes < config.WORKER_POLL_BATCH_SIZE:
+            stop_event.wait(config.WORKER_POLL_SECONDS)
+
+
+def run_applier(queue, stop_event):
+    while not stop_event.is_set():
+        users = queue.get_batch(config.WORKER_BATCH_USERS)
+        if not users:
+            continue
+
+        try:
+            calculate_recommendations_many(users)
+        except Exception:
+            logging.exception(f'Recommendations for {len(users)} users failed, users are queued again')
+            queue.done(users, failed=True)
+            stop_event.wait(config.WORKER_POLL_SECONDS)
+        else:
+            queue.done(users)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.DEBUG if config.LOGGIN_LEVEL == 'DEBUG' else logging.INFO,
+        format='[%(asctime)s: %(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    get_client()
+    mongo_db = KMongoDb(config.MONGO_INITDB_DATABASE)
+    if config.MONGO_ENSURE_INDEXES:
+        ensure_indexes(mongo_db)
+    queue = CoalescingQueue(config.WORKER_COALESCE_SECONDS, config.WORKER_QUEUE_MAX_USERS)
+    tailer = ActivityTailer(mongo_db, queue)
+    tailer.load_position()
+
+    metrics.register_gauges('kinoki_worker', lambda: dict(queue.get_stats(), **tailer.get_stats()))
+    server = None
+    if config.WORKER_METRICS_PORT:
+        server = ThreadingHTTPServer((config.API_HOST, config.WORKER_METRICS_PORT), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logging.info(f'Worker metrics on port {config.WORKER_METRICS_PORT}')
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop_event.set())
+
+    threads = [
+        threading.Thread(target=run_tailer, args=(tailer, stop_event), name='tailer'),
+        threading.Thread(target=run_applier, args=(queue, stop_event), name='applier'),
+    ]
+    for thread in threads:
+        thread.start()
+    logging.info('Worker started')
+
+    while not stop_event.is_set():
+        stop_event.wait(1)
+
+    logging.info('Stopping worker')
+    for thread in threads:
+        thread.join()
+    tailer.save_position()
+    if server is not None:
+        server.shutdown()
+    close_client()
+
+
+if __name__ == "__main__":
+    main()